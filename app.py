@@ -8,13 +8,71 @@ import secrets
 import logging
 import sys
 import uuid
+import subprocess
+import concurrent.futures
+import io
+import zipfile
+import hashlib
+import heapq
+import base64
+import math
+import atexit
+import bisect
+import queue
+import threading
+import ipaddress
+import sqlite3
+import csv
+import codecs
+import gzip
+import zlib
 import requests
+from collections import OrderedDict, Counter
+from urllib.parse import quote
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from flask import Flask, render_template, send_from_directory, abort, request, jsonify, session, redirect, url_for, \
-    flash
+from flask import Flask, render_template, send_from_directory, send_file, abort, request, jsonify, session, redirect, url_for, \
+    flash, g
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text, inspect
+from sqlalchemy import text, event, update, func, bindparam, tuple_
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.security import safe_join
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地调试
+    fcntl = None
+
+try:
+    import gevent
+    from gevent import monkey as gevent_monkey
+except ImportError:  # 未安装 gevent 时只能用 sync worker
+    gevent = gevent_monkey = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # 未安装 Pillow 时不生成缩略图
+    Image = ImageOps = None
+
+try:
+    import brotli
+except ImportError:  # 未安装 Brotli 时只生成 / 协商 gzip
+    brotli = None
+
+try:
+    import pygments
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_for_filename
+    from pygments.util import ClassNotFound as PygmentsClassNotFound
+except ImportError:  # 未安装 Pygments 时代码预览不高亮
+    pygments = None
+
+# 进程启动计时 (导入到可以处理请求)，见文件末尾
+_import_started = time.perf_counter()
 
 # ================= 日志配置 =================
 logging.basicConfig(
@@ -33,17 +91,28 @@ app.secret_key = "nexus-drive-fixed-secret"
 # 设置大一点，防止 Flask 层面限制上传
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024 * 1024 
 
-DATA_DIR = "/app/data"
-BASE_DIR = "/app/shares"
+# 环境变量可覆盖默认目录 (本地调试、bench/ 压测使用独立目录)
+DATA_DIR = os.environ.get('NEXUS_DATA_DIR', "/app/data")
+BASE_DIR = os.environ.get('NEXUS_BASE_DIR', "/app/shares")
+# gunicorn master 启动时执行数据库迁移用的一次性进程，不启动任何后台线程
+MIGRATE_ONLY = os.environ.get('NEXUS_MIGRATE_ONLY') == '1'
 
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(BASE_DIR, exist_ok=True)
 
 CONFIG_FILE = os.path.join(DATA_DIR, 'nexus.conf')
+# 运行时状态 (下载名额、令牌桶、登录失败记录)，所有 worker 共用，丢失也无妨
+RUNTIME_DB_FILE = os.path.join(DATA_DIR, 'runtime.db')
+
+# (mtime_ns, size) -> 解析结果；配置文件没变时不再重复读取
+_config_cache = (None, None)
 
 def get_config():
+    global _config_cache
     defaults = {'user_password': '123456', 'admin_password': 'admin'}
-    if not os.path.exists(CONFIG_FILE):
+    try:
+        st = os.stat(CONFIG_FILE)
+    except FileNotFoundError:
         try:
             with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
                 f.write(f"user_password={defaults['user_password']}\n")
@@ -51,6 +120,12 @@ def get_config():
         except Exception as e:
             app.logger.error(f"Config write error: {e}")
         return defaults
+    except OSError as e:
+        app.logger.error(f"Config stat error: {e}")
+        return defaults
+    version, cached = _config_cache
+    if version == (st.st_mtime_ns, st.st_size):
+        return dict(cached)
     config = defaults.copy()
     try:
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
@@ -62,7 +137,63 @@ def get_config():
                     config[key.strip()] = value.strip()
     except Exception as e:
         app.logger.error(f"Config read error: {e}")
-    return config
+        return config
+    _config_cache = ((st.st_mtime_ns, st.st_size), config)
+    return dict(config)
+
+def _config_number(config, key, default, cast=int):
+    try:
+        return cast(config.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+# ================= 协程模式 (gevent) =================
+# gunicorn.conf.py 默认使用 gevent worker：加载应用前标准库已被 monkey patch，socket / time.sleep /
+# threading / queue 都会在阻塞时切换协程，慢速下载、大文件上传、requests 查询 IP 只挂起自己的协程。
+# 剩下会卡住整个 worker 的是不经过 Python socket 的阻塞：SQLite 写入 (忙等待在 C 里 sleep)、
+# 大文件哈希、后台任务的磁盘复制，这些用 run_blocking 放到 gevent 的真实线程池执行；
+# 长循环 (目录遍历、文件分块发送) 里调用 cooperate() 主动让出。sync worker 下两者都是直接调用。
+
+GREEN_MODE = gevent_monkey is not None and gevent_monkey.is_module_patched('socket')
+
+def cooperate():
+    if GREEN_MODE: gevent.sleep(0)
+
+def run_blocking(fn, *args, **kwargs):
+    if GREEN_MODE:
+        return gevent.get_hub().threadpool.apply(fn, args, kwargs)
+    return fn(*args, **kwargs)
+
+# ================= 跨进程文件锁 =================
+
+@contextmanager
+def file_lock(name, blocking=True):
+    """
+    gunicorn 多 worker 之间的互斥锁 (DATA_DIR/<name>.lock)。
+    非阻塞模式下拿不到锁时 yield False；Windows 本地调试没有 fcntl，直接视为拿到锁。
+    """
+    if fcntl is None:
+        yield True
+        return
+    with open(os.path.join(DATA_DIR, f"{name}.lock"), 'a') as f:
+        try:
+            if blocking and GREEN_MODE:
+                # flock 阻塞会卡住整个 gevent worker，改为非阻塞轮询
+                while True:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        gevent.sleep(0.01)
+            else:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 # ================= 时间工具 =================
 def get_beijing_time():
@@ -73,15 +204,36 @@ def get_beijing_time():
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{os.path.join(DATA_DIR, "logs.db")}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['JSON_AS_ASCII'] = False
+# gevent worker 里同时处理的请求多，默认的 5 + 10 个连接不够时请求会排队等待
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {'pool_size': 10, 'max_overflow': 30, 'pool_timeout': 30,
+                                           'connect_args': {'timeout': 30}}
 
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    """每个新连接的设置 (journal_mode=WAL 写在库文件里，由迁移设置一次)"""
+    if not isinstance(dbapi_conn, sqlite3.Connection): return
+    cursor = dbapi_conn.cursor()
+    # WAL 模式下 NORMAL 只在断电时可能丢失最近几个事务，不会损坏数据库
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA cache_size=-16384")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
 # 新增：用于存储历史统计数据的模型
 class SystemStat(db.Model):
     key = db.Column(db.String(50), primary_key=True) # 例如 'total_downloads'
     value = db.Column(db.Integer, default=0)
 
 class DownloadLog(db.Model):
+    # 日志按 (timestamp, id) 倒序 keyset 分页，每种筛选条件都有以它开头、以时间结尾的组合索引；
+    # 时间索引带上 filename，文件名子串筛选只扫索引不回表
+    __table_args__ = (
+        db.Index('ix_download_log_ts', 'timestamp', 'id', 'filename'),
+        db.Index('ix_download_log_action_ts', 'action', 'timestamp'),
+        db.Index('ix_download_log_ip_ts', 'ip_address', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     filename = db.Column(db.String(200))
     ip_address = db.Column(db.String(50))
@@ -90,7 +242,22 @@ class DownloadLog(db.Model):
     device_type = db.Column(db.String(100), default='未知')
     timestamp = db.Column(db.DateTime, default=get_beijing_time)
 
+# 日志汇总表：后台定期把 download_log 按小时 / 按天聚合进来，面板的趋势图和热门文件只查这两张表
+class LogHourly(db.Model):
+    hour = db.Column(db.String(13), primary_key=True)  # 'YYYY-MM-DD HH'
+    action = db.Column(db.String(20), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
+class LogDaily(db.Model):
+    day = db.Column(db.String(10), primary_key=True)  # 'YYYY-MM-DD'
+    action = db.Column(db.String(20), primary_key=True)
+    filename = db.Column(db.String(200), primary_key=True)
+    ip_location = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, default=0)
+
 class FileShare(db.Model):
+    # 后台外链列表按 (created_at, id) 倒序 keyset 分页
+    __table_args__ = (db.Index('ix_file_share_created', 'created_at', 'id'),)
     id = db.Column(db.Integer, primary_key=True)
     file_path = db.Column(db.String(500), nullable=False)
     slug = db.Column(db.String(50), unique=True, nullable=False)
@@ -98,46 +265,52 @@ class FileShare(db.Model):
     created_at = db.Column(db.DateTime, default=get_beijing_time)
     downloads = db.Column(db.Integer, default=0)
 
-def check_and_update_db():
-    """
-    启动时检查数据库结构
-    """
-    with app.app_context():
-        db.create_all()
-        inspector = inspect(db.engine)
-        columns = [c['name'] for c in inspector.get_columns('download_log')]
-        
-        if 'action' not in columns:
-            try:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE download_log ADD COLUMN action VARCHAR(20)"))
-                    conn.execute(text("UPDATE download_log SET action = 'down'"))
-                    conn.commit()
-            except Exception as e: app.logger.error(f"DB Update Action Error: {e}")
-            
-        if 'ip_location' not in columns:
-            try:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE download_log ADD COLUMN ip_location VARCHAR(100)"))
-                    conn.commit()
-            except Exception as e: app.logger.error(f"DB Update Location Error: {e}")
+class FileJob(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # delete / move / copy
+    status = db.Column(db.String(20), default='pending', index=True)
+    path = db.Column(db.String(500), default='')  # 源文件夹
+    names = db.Column(db.Text)  # JSON 数组
+    dest = db.Column(db.String(500), nullable=True)
+    targets = db.Column(db.Text, nullable=True)  # JSON 对象: 源名称 -> 目标名称，首次执行时确定，重试沿用
+    total_items = db.Column(db.Integer, default=0)
+    done_items = db.Column(db.Integer, default=0)
+    total_bytes = db.Column(db.BigInteger, default=0)
+    done_bytes = db.Column(db.BigInteger, default=0)
+    attempts = db.Column(db.Integer, default=0)
+    cancel_requested = db.Column(db.Boolean, default=False)
+    message = db.Column(db.String(500), nullable=True)
+    created_at = db.Column(db.DateTime, default=get_beijing_time)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
 
-        if 'device_type' not in columns:
-            try:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE download_log ADD COLUMN device_type VARCHAR(100)"))
-                    conn.commit()
-            except Exception as e: app.logger.error(f"DB Update Device Error: {e}")
+# ================= 统计工具函数 =================
+# total_downloads / total_views / total_logins：清空日志时归档的历史数据
+# live:<action>：download_log 中当前各动作的行数，live:_all 为总行数
+# day:<YYYY-MM-DD>:<action>：每日事件数 (清空日志不影响)
+# 计数器随日志批量写入在同一事务中递增，后台面板只需按主键读取这几行。
 
-check_and_update_db()
+COUNTERS_VERSION_KEY = 'counters_version'
+LIVE_TOTAL_KEY = 'live:_all'
 
-# ================= 统计工具函数 =================
+def live_counter_key(action):
+    return f"live:{action or 'unknown'}"
+
+def day_counter_key(day, action):
+    return f"day:{day}:{action or 'unknown'}"
 
 def get_archived_stat(key):
     """获取归档的历史统计数据"""
     stat = SystemStat.query.get(key)
     return stat.value if stat else 0
 
+def get_stats(keys):
+    """一次查询读取多个计数器，不存在的记为 0"""
+    rows = SystemStat.query.filter(SystemStat.key.in_(keys)).all()
+    values = dict.fromkeys(keys, 0)
+    values.update({r.key: r.value or 0 for r in rows})
+    return values
+
 def update_archived_stat(key, count):
     """累加历史统计数据"""
     if count == 0: return
@@ -147,6 +320,170 @@ def update_archived_stat(key, count):
         db.session.add(stat)
     stat.value += count
 
+def increment_counters(deltas):
+    """在当前事务内批量累加计数器 (INSERT ... ON CONFLICT DO UPDATE)"""
+    deltas = {k: v for k, v in deltas.items() if v}
+    if not deltas: return
+    table = SystemStat.__table__
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(index_elements=[table.c.key], set_={'value': table.c.value + stmt.excluded.value})
+    db.session.execute(stmt, [{'key': k, 'value': v} for k, v in deltas.items()])
+
+def count_events(events):
+    """统计一批日志事件对应的计数器增量"""
+    deltas = Counter()
+    for e in events:
+        deltas[LIVE_TOTAL_KEY] += 1
+        deltas[live_counter_key(e['action'])] += 1
+        deltas[day_counter_key(e['timestamp'].strftime('%Y-%m-%d'), e['action'])] += 1
+    return deltas
+
+def recompute_counters():
+    """根据 download_log 重新计算 live:* 和表中仍存在的日期的 day:* 计数器，用于修复偏差"""
+    SystemStat.query.filter(SystemStat.key.like('live:%')).delete(synchronize_session=False)
+    total = 0
+    for action, count in db.session.query(DownloadLog.action, func.count()).group_by(DownloadLog.action):
+        db.session.add(SystemStat(key=live_counter_key(action), value=count))
+        total += count
+    db.session.add(SystemStat(key=LIVE_TOTAL_KEY, value=total))
+    day = func.strftime('%Y-%m-%d', DownloadLog.timestamp)
+    for day_value, action, count in db.session.query(day, DownloadLog.action, func.count()).group_by(day, DownloadLog.action):
+        if not day_value: continue
+        db.session.merge(SystemStat(key=day_counter_key(day_value, action), value=count))
+    db.session.merge(SystemStat(key=COUNTERS_VERSION_KEY, value=1))
+    db.session.commit()
+    return total
+
+# 后台面板的三项统计 = 归档值 + 对应动作的实时计数
+ARCHIVED_STAT_ACTIONS = {
+    'total_downloads': ['down'],
+    'total_views': ['view'],
+    'total_logins': ['login', 'user_login'],
+}
+
+def get_dashboard_stats():
+    keys = list(ARCHIVED_STAT_ACTIONS) + [LIVE_TOTAL_KEY] + \
+        [live_counter_key(a) for actions in ARCHIVED_STAT_ACTIONS.values() for a in actions]
+    values = get_stats(keys)
+    stats = {k: values[k] + sum(values[live_counter_key(a)] for a in actions)
+             for k, actions in ARCHIVED_STAT_ACTIONS.items()}
+    return stats, values[LIVE_TOTAL_KEY]
+
+@app.cli.command('recompute-stats')
+def recompute_stats_command():
+    """根据日志表重新计算后台统计计数器"""
+    total = recompute_counters()
+    print(f"计数器已重新计算，当前日志 {total} 条")
+
+# ================= 数据库迁移 =================
+# logs.db 的结构变更按版本号顺序执行一次，已执行到的版本记在 schema_version 表里。
+# gunicorn master 启动时 (gunicorn.conf.py 的 on_starting) 先在独立进程里跑完迁移，
+# worker 导入时只查一次版本号；不经过 gunicorn 启动时由第一个拿到 schema 文件锁的进程执行，其他进程等它完成。
+# 迁移函数必须可以重复执行 (执行完、记录版本号之前进程退出的话，下次会再跑一遍)。
+# 新的结构变更只能追加到 SCHEMA_MIGRATIONS 末尾，不要修改已发布的迁移。
+
+def _migrate_create_tables():
+    db.create_all()
+
+def _migrate_log_columns():
+    """早期版本的 download_log 只有 filename / ip_address / timestamp"""
+    with db.engine.begin() as conn:
+        columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(download_log)")}
+        if 'action' not in columns:
+            conn.exec_driver_sql("ALTER TABLE download_log ADD COLUMN action VARCHAR(20)")
+            conn.exec_driver_sql("UPDATE download_log SET action = 'down'")
+        if 'ip_location' not in columns:
+            conn.exec_driver_sql("ALTER TABLE download_log ADD COLUMN ip_location VARCHAR(100)")
+        if 'device_type' not in columns:
+            conn.exec_driver_sql("ALTER TABLE download_log ADD COLUMN device_type VARCHAR(100)")
+
+def _migrate_log_indexes():
+    """老库补上组合索引 (create_all 不会给已存在的表补索引)，单列索引已被组合索引覆盖，删掉省写入开销"""
+    with db.engine.begin() as conn:
+        for index in DownloadLog.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_download_log_action")
+        conn.exec_driver_sql("DROP INDEX IF EXISTS ix_download_log_timestamp")
+
+def _migrate_counters():
+    """首次升级时根据现有日志初始化实时计数器"""
+    if not db.session.get(SystemStat, COUNTERS_VERSION_KEY):
+        recompute_counters()
+
+def _migrate_wal():
+    """WAL 模式写在库文件里，设置一次即可；读写可以并发，提交也不必每次刷盘"""
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+
+def _migrate_log_rollups():
+    """日志汇总表；已有日志由后台汇总线程从头补齐"""
+    db.create_all()
+
+def _migrate_share_index():
+    with db.engine.begin() as conn:
+        for index in FileShare.__table__.indexes:
+            index.create(bind=conn, checkfirst=True)
+
+SCHEMA_MIGRATIONS = [
+    (1, '创建数据表', _migrate_create_tables),
+    (2, 'download_log 补充 action / ip_location / device_type 字段', _migrate_log_columns),
+    (3, 'download_log 组合索引', _migrate_log_indexes),
+    (4, '初始化统计计数器', _migrate_counters),
+    (5, '启用 WAL', _migrate_wal),
+    (6, '日志按小时 / 按天汇总表', _migrate_log_rollups),
+    (7, 'file_share 创建时间索引', _migrate_share_index),
+]
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1][0]
+
+def get_schema_version():
+    try:
+        with db.engine.connect() as conn:
+            return conn.exec_driver_sql("SELECT MAX(version) FROM schema_version").scalar() or 0
+    except OperationalError:
+        # 还没有 schema_version 表：新库，或升级前的老版本建的库
+        return 0
+
+def migrate_db():
+    """执行未完成的迁移 (调用方持有 schema 文件锁)，返回本次执行的 [(版本号, 说明)]"""
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                applied_at DATETIME NOT NULL
+            )''')
+    current = get_schema_version()
+    applied = []
+    for version, name, migrate in SCHEMA_MIGRATIONS:
+        if version <= current: continue
+        started = time.perf_counter()
+        migrate()
+        with db.engine.begin() as conn:
+            conn.execute(text("INSERT OR REPLACE INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+                         {'v': version, 'n': name, 't': get_beijing_time()})
+        app.logger.info(f"Schema migration {version} ({name}) applied in {time.perf_counter() - started:.2f}s")
+        applied.append((version, name))
+    return applied
+
+def init_db():
+    """导入时调用：版本已是最新就直接返回，否则拿 schema 文件锁执行迁移"""
+    with app.app_context():
+        if get_schema_version() >= SCHEMA_VERSION: return []
+        with file_lock('schema'):
+            return migrate_db()
+
+@app.cli.command('migrate-db')
+def migrate_db_command():
+    """执行未完成的数据库迁移 (gunicorn master 启动时自动调用)"""
+    with file_lock('schema'):
+        applied = schema_migrations_applied + migrate_db()
+    done = '、'.join(str(version) for version, _ in applied) or '无'
+    print(f"数据库结构版本 {get_schema_version()}，本次执行的迁移: {done}")
+
+_schema_started = time.perf_counter()
+schema_migrations_applied = init_db()
+schema_seconds = time.perf_counter() - _schema_started
+
 # ================= 常用工具函数 =================
 
 def get_real_ip():
@@ -156,26 +493,478 @@ def get_real_ip():
         return request.headers.get('X-Forwarded-For').split(',')[0].strip()
     return request.remote_addr
 
+def get_client_addr():
+    """
+    限流用的客户端地址：ProxyFix 只采信最近一层代理追加的 X-Forwarded-For。
+    get_real_ip() 直接读客户端可以随意填写的请求头，只用于日志展示，不能作为限流的依据。
+    """
+    return request.remote_addr
+
+# ================= 后台线程 =================
+
+class BackgroundWorker:
+    """按进程懒启动的后台线程 (gunicorn fork 之后线程不会被继承，首次使用时再启动)"""
+    name = 'background'
+
+    def __init__(self):
+        self._pid = None
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() or MIGRATE_ONLY: return
+        with self._start_lock:
+            if self._pid == os.getpid(): return
+            self._on_start()
+            self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _on_start(self):
+        """线程启动前重置本进程状态"""
+        pass
+
+    def _run(self):
+        raise NotImplementedError
+
+# ================= 运行指标 =================
+# 进程内累计 counter / histogram / gauge，后台线程每隔几秒把快照写到 METRICS_DIR/<pid>.json；
+# /admin/metrics 合并所有 worker 的快照输出 Prometheus 文本格式。
+# counter 和 histogram 直接相加，已退出进程的快照并入 archive.json 以保持单调递增；gauge 只统计存活进程。
+
+METRICS_DIR = os.path.join(DATA_DIR, 'metrics')
+METRICS_FLUSH_INTERVAL = 5
+METRICS_ARCHIVE_FILE = 'archive.json'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIC_DEFINITIONS = {
+    'nexus_http_requests_total': ('counter', '按接口、方法和状态码统计的请求数'),
+    'nexus_http_request_duration_seconds': ('histogram', '按接口统计的请求处理耗时 (流式响应只计到开始发送)'),
+    'nexus_http_requests_in_flight': ('gauge', '正在处理中的请求数'),
+    'nexus_http_response_bytes_total': ('counter', '按接口统计的响应字节数 (有 Content-Length 的响应和打包下载)'),
+    'nexus_offloaded_bytes_total': ('counter', '交给 nginx/Apache 发送的文件字节数'),
+    'nexus_operation_duration_seconds': ('histogram', '热点操作耗时：数据库提交、目录扫描、搜索、Markdown 渲染、IP 查询、进程启动等'),
+    'nexus_activity_dropped_total': ('counter', '活动日志队列已满时丢弃的事件数'),
+    'nexus_transfers_in_flight': ('gauge', '正在进行的文件传输数'),
+    'nexus_traffic_rejected_total': ('counter', '因并发数或带宽超限被拒绝的下载'),
+    'nexus_traffic_throttled_seconds_total': ('counter', '限速等待的总秒数'),
+    'nexus_login_failures_total': ('counter', '按入口统计的登录失败次数'),
+    'nexus_login_throttled_total': ('counter', '因失败次数过多被拒绝的登录尝试'),
+    'nexus_rebalanced_bytes_total': ('counter', '后台均衡在卷之间搬运的字节数'),
+    'nexus_logs_purged_total': ('counter', '超过保留天数、汇总后删除的原始日志条数'),
+}
+
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+def _metric_key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+class Metrics(BackgroundWorker):
+    name = 'metrics'
+
+    def __init__(self, metrics_dir=METRICS_DIR, interval=METRICS_FLUSH_INTERVAL):
+        super().__init__()
+        self.metrics_dir = metrics_dir
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+
+    def _on_start(self):
+        # fork 出来的 worker 不继承 master 的计数
+        with self._lock:
+            self._reset()
+
+    # ---------- 记录 ----------
+
+    def inc(self, name, value=1, **labels):
+        self._ensure_started()
+        key = _metric_key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge_add(self, name, delta, **labels):
+        self._ensure_started()
+        key = _metric_key(name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + delta
+
+    def observe(self, name, seconds, **labels):
+        self._ensure_started()
+        key = _metric_key(name, labels)
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]
+            hist[index] += 1
+            hist[-1] += seconds
+
+    @contextmanager
+    def timer(self, op):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('nexus_operation_duration_seconds', time.perf_counter() - started, op=op)
+
+    # ---------- 跨进程汇总 ----------
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'counters': [[k[0], list(k[1]), v] for k, v in self.counters.items()],
+                'histograms': [[k[0], list(k[1]), list(v)] for k, v in self.histograms.items()],
+                'gauges': [[k[0], list(k[1]), v] for k, v in self.gauges.items()],
+            }
+
+    def _write_json(self, filename, data):
+        path = os.path.join(self.metrics_dir, filename)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def flush(self):
+        if self._pid != os.getpid(): return
+        try:
+            self._write_json(f"{os.getpid()}.json", self.snapshot())
+        except OSError as e:
+            app.logger.error(f"Metrics flush error: {e}")
+
+    @staticmethod
+    def _merge(total, snap, include_gauges=True):
+        for name, labels, value in snap.get('counters', []):
+            key = (name, tuple(map(tuple, labels)))
+            total['counters'][key] = total['counters'].get(key, 0) + value
+        for name, labels, values in snap.get('histograms', []):
+            key = (name, tuple(map(tuple, labels)))
+            current = total['histograms'].get(key)
+            total['histograms'][key] = values if current is None else [a + b for a, b in zip(current, values)]
+        if include_gauges:
+            for name, labels, value in snap.get('gauges', []):
+                key = (name, tuple(map(tuple, labels)))
+                total['gauges'][key] = total['gauges'].get(key, 0) + value
+
+    @staticmethod
+    def _pid_alive(pid):
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    @staticmethod
+    def _to_snapshot(total):
+        return {
+            'counters': [[k[0], list(k[1]), v] for k, v in total['counters'].items()],
+            'histograms': [[k[0], list(k[1]), v] for k, v in total['histograms'].items()],
+        }
+
+    def collect(self):
+        """合并所有进程的快照；已退出进程的快照并入 archive.json 后删除"""
+        self.flush()
+        total = {'counters': {}, 'histograms': {}, 'gauges': {}}
+        with file_lock('metrics'):
+            archive = {'counters': {}, 'histograms': {}, 'gauges': {}}
+            try:
+                with open(os.path.join(self.metrics_dir, METRICS_ARCHIVE_FILE), 'r', encoding='utf-8') as f:
+                    self._merge(archive, json.load(f), include_gauges=False)
+            except (OSError, ValueError):
+                pass
+            archived = False
+            for filename in os.listdir(self.metrics_dir):
+                if not filename.endswith('.json') or filename == METRICS_ARCHIVE_FILE: continue
+                path = os.path.join(self.metrics_dir, filename)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        snap = json.load(f)
+                except (OSError, ValueError):
+                    continue
+                if self._pid_alive(snap.get('pid', 0)):
+                    self._merge(total, snap)
+                else:
+                    self._merge(archive, snap, include_gauges=False)
+                    os.remove(path)
+                    archived = True
+            if archived:
+                self._write_json(METRICS_ARCHIVE_FILE, self._to_snapshot(archive))
+        self._merge(total, self._to_snapshot(archive), include_gauges=False)
+        return total
+
+    def render(self):
+        total = self.collect()
+        by_name = {}
+        for kind in ('counters', 'gauges', 'histograms'):
+            for (name, labels), value in total[kind].items():
+                by_name.setdefault(name, []).append((labels, value))
+
+        def fmt_labels(labels, extra=None):
+            pairs = list(labels) + ([extra] if extra else [])
+            if not pairs: return ''
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+            return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+        lines = []
+        for name in sorted(by_name):
+            kind, help_text = METRIC_DEFINITIONS.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name[name], key=lambda x: x[0]):
+                if kind != 'histogram':
+                    lines.append(f"{name}{fmt_labels(labels)} {value}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{fmt_labels(labels, ('le', bound))} {cumulative}")
+                lines.append(f"{name}_sum{fmt_labels(labels)} {value[-1]}")
+                lines.append(f"{name}_count{fmt_labels(labels)} {cumulative}")
+        return '\n'.join(lines) + '\n'
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+metrics = Metrics()
+atexit.register(metrics.flush)
+
+def count_streamed_bytes(chunks, endpoint):
+    """流式响应没有 Content-Length，边发送边计数"""
+    for chunk in chunks:
+        metrics.inc('nexus_http_response_bytes_total', len(chunk), endpoint=endpoint)
+        yield chunk
+
+# ================= IP 归属地解析 =================
+# 请求线程只读缓存 / 离线库，网络查询全部交给后台线程，写库后再回填 DownloadLog.ip_location
+
+IP_LOCATION_PENDING = '查询中'
+IP_CACHE_SIZE = 4096
+IP_CACHE_TTL = 24 * 3600
+IP_CACHE_FAIL_TTL = 300
+IP_DB_FILE = os.path.join(DATA_DIR, 'ipdb.txt')
+
+def is_internal_ip(ip):
+    return ip in ['127.0.0.1', 'localhost', '::1'] or ip.startswith('192.168.') or ip.startswith('10.') or ip.startswith('172.')
+
+def ip_to_int(ip):
+    try:
+        return int(ipaddress.IPv4Address(ip))
+    except ValueError:
+        return None
+
+class IPLocationCache:
+    """归属地缓存：LRU + TTL，IPv4 按 /24 网段聚合，线程安全"""
+
+    def __init__(self, maxsize=IP_CACHE_SIZE, ttl=IP_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key_for(ip):
+        parts = ip.split('.')
+        if len(parts) == 4:
+            return '.'.join(parts[:3]) + '.0/24'
+        return ip
+
+    def get(self, ip):
+        key = self.key_for(ip)
+        with self._lock:
+            item = self._data.get(key)
+            if item is None: return None
+            location, expire_at = item
+            if expire_at < time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return location
+
+    def put(self, ip, location, ttl=None):
+        key = self.key_for(ip)
+        with self._lock:
+            self._data[key] = (location, time.time() + (ttl or self.ttl))
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+class HttpIPSource:
+    """在线查询 (whois.pconline.com.cn)，会阻塞，只能在后台线程调用 (gevent 模式下只挂起该协程)"""
+    name = 'http'
+    blocking = True
+
+    def lookup(self, ip):
+        try:
+            url = "https://whois.pconline.com.cn/ipJson.jsp"
+            params = {'ip': ip, 'json': 'true'}
+            headers = {'User-Agent': 'Mozilla/5.0'}
+            with metrics.timer('ip_lookup'):
+                resp = requests.get(url, params=params, headers=headers, timeout=3)
+            if resp.status_code == 200:
+                content = resp.content.decode('gbk', 'ignore').strip()
+                data = json.loads(content)
+                if 'addr' in data and data['addr']:
+                    return data['addr'].strip()
+                if 'pro' in data or 'city' in data:
+                    return f"{data.get('pro','')} {data.get('city','')}".strip() or None
+        except Exception as e:
+            app.logger.error(f"IP Query Error: {str(e)}")
+        return None
+
+class OfflineIPSource:
+    """
+    离线 IP 段库，二分查找，不走网络，请求线程可直接调用。
+    文件每行一段：`起始IP 结束IP 归属地`，IP 可写点分或整数，# 开头为注释。
+    文件 mtime 变化时自动重新加载。
+    """
+    name = 'offline'
+    blocking = False
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        # (起始列表, 结束列表, 归属地列表) 整体替换，查询时只读一次，重新加载不会读到新旧混合的数据
+        self._ranges = ([], [], [])
+        self._lock = threading.Lock()
+
+    def _parse_ip(self, value):
+        return int(value) if value.isdigit() else ip_to_int(value)
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self._mtime: return
+        with self._lock:
+            if mtime == self._mtime: return
+            ranges = []
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line or line.startswith('#'): continue
+                        parts = line.split(None, 2)
+                        if len(parts) < 3: continue
+                        start, end = self._parse_ip(parts[0]), self._parse_ip(parts[1])
+                        if start is None or end is None: continue
+                        ranges.append((start, end, parts[2].strip()))
+            except Exception as e:
+                app.logger.error(f"IP DB Load Error: {e}")
+                return
+            ranges.sort()
+            self._ranges = ([r[0] for r in ranges], [r[1] for r in ranges], [r[2] for r in ranges])
+            self._mtime = mtime
+            app.logger.info(f"IP DB loaded: {len(ranges)} ranges")
+
+    def lookup(self, ip):
+        self._load()
+        n = ip_to_int(ip)
+        if n is None: return None
+        starts, ends, locations = self._ranges
+        idx = bisect.bisect_right(starts, n) - 1
+        if idx >= 0 and n <= ends[idx]:
+            return locations[idx]
+        return None
+
+ip_location_cache = IPLocationCache()
+_ip_sources = {}
+
+def get_ip_source():
+    """
+    按配置选择查询源 (nexus.conf: ip_source=auto|offline|http|off)
+    auto: 存在离线库文件时用离线库，否则在线查询
+    """
+    config = get_config()
+    mode = config.get('ip_source', 'auto')
+    db_file = config.get('ip_db', IP_DB_FILE)
+    if mode == 'off': return None
+    if mode == 'offline' or (mode == 'auto' and os.path.exists(db_file)):
+        if db_file not in _ip_sources: _ip_sources[db_file] = OfflineIPSource(db_file)
+        return _ip_sources[db_file]
+    if 'http' not in _ip_sources: _ip_sources['http'] = HttpIPSource()
+    return _ip_sources['http']
+
 def get_ip_location_info(ip):
-    if ip in ['127.0.0.1', 'localhost', '::1'] or ip.startswith('192.168.') or ip.startswith('10.') or ip.startswith('172.'):
+    """完整查询 (可能阻塞在网络上)，供后台线程使用"""
+    if is_internal_ip(ip):
         return "内网/本地"
-    try:
-        url = "https://whois.pconline.com.cn/ipJson.jsp"
-        params = {'ip': ip, 'json': 'true'}
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        resp = requests.get(url, params=params, headers=headers, timeout=3)
-        if resp.status_code == 200:
-            content = resp.content.decode('gbk', 'ignore').strip()
-            data = json.loads(content)
-            if 'addr' in data and data['addr']:
-                return data['addr'].strip()
-            if 'pro' in data or 'city' in data:
-                return f"{data.get('pro','')} {data.get('city','')}".strip()
-    except Exception as e:
-        app.logger.error(f"IP Query Error: {str(e)}")
-        pass
+    cached = ip_location_cache.get(ip)
+    if cached is not None: return cached
+    source = get_ip_source()
+    location = source.lookup(ip) if source else None
+    if location:
+        ip_location_cache.put(ip, location)
+        return location
+    ip_location_cache.put(ip, "未知", ttl=IP_CACHE_FAIL_TTL)
     return "未知"
 
+def get_ip_location_nowait(ip):
+    """请求线程使用：只查缓存和离线库，查不到返回 None，由后台线程补查"""
+    if is_internal_ip(ip):
+        return "内网/本地"
+    cached = ip_location_cache.get(ip)
+    if cached is not None: return cached
+    source = get_ip_source()
+    if source is None: return "未知"
+    if not source.blocking:
+        return get_ip_location_info(ip)
+    return None
+
+class IPLocationResolver(BackgroundWorker):
+    """后台回填线程：按 IP 合并待查日志，查询后批量 UPDATE download_log"""
+    name = 'ip-resolver'
+
+    def __init__(self, maxsize=10000):
+        super().__init__()
+        self.queue = queue.Queue(maxsize=maxsize)
+
+    def _on_start(self):
+        self.queue = queue.Queue(maxsize=self.queue.maxsize)
+
+    def submit(self, log_id, ip):
+        self._ensure_started()
+        try:
+            self.queue.put_nowait((log_id, ip))
+        except queue.Full:
+            app.logger.warning(f"IP resolver queue full, drop {ip}")
+
+    def _run(self):
+        while True:
+            pending = {}
+            log_id, ip = self.queue.get()
+            pending.setdefault(ip, []).append(log_id)
+            while len(pending) < 100:
+                try:
+                    log_id, ip = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                pending.setdefault(ip, []).append(log_id)
+            for ip, ids in pending.items():
+                try:
+                    location = get_ip_location_info(ip)
+                    run_blocking(self._store, ids, location)
+                except Exception as e:
+                    app.logger.error(f"IP Resolve Error: {e}")
+
+    def _store(self, ids, location):
+        with app.app_context():
+            db.session.execute(
+                update(DownloadLog).where(DownloadLog.id.in_(ids)).values(ip_location=location)
+            )
+            db.session.commit()
+
+ip_resolver = IPLocationResolver()
+
 def get_device_info():
     ua = request.user_agent
     ua_str = request.headers.get('User-Agent', '').lower()
@@ -198,31 +987,184 @@ def get_device_info():
     device_type = "移动端" if is_mobile_device() else "PC端"
     return f"{platform} ({browser}) - {device_type}"
 
+# ================= 活动日志异步写入 =================
+# 请求线程只把事件放进内存队列，由后台线程攒批后一次事务写入。
+# 30 秒去重记录在 RUNTIME_DB_FILE，所有 worker 共用：同一客户端的 Range / 拖动进度条请求落到不同 worker 也只记一次。
+
+ACTIVITY_DEDUP_SECONDS = 30
+ACTIVITY_QUEUE_SIZE = 10000
+ACTIVITY_BATCH_SIZE = 200
+ACTIVITY_FLUSH_INTERVAL = 1.0
+
+class ActivityLogger(BackgroundWorker):
+    name = 'activity-logger'
+    _STOP = object()
+
+    def __init__(self, maxsize=ACTIVITY_QUEUE_SIZE, batch_size=ACTIVITY_BATCH_SIZE,
+                 flush_interval=ACTIVITY_FLUSH_INTERVAL, dedup_seconds=ACTIVITY_DEDUP_SECONDS, db_file=RUNTIME_DB_FILE):
+        super().__init__()
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dedup_seconds = dedup_seconds
+        self.db_file = db_file
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.dropped = 0
+        self._local = threading.local()
+        self._schema_ready = False
+        self._next_purge = 0
+        self._write_lock = threading.Lock()
+
+    def _on_start(self):
+        self.queue = queue.Queue(maxsize=self.maxsize)
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            if not self._schema_ready:
+                conn.execute('''
+                    CREATE TABLE IF NOT EXISTS activity_dedup (
+                        ip TEXT NOT NULL,
+                        filename TEXT NOT NULL,
+                        action TEXT NOT NULL,
+                        expire_at REAL NOT NULL,
+                        PRIMARY KEY (ip, filename, action)
+                    )
+                ''')
+                self._schema_ready = True
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _claim(self, key, now):
+        """窗口内没有相同事件时占住 key 并返回 True；插入和过期判断是同一条语句，多个 worker 同时到达也只有一个成功"""
+        conn = self._conn()
+        with conn:
+            claimed = conn.execute(
+                "INSERT INTO activity_dedup(ip, filename, action, expire_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ip, filename, action) DO UPDATE SET expire_at = excluded.expire_at "
+                "WHERE activity_dedup.expire_at <= ?", (*key, now + self.dedup_seconds, now)
+            ).rowcount == 1
+            if now >= self._next_purge:
+                self._next_purge = now + self.dedup_seconds
+                conn.execute("DELETE FROM activity_dedup WHERE expire_at <= ?", (now,))
+        return claimed
+
+    def _is_duplicate(self, key):
+        """(ip, filename, action) 在去重窗口内出现过则丢弃；去重表出错时照常记录"""
+        try:
+            return not run_blocking(self._claim, key, time.time())
+        except sqlite3.Error as e:
+            app.logger.error(f"Activity dedup error: {e}")
+            return False
+
+    def _forget(self, key):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM activity_dedup WHERE ip = ? AND filename = ? AND action = ?", key)
+        except sqlite3.Error as e:
+            app.logger.error(f"Activity dedup error: {e}")
+
+    def log(self, event):
+        self._ensure_started()
+        key = (event['ip_address'] or '', event['filename'] or '', event['action'] or '')
+        if self._is_duplicate(key):
+            return False
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except queue.Full:
+            # 没写进队列的事件不算数，之后相同的事件不应被去重掉
+            self._forget(key)
+            self.dropped += 1
+            metrics.inc('nexus_activity_dropped_total')
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                app.logger.warning(f"Activity queue full, dropped {self.dropped} events")
+            return False
+
+    def _drain(self, limit):
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return events
+
+    def _write(self, events):
+        if not events: return
+        with self._write_lock:
+            try:
+                for log_id, ip in run_blocking(self._commit, events):
+                    ip_resolver.submit(log_id, ip)
+            except Exception as e:
+                app.logger.error(f"Logging error: {e}")
+
+    def _commit(self, events):
+        """写入一批事件，返回需要后台补查归属地的 (日志 id, IP)"""
+        with app.app_context():
+            rows = [DownloadLog(**e) for e in events]
+            db.session.add_all(rows)
+            with metrics.timer('db_commit'):
+                increment_counters(count_events(events))
+                db.session.commit()
+            return [(row.id, row.ip_address) for row in rows if row.ip_location == IP_LOCATION_PENDING]
+
+    def flush(self):
+        """同步写出队列中剩余的全部事件"""
+        while True:
+            events = [e for e in self._drain(self.batch_size) if e is not self._STOP]
+            if not events: break
+            self._write(events)
+
+    def shutdown(self):
+        """进程退出钩子：通知后台线程写完手上的批次后退出，再写出队列剩余事件"""
+        if self._pid == os.getpid() and self._thread and self._thread.is_alive():
+            try:
+                self.queue.put(self._STOP, timeout=1)
+                self._thread.join(timeout=5)
+            except queue.Full:
+                pass
+        self.flush()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is self._STOP: break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0: break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+
+activity_logger = ActivityLogger()
+atexit.register(activity_logger.shutdown)
+
 def log_activity(filename, action):
     try:
         ip = get_real_ip()
-        cutoff_time = get_beijing_time() - timedelta(seconds=30)
-        recent_log = DownloadLog.query.filter(
-            DownloadLog.ip_address == ip,
-            DownloadLog.filename == filename,
-            DownloadLog.action == action,
-            DownloadLog.timestamp > cutoff_time
-        ).first()
-
-        if recent_log:
-            return
-
-        location = get_ip_location_info(ip)
-        device = get_device_info()
-        new_log = DownloadLog(
-            filename=filename,
-            ip_address=ip,
-            action=action,
-            ip_location=location,
-            device_type=device
-        )
-        db.session.add(new_log)
-        db.session.commit()
+        location = get_ip_location_nowait(ip)
+        activity_logger.log({
+            'filename': filename,
+            'ip_address': ip,
+            'action': action,
+            'ip_location': location or IP_LOCATION_PENDING,
+            'device_type': get_device_info(),
+            'timestamp': get_beijing_time(),
+        })
     except Exception as e:
         app.logger.error(f"Logging error: {e}")
 
@@ -238,15 +1180,25 @@ def get_file_type(filename):
     if ext in ['.mp4', '.mkv', '.avi', '.mov', '.webm']: return 'video'
     if ext in ['.mp3', '.wav', '.flac']: return 'audio'
     if ext in ['.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx']: return 'doc'
-    if ext in ['.txt', '.md', '.json', '.xml', '.py', '.js', '.html', '.css']: return 'code'
+    if ext in ['.txt', '.md', '.json', '.xml', '.py', '.js', '.html', '.css', '.log', '.csv', '.yaml', '.yml',
+               '.ini', '.conf', '.sh', '.sql']: return 'code'
     if ext in ['.zip', '.rar', '.7z', '.tar', '.gz']: return 'archive'
     return 'file'
 
 def get_disk_usage():
+    """存储池的总容量 (同一文件系统上的多个卷只算一次)，多卷时附带各卷明细"""
     try:
-        total, used, free = shutil.disk_usage(BASE_DIR)
-        return {'total': human_readable_size(total), 'used': human_readable_size(used),
-                'percent': round((used / total) * 100, 1)}
+        usage = storage_pool.usage()
+        devices = {u['device']: u for u in usage}
+        total = sum(u['total'] for u in devices.values())
+        used = sum(u['used'] for u in devices.values())
+        result = {'total': human_readable_size(total), 'used': human_readable_size(used),
+                  'percent': round((used / total) * 100, 1)}
+        if storage_pool.multi:
+            result['volumes'] = [{'name': u['volume'].name, 'root': u['volume'].root, 'weight': u['volume'].weight,
+                                  'total': human_readable_size(u['total']), 'used': human_readable_size(u['used']),
+                                  'free': human_readable_size(u['free']), 'percent': u['percent']} for u in usage]
+        return result
     except:
         return {'total': 'N/A', 'used': 'N/A', 'percent': 0}
 
@@ -271,88 +1223,2245 @@ def is_mobile_device():
     ]
     return any(keyword in ua for keyword in mobile_keywords)
 
-@app.context_processor
-def inject_global_vars():
-    return dict(is_admin=session.get('is_admin', False))
+# ================= 存储池 =================
+# 多个本地目录 (卷) 合成一个逻辑命名空间：BASE_DIR 是主卷，nexus.conf 的 volumes 追加其他卷，例如
+#   volumes=disk2:/mnt/disk2, disk3:/mnt/disk3:2      (名称:路径[:权重]，修改后需重启)
+# 同一个逻辑目录可以同时存在于多个卷上、各放一部分文件：列表、索引、搜索、打包都合并各卷的内容，
+# 同名条目以排在前面的卷为准。新文件按 剩余空间 × 权重 选卷，权重为 0 的卷不再放新文件 (用于腾空)。
+# 逻辑路径 -> 卷 的映射缓存在进程内 (LRU)，命中后仍会 lstat 确认，未命中或失效时按卷的顺序探测，
+# 其他 worker 或后台均衡搬走了文件也不会读错位置。只配置主卷时所有操作等同于直接拼接 BASE_DIR。
 
-@app.before_request
-def log_request_info():
-    if not request.path.startswith('/static'):
-        pass
+STORAGE_MAP_SIZE = 100000
+STORAGE_MIN_FREE = 1024 * 1024 * 1024   # 剩余空间低于此值的卷不再放新文件
 
-# ================= 接口部分 =================
+class Volume:
+    __slots__ = ('name', 'root', 'weight')
 
-# 修改：清空日志接口
-# 逻辑：在删除前，统计当前表的各项数据，累加到 SystemStat 表中
-@app.route('/admin/logs/clear', methods=['POST'])
-def clear_logs():
-    if not session.get('is_admin'): 
-        return jsonify({'error': '无权操作'}), 403
-    try:
-        # 1. 统计当前日志中的数据
-        current_downloads = DownloadLog.query.filter_by(action='down').count()
-        current_views = DownloadLog.query.filter_by(action='view').count()
-        current_logins = DownloadLog.query.filter(DownloadLog.action.in_(['login', 'user_login'])).count()
-        
-        # 2. 将数据累加到 SystemStat 表 (归档)
-        update_archived_stat('total_downloads', current_downloads)
-        update_archived_stat('total_views', current_views)
-        update_archived_stat('total_logins', current_logins)
-        
-        # 3. 清空日志表
-        db.session.query(DownloadLog).delete()
-        db.session.commit()
-        
-        return jsonify({'success': True})
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    def __init__(self, name, root, weight=1.0):
+        self.name, self.root, self.weight = name, root, weight
 
-@app.route('/admin/file/mkdir', methods=['POST'])
-def create_folder():
-    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
-    data = request.json
-    path = secure_path(data.get('path', ''))
-    name = data.get('name', '').strip()
-    if path is None: return jsonify({'error': '非法路径'}), 400
-    if not name or '..' in name or '/' in name or '\\' in name: 
-        return jsonify({'error': '文件夹名称非法'}), 400
-    full_path = os.path.join(BASE_DIR, path, name)
+    def path(self, rel_path):
+        return os.path.join(self.root, rel_path) if rel_path else self.root
+
+def parse_volumes(spec):
+    """'disk2:/mnt/disk2, disk3:/mnt/disk3:2' -> [Volume]；格式不对、重名或目录不存在的项跳过"""
+    volumes, names = [], {'main'}
+    for item in (spec or '').split(','):
+        parts = [p.strip() for p in item.split(':')]
+        if len(parts) < 2 or not parts[0] or not parts[1]: continue
+        name, root = parts[0], os.path.abspath(parts[1])
+        try:
+            weight = max(0.0, float(parts[2])) if len(parts) > 2 and parts[2] else 1.0
+        except ValueError:
+            weight = 1.0
+        if name in names: continue
+        # 挂载点不存在时不自动创建，否则数据会悄悄写到系统盘上
+        if not os.path.isdir(root):
+            app.logger.error(f"Storage volume {name} skipped: {root} is not a directory")
+            continue
+        names.add(name)
+        volumes.append(Volume(name, root, weight))
+    return volumes
+
+class StoragePool:
+    def __init__(self, volumes, map_size=STORAGE_MAP_SIZE):
+        self.volumes = volumes
+        self.primary = volumes[0]
+        self.multi = len(volumes) > 1
+        self.map_size = map_size
+        self._where = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _norm(rel_path):
+        return (rel_path or '').replace('\\', '/').strip('/')
+
+    # ---------- 路径解析 ----------
+
+    def remember(self, rel_path, volume):
+        rel_path = self._norm(rel_path)
+        with self._lock:
+            self._where[rel_path] = volume
+            self._where.move_to_end(rel_path)
+            while len(self._where) > self.map_size: self._where.popitem(last=False)
+
+    def forget(self, rel_path):
+        with self._lock:
+            self._where.pop(self._norm(rel_path), None)
+
+    def locate(self, rel_path):
+        """
+        逻辑路径 -> 物理路径。不存在时返回主卷上的路径，调用方照常用 os.path.exists 判断；
+        目录在多个卷上都有时返回第一个 (需要全部副本时用 copies)。
+        """
+        rel_path = self._norm(rel_path)
+        if not self.multi or not rel_path: return self.primary.path(rel_path)
+        volume = self._where.get(rel_path)
+        if volume is not None:
+            path = volume.path(rel_path)
+            if os.path.lexists(path): return path
+            self.forget(rel_path)
+        for volume in self.volumes:
+            path = volume.path(rel_path)
+            if os.path.lexists(path):
+                if volume is not self.primary: self.remember(rel_path, volume)
+                return path
+        return self.primary.path(rel_path)
+
+    def copies(self, rel_path):
+        """逻辑路径在各卷上实际存在的 [(卷, 物理路径)]"""
+        rel_path = self._norm(rel_path)
+        result = []
+        for volume in self.volumes:
+            path = volume.path(rel_path)
+            if os.path.lexists(path): result.append((volume, path))
+        return result
+
+    def exists(self, rel_path):
+        return os.path.exists(self.locate(rel_path))
+
+    def isdir(self, rel_path):
+        if not self.multi: return os.path.isdir(self.primary.path(self._norm(rel_path)))
+        return any(os.path.isdir(path) for _, path in self.copies(rel_path))
+
+    def volume_of(self, full_path):
+        """物理路径所在的卷，不在任何卷下时返回 None"""
+        full_path = os.path.abspath(full_path)
+        for volume in self.volumes:
+            rel = os.path.relpath(full_path, volume.root)
+            if rel != '..' and not rel.startswith('..' + os.sep): return volume
+        return None
+
+    def logical(self, full_path):
+        """物理路径 -> 逻辑路径 ('' 为根目录)，不在任何卷下时返回 None"""
+        volume = self.volume_of(full_path)
+        if volume is None: return None
+        rel = os.path.relpath(os.path.abspath(full_path), volume.root).replace('\\', '/')
+        return '' if rel == '.' else rel
+
+    # ---------- 目录 ----------
+
+    def scandir(self, rel_dir):
+        """合并各卷上同一目录的条目 (os.DirEntry)，同名时前面的卷优先；目录不存在或无权限的卷跳过"""
+        rel_dir = self._norm(rel_dir)
+        seen = set() if self.multi else None
+        for volume in self.volumes:
+            try:
+                with os.scandir(volume.path(rel_dir)) as it:
+                    for entry in it:
+                        if seen is not None:
+                            if entry.name in seen: continue
+                            seen.add(entry.name)
+                        yield entry
+            except (PermissionError, FileNotFoundError, NotADirectoryError):
+                continue
+
+    def dir_version(self, rel_dir):
+        """各卷上该目录 mtime 组成的元组，任何一个卷上增删条目都会变化；目录不存在时抛 FileNotFoundError"""
+        rel_dir = self._norm(rel_dir)
+        if not self.multi: return (os.stat(self.primary.path(rel_dir)).st_mtime_ns,)
+        versions = []
+        for volume in self.volumes:
+            try:
+                versions.append(os.stat(volume.path(rel_dir)).st_mtime_ns)
+            except (FileNotFoundError, NotADirectoryError):
+                versions.append(None)
+        if not any(v is not None for v in versions): raise FileNotFoundError(rel_dir)
+        return tuple(versions)
+
+    def walk(self, rel_root):
+        """
+        按逻辑路径遍历子树 (合并各卷)，产出 (rel_dir, 子目录 DirEntry 列表, 文件 DirEntry 列表)，
+        跳过隐藏条目；和 os.walk 一样不进入符号链接的目录，可以在遍历时修改子目录列表来剪枝。
+        """
+        stack = [self._norm(rel_root)]
+        while stack:
+            rel_dir = stack.pop()
+            dirs, files = [], []
+            for entry in self.scandir(rel_dir):
+                if entry.name.startswith('.'): continue
+                try:
+                    (dirs if entry.is_dir() else files).append(entry)
+                except OSError:
+                    continue
+            yield rel_dir, dirs, files
+            stack.extend(f"{rel_dir}/{d.name}" if rel_dir else d.name for d in reversed(dirs) if not d.is_symlink())
+
+    # ---------- 容量与选卷 ----------
+
+    def usage(self):
+        """各卷容量 [{'volume', 'device', 'total', 'used', 'free', 'percent'}]，读取失败的卷跳过"""
+        result = []
+        for volume in self.volumes:
+            try:
+                total, used, free = shutil.disk_usage(volume.root)
+                device = os.stat(volume.root).st_dev
+            except OSError:
+                continue
+            result.append({'volume': volume, 'device': device, 'total': total, 'used': used, 'free': free,
+                           'percent': round(used * 100 / total, 1) if total else 0})
+        return result
+
+    def choose(self, size=0):
+        """按 剩余空间 × 权重 选一个放新文件的卷；都放不下时退回主卷，由写入时报磁盘空间不足"""
+        if not self.multi: return self.primary
+        best, best_score = None, 0
+        for u in self.usage():
+            volume = u['volume']
+            if volume.weight <= 0 or u['free'] - (size or 0) < STORAGE_MIN_FREE: continue
+            score = u['free'] * volume.weight
+            if score > best_score: best, best_score = volume, score
+        return best or self.primary
+
+    def place(self, rel_dir, size=0):
+        """为 rel_dir 下的新文件选卷，确保该卷上有这个目录，返回物理目录 (调用方需先确认逻辑目录存在)"""
+        rel_dir = self._norm(rel_dir)
+        volume = self.choose(size)
+        path = volume.path(rel_dir)
+        if volume is not self.primary: os.makedirs(path, exist_ok=True)
+        return path
+
+storage_pool = StoragePool([Volume('main', os.path.abspath(BASE_DIR))] + parse_volumes(get_config().get('volumes')))
+
+# ---------- 后台均衡 ----------
+# nexus.conf 中 rebalance=on 开启。有权重的卷之间使用率相差超过 rebalance_threshold 个百分点 (默认 10) 时，
+# 把最满的卷上最久没有修改的文件 (至少 rebalance_min_age 天，默认 30) 搬到最空的卷，
+# 每轮最多 rebalance_batch (默认 10G)。权重为 0 的卷只搬出不搬入。
+# 搬运时先复制到目标卷的隐藏临时文件，确认源文件在复制期间没有变化再 rename 到位并删除源文件，逻辑路径不变；
+# 复制期间源文件被删除/重命名则撤销。去重存储的硬链接文件不搬 (跨卷后无法再共享 blob)。
+
+REBALANCE_INTERVAL = 3600
+REBALANCE_CANDIDATES = 2000
+REBALANCE_STAMP_FILE = os.path.join(DATA_DIR, 'rebalance.stamp')
+
+class StorageRebalancer(BackgroundWorker):
+    name = 'storage-rebalance'
+
+    def __init__(self, pool, interval=REBALANCE_INTERVAL):
+        super().__init__()
+        self.pool = pool
+        self.interval = interval
+
+    @staticmethod
+    def settings():
+        config = get_config()
+        return {
+            'enabled': config.get('rebalance', 'off').strip().lower() in ('on', 'true', '1', 'yes'),
+            'threshold': _config_number(config, 'rebalance_threshold', 10.0, float),
+            'min_age': _config_number(config, 'rebalance_min_age', 30.0, float) * 86400,
+            'batch': parse_byte_size(config.get('rebalance_batch'), 10 * 1024 ** 3),
+        }
+
+    def plan(self, threshold):
+        """返回 (源卷, 目标卷, 计划搬运的字节数)，不需要均衡时返回 None"""
+        usage = self.pool.usage()
+        targets = [u for u in usage if u['volume'].weight > 0]
+        if len(usage) < 2 or not targets: return None
+        source = max(usage, key=lambda u: u['percent'])
+        target = min(targets, key=lambda u: u['percent'])
+        if source['volume'] is target['volume'] or source['device'] == target['device']: return None
+        gap = source['percent'] - target['percent']
+        if gap < threshold: return None
+        # 搬到两边大致持平为止，并给目标卷留出最低剩余空间
+        goal = int(gap / 200 * min(source['total'], target['total']))
+        return source['volume'], target['volume'], min(goal, max(0, target['free'] - STORAGE_MIN_FREE))
+
+    def cold_files(self, volume, min_age, limit=REBALANCE_CANDIDATES):
+        """源卷上修改时间最早的 limit 个文件 [(物理路径, 大小)]，跳过隐藏文件、硬链接和最近修改过的文件"""
+        cutoff = time.time() - min_age
+        heap = []  # (-mtime, path, size)，堆顶是已选中的文件里最新的一个
+        stack = [volume.root]
+        while stack:
+            cooperate()
+            try:
+                with os.scandir(stack.pop()) as it:
+                    for entry in it:
+                        if entry.name.startswith('.'): continue
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                stack.append(entry.path)
+                                continue
+                            if not entry.is_file(follow_symlinks=False): continue
+                            st = entry.stat(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if st.st_nlink > 1 or max(st.st_mtime, st.st_atime) > cutoff: continue
+                        item = (-max(st.st_mtime, st.st_atime), entry.path, st.st_size)
+                        if len(heap) < limit: heapq.heappush(heap, item)
+                        elif item > heap[0]: heapq.heapreplace(heap, item)
+            except (PermissionError, FileNotFoundError, NotADirectoryError):
+                continue
+        return [(path, size) for _, path, size in sorted(heap, reverse=True)]
+
+    def move(self, source, target, full_path):
+        """把单个文件从 source 卷搬到 target 卷的同一逻辑路径，返回搬运的字节数 (跳过时为 0)"""
+        rel_path = os.path.relpath(full_path, source.root).replace('\\', '/')
+        dest = target.path(rel_path)
+        st = os.stat(full_path)
+        if os.path.lexists(dest) or st.st_nlink > 1: return 0
+        dest_dir = os.path.dirname(dest)
+        os.makedirs(dest_dir, exist_ok=True)
+        tmp_path = os.path.join(dest_dir, f".{secrets.token_hex(8)}.rebalance")
+        try:
+            with open(full_path, 'rb') as fsrc, open(tmp_path, 'xb') as fdst:
+                for block in iter(lambda: fsrc.read(UPLOAD_IO_BLOCK), b''):
+                    fdst.write(block)
+                os.fsync(fdst.fileno())
+            shutil.copystat(full_path, tmp_path)
+            after = os.stat(full_path)
+            if (after.st_mtime_ns, after.st_size, after.st_nlink) != (st.st_mtime_ns, st.st_size, 1): return 0
+            if os.path.lexists(dest): return 0
+            os.replace(tmp_path, dest)
+            try:
+                os.remove(full_path)
+            except FileNotFoundError:
+                # 复制期间源文件被删除或重命名：撤销，避免旧路径上凭空多出一份
+                os.remove(dest)
+                return 0
+        finally:
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+        self.pool.remember(rel_path, target)
+        return st.st_size
+
+    def rebalance(self, settings):
+        plan = self.plan(settings['threshold'])
+        if not plan: return 0
+        source, target, goal = plan
+        goal = min(goal, settings['batch'])
+        moved_total = moved_files = 0
+        for full_path, size in self.cold_files(source, settings['min_age']):
+            if moved_total >= goal: break
+            try:
+                moved = run_blocking(self.move, source, target, full_path)
+            except OSError as e:
+                app.logger.warning(f"Rebalance skip {full_path}: {e}")
+                continue
+            if not moved: continue
+            moved_total += moved
+            moved_files += 1
+            metrics.inc('nexus_rebalanced_bytes_total', moved, source=source.name, target=target.name)
+        if moved_files:
+            app.logger.info(f"Rebalanced {moved_files} files ({human_readable_size(moved_total)}) "
+                            f"from {source.name} to {target.name}")
+        return moved_total
+
+    def _due(self):
+        try:
+            return time.time() - os.path.getmtime(REBALANCE_STAMP_FILE) >= self.interval
+        except OSError:
+            return True
+
+    def _run(self):
+        while True:
+            time.sleep(min(self.interval, 60) if self._due() else self.interval)
+            try:
+                settings = self.settings()
+                if not settings['enabled']: continue
+                # 多个 worker 各有一个线程，只让拿到锁且到期的那个执行
+                with file_lock('rebalance', blocking=False) as locked:
+                    if locked and self._due():
+                        with open(REBALANCE_STAMP_FILE, 'w') as f: f.write(str(time.time()))
+                        self.rebalance(settings)
+            except Exception as e:
+                app.logger.error(f"Rebalance error: {e}")
+
+    def start(self):
+        if self.pool.multi: self._ensure_started()
+
+storage_rebalancer = StorageRebalancer(storage_pool)
+storage_rebalancer.start()
+
+# ================= 文件名索引 =================
+# 存储池中所有文件/文件夹的逻辑路径索引 (DATA_DIR/index.db)，供 /api/search 使用。
+# 启动时全量构建一次，之后由上传/新建/重命名/删除接口增量维护，后台定期对账捕获外部改动。
+# 同一个库里还维护各文件夹的递归大小/文件数 (folder_usage) 和按类型汇总 (type_usage)：
+# 增量操作只把子树前后的差值沿祖先链向上累加，对账时再由 entries 整体重算纠偏。
+
+INDEX_DB_FILE = os.path.join(DATA_DIR, 'index.db')
+INDEX_RECONCILE_INTERVAL = 600
+INDEX_BATCH_SIZE = 5000
+SEARCH_DEFAULT_LIMIT = 30
+SEARCH_MAX_LIMIT = 500
+STORAGE_TOP_FOLDERS = 10
+
+def _range_end(prefix):
+    """`path >= prefix/ AND path < prefix0` 可以走主键索引取出整棵子树 ('0' 紧跟在 '/' 之后)"""
+    return prefix + '0'
+
+def _ancestors(rel_path):
+    """'a/b/c' -> ['a/b', 'a', '']，'' 代表 BASE_DIR 本身"""
+    result = []
+    while rel_path:
+        rel_path = rel_path.rpartition('/')[0]
+        result.append(rel_path)
+    return result
+
+class FileIndex(BackgroundWorker):
+    name = 'file-index'
+
+    def __init__(self, db_file=INDEX_DB_FILE, pool=storage_pool, interval=INDEX_RECONCILE_INTERVAL):
+        super().__init__()
+        self.db_file = db_file
+        self.pool = pool
+        self.interval = interval
+        self.fts = False
+        self._local = threading.local()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def init_schema(self):
+        conn = self._conn()
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                parent TEXT NOT NULL,
+                name TEXT NOT NULL,
+                type TEXT NOT NULL,
+                is_dir INTEGER NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                mtime REAL NOT NULL DEFAULT 0,
+                seen REAL NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_entries_parent ON entries(parent);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS folder_usage (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL DEFAULT 0,
+                files INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS idx_folder_usage_size ON folder_usage(size);
+            CREATE TABLE IF NOT EXISTS type_usage (
+                type TEXT PRIMARY KEY,
+                size INTEGER NOT NULL DEFAULT 0,
+                files INTEGER NOT NULL DEFAULT 0
+            );
+        ''')
+        try:
+            conn.executescript('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts USING fts5(
+                    name, content='entries', content_rowid='id', tokenize='trigram');
+                CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+                    INSERT INTO entries_fts(rowid, name) VALUES (new.id, new.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+                    INSERT INTO entries_fts(entries_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                END;
+                CREATE TRIGGER IF NOT EXISTS entries_au AFTER UPDATE OF name ON entries BEGIN
+                    INSERT INTO entries_fts(entries_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO entries_fts(rowid, name) VALUES (new.id, new.name);
+                END;
+            ''')
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite < 3.34 没有 trigram 分词器，退化为 LIKE 扫描
+            app.logger.warning(f"FTS5 trigram unavailable, search falls back to LIKE: {e}")
+            self.fts = False
+
+    def get_meta(self, key):
+        row = self._conn().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row['value'] if row else None
+
+    def set_meta(self, key, value):
+        self._conn().execute("INSERT OR REPLACE INTO meta(key, value) VALUES (?, ?)", (key, str(value)))
+
+    @property
+    def ready(self):
+        try:
+            return self.get_meta('built_at') is not None
+        except sqlite3.Error:
+            return False
+
+    @property
+    def usage_ready(self):
+        try:
+            return self.get_meta('usage_at') is not None
+        except sqlite3.Error:
+            return False
+
+    # ---------- 增量维护 (由文件操作接口调用) ----------
+
+    def _row_for(self, rel_path, st, is_dir, seen):
+        rel_path = rel_path.replace('\\', '/').strip('/')
+        parent, name = os.path.split(rel_path)
+        return (rel_path, parent, name, 'folder' if is_dir else get_file_type(name),
+                1 if is_dir else 0, 0 if is_dir else st.st_size, st.st_mtime, seen)
+
+    def _upsert(self, conn, rows):
+        conn.executemany('''
+            INSERT INTO entries(path, parent, name, type, is_dir, size, mtime, seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(path) DO UPDATE SET
+                type = excluded.type, is_dir = excluded.is_dir, size = excluded.size,
+                mtime = excluded.mtime, seen = excluded.seen
+        ''', rows)
+
+    def add(self, rel_path):
+        """新增/更新单个路径 (文件夹会连同其子树一起收录)"""
+        rel_path = rel_path.replace('\\', '/').strip('/')
+        full_path = self.pool.locate(rel_path)
+        try:
+            st = os.stat(full_path)
+            is_dir = os.path.isdir(full_path)
+            conn = self._conn()
+            with conn:
+                before = self._subtree_usage(conn, rel_path)
+                self._upsert(conn, [self._row_for(rel_path, st, is_dir, time.time())])
+            if is_dir:
+                self._scan(rel_path)
+            with conn:
+                self._apply_usage(conn, rel_path, before, self._subtree_usage(conn, rel_path))
+                if is_dir: self._rebuild_folder_usage(conn, rel_path)
+        except Exception as e:
+            app.logger.error(f"Index add error: {e}")
+
+    def remove(self, rel_path):
+        rel_path = rel_path.replace('\\', '/').strip('/')
+        try:
+            conn = self._conn()
+            with conn:
+                before = self._subtree_usage(conn, rel_path)
+                conn.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+                             (rel_path, rel_path + '/', _range_end(rel_path)))
+                conn.execute("DELETE FROM folder_usage WHERE path = ? OR (path >= ? AND path < ?)",
+                             (rel_path, rel_path + '/', _range_end(rel_path)))
+                self._apply_usage(conn, rel_path, before, {})
+        except Exception as e:
+            app.logger.error(f"Index remove error: {e}")
+
+    def move(self, old_rel, new_rel):
+        old_rel = old_rel.replace('\\', '/').strip('/')
+        new_rel = new_rel.replace('\\', '/').strip('/')
+        parent, name = os.path.split(new_rel)
+        try:
+            conn = self._conn()
+            with conn:
+                moved = self._subtree_usage(conn, old_rel)
+                replaced = self._subtree_usage(conn, new_rel)
+                conn.execute("DELETE FROM entries WHERE path = ? OR (path >= ? AND path < ?)",
+                             (new_rel, new_rel + '/', _range_end(new_rel)))
+                conn.execute("UPDATE entries SET path = ?, parent = ?, name = ?, type = CASE WHEN is_dir THEN 'folder' ELSE ? END WHERE path = ?",
+                             (new_rel, parent, name, get_file_type(name), old_rel))
+                n = len(old_rel)
+                conn.execute('''
+                    UPDATE entries SET path = ? || substr(path, ?), parent = ? || substr(parent, ?)
+                    WHERE path >= ? AND path < ?
+                ''', (new_rel, n + 1, new_rel, n + 1, old_rel + '/', _range_end(old_rel)))
+                # 子树整体搬家：旧祖先减去、新祖先加上 (改扩展名可能改变类型，按移动后的实际类型计)
+                conn.execute("DELETE FROM folder_usage WHERE path = ? OR (path >= ? AND path < ?)",
+                             (new_rel, new_rel + '/', _range_end(new_rel)))
+                conn.execute("UPDATE folder_usage SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)",
+                             (new_rel, n + 1, old_rel, old_rel + '/', _range_end(old_rel)))
+                self._apply_usage(conn, old_rel, moved, {})
+                self._apply_usage(conn, new_rel, replaced, self._subtree_usage(conn, new_rel))
+        except Exception as e:
+            app.logger.error(f"Index move error: {e}")
+
+    # ---------- 容量统计 ----------
+
+    def _subtree_usage(self, conn, rel_path):
+        """rel_path 本身及子树内的文件按类型汇总: {type: (size, files)}"""
+        rows = conn.execute('''
+            SELECT type, SUM(size) AS size, COUNT(*) AS files FROM entries
+            WHERE is_dir = 0 AND (path = ? OR (path >= ? AND path < ?)) GROUP BY type
+        ''', (rel_path, rel_path + '/', _range_end(rel_path))).fetchall()
+        return {row['type']: (row['size'], row['files']) for row in rows}
+
+    @staticmethod
+    def _add_usage(conn, table, column, rows):
+        conn.executemany(f'''
+            INSERT INTO {table}({column}, size, files) VALUES (?, ?, ?)
+            ON CONFLICT({column}) DO UPDATE SET size = size + excluded.size, files = files + excluded.files
+        ''', rows)
+
+    def _apply_usage(self, conn, rel_path, before, after):
+        """把 rel_path 子树前后的差值累加到类型汇总和 rel_path 的各级祖先上"""
+        deltas = []
+        for ftype in set(before) | set(after):
+            old_size, old_files = before.get(ftype, (0, 0))
+            new_size, new_files = after.get(ftype, (0, 0))
+            if new_size != old_size or new_files != old_files:
+                deltas.append((ftype, new_size - old_size, new_files - old_files))
+        if not deltas: return
+        self._add_usage(conn, 'type_usage', 'type', deltas)
+        size = sum(d[1] for d in deltas)
+        files = sum(d[2] for d in deltas)
+        self._add_usage(conn, 'folder_usage', 'path', [(p, size, files) for p in _ancestors(rel_path)])
+
+    def _rebuild_folder_usage(self, conn, rel_root=''):
+        """由 entries 重算 rel_root 子树内各文件夹的递归大小 (rel_root 为空时重算全部)"""
+        if rel_root:
+            scope, params = "(parent = ? OR (parent >= ? AND parent < ?))", (rel_root, rel_root + '/', _range_end(rel_root))
+            dir_scope, dir_params = "(path >= ? AND path < ?)", (rel_root + '/', _range_end(rel_root))
+        else:
+            scope, params, dir_scope, dir_params = "1", (), "1", ()
+        totals = {rel_root: [0, 0]}
+        for row in conn.execute(f"SELECT path FROM entries WHERE is_dir = 1 AND {dir_scope}", dir_params):
+            totals[row['path']] = [0, 0]
+        for row in conn.execute(f"SELECT parent, SUM(size) AS size, COUNT(*) AS files FROM entries WHERE is_dir = 0 AND {scope} GROUP BY parent", params):
+            path = row['parent']
+            while True:
+                total = totals.setdefault(path, [0, 0])
+                total[0] += row['size']
+                total[1] += row['files']
+                if path == rel_root: break
+                path = path.rpartition('/')[0]
+        if rel_root:
+            conn.execute("DELETE FROM folder_usage WHERE path = ? OR (path >= ? AND path < ?)",
+                         (rel_root, rel_root + '/', _range_end(rel_root)))
+        else:
+            conn.execute("DELETE FROM folder_usage")
+        conn.executemany("INSERT INTO folder_usage(path, size, files) VALUES (?, ?, ?)",
+                         [(path, t[0], t[1]) for path, t in totals.items()])
+
+    def rebuild_usage(self, conn):
+        self._rebuild_folder_usage(conn)
+        conn.execute("DELETE FROM type_usage")
+        conn.execute("INSERT INTO type_usage(type, size, files) SELECT type, SUM(size), COUNT(*) FROM entries WHERE is_dir = 0 GROUP BY type")
+
+    # ---------- 全量构建 / 对账 ----------
+
+    def _scan(self, rel_root=''):
+        """扫描 rel_root 子树并 upsert，返回扫描开始时间 (早于它且未被看到的记录即为已删除)"""
+        started = time.time()
+        conn = self._conn()
+        rows = []
+        stack = [rel_root]
+        while stack:
+            rel_dir = stack.pop()
+            cooperate()
+            for entry in self.pool.scandir(rel_dir):
+                if entry.name.startswith('.'): continue
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+                rows.append(self._row_for(rel_path, st, is_dir, started))
+                if is_dir: stack.append(rel_path)
+                if len(rows) >= INDEX_BATCH_SIZE:
+                    with conn: self._upsert(conn, rows)
+                    rows = []
+        if rows:
+            with conn: self._upsert(conn, rows)
+        return started
+
+    def reconcile(self):
+        started_at = time.time()
+        scan_started = self._scan()
+        conn = self._conn()
+        with conn:
+            removed = conn.execute("DELETE FROM entries WHERE seen < ?", (scan_started,)).rowcount
+            # 与删除过期记录在同一个写事务里重算，期间其他进程的增量更新会排队等待
+            self.rebuild_usage(conn)
+            if self.get_meta('built_at') is None: self.set_meta('built_at', time.time())
+            self.set_meta('usage_at', time.time())
+            self.set_meta('reconciled_at', time.time())
+        app.logger.info(f"File index reconciled in {time.time() - started_at:.1f}s, removed {removed} stale entries")
+
+    def _run(self):
+        while True:
+            try:
+                with file_lock('index', blocking=False) as locked:
+                    if locked:
+                        last = float(self.get_meta('reconciled_at') or 0)
+                        # 旧版本建好的索引还没有容量统计，立即补一次全量对账
+                        if time.time() - last >= self.interval or not self.usage_ready:
+                            self.reconcile()
+            except Exception as e:
+                app.logger.error(f"Index reconcile error: {e}")
+            time.sleep(self.interval if self.ready else 5)
+
+    def start(self):
+        try:
+            self.init_schema()
+        except Exception as e:
+            app.logger.error(f"Index init error: {e}")
+            return
+        self._ensure_started()
+
+    # ---------- 查询 ----------
+
+    def search(self, query, types=None, limit=SEARCH_DEFAULT_LIMIT):
+        """子串/前缀匹配，排序：完全匹配 > 前缀匹配 > 子串匹配，同级按名称长度"""
+        query = query.lower()
+        params = []
+        if self.fts and len(query) >= 3:
+            sql = "SELECT e.* FROM entries_fts f JOIN entries e ON e.id = f.rowid WHERE entries_fts MATCH ?"
+            params.append('"' + query.replace('"', '""') + '"')
+        else:
+            escaped = query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            sql = "SELECT e.* FROM entries e WHERE e.name LIKE ? ESCAPE '\\'"
+            params.append(f"%{escaped}%")
+        if types:
+            sql += f" AND e.type IN ({','.join('?' * len(types))})"
+            params.extend(types)
+        sql += '''
+            ORDER BY (lower(e.name) = ?) DESC, (substr(lower(e.name), 1, ?) = ?) DESC,
+                     length(e.name), e.name
+            LIMIT ?
+        '''
+        params.extend([query, len(query), query, limit])
+        return self._conn().execute(sql, params).fetchall()
+
+    def folder_usage(self, paths):
+        """批量查询文件夹递归大小: {path: (size, files)}"""
+        result = {}
+        paths = list(paths)
+        conn = self._conn()
+        for i in range(0, len(paths), 500):
+            chunk = paths[i:i + 500]
+            rows = conn.execute(f"SELECT path, size, files FROM folder_usage WHERE path IN ({','.join('?' * len(chunk))})", chunk)
+            for row in rows: result[row['path']] = (row['size'], row['files'])
+        return result
+
+    def top_folders(self, limit=STORAGE_TOP_FOLDERS):
+        return self._conn().execute(
+            "SELECT path, size, files FROM folder_usage WHERE path != '' ORDER BY size DESC LIMIT ?", (limit,)).fetchall()
+
+    def type_breakdown(self):
+        return self._conn().execute("SELECT type, size, files FROM type_usage WHERE files > 0 ORDER BY size DESC").fetchall()
+
+file_index = FileIndex()
+file_index.start()
+
+FILE_TYPE_LABELS = {'image': '图片', 'video': '视频', 'audio': '音频', 'doc': '文档',
+                    'code': '代码/文本', 'archive': '压缩包', 'file': '其他'}
+
+def get_storage_usage(limit=STORAGE_TOP_FOLDERS):
+    """后台的容量分布：最大的若干文件夹 + 按类型汇总，全部来自 folder_usage/type_usage"""
+    if not file_index.usage_ready: return None
+    try:
+        total = file_index.folder_usage(['']).get('', (0, 0))
+        folders = file_index.top_folders(limit)
+        types = file_index.type_breakdown()
+    except sqlite3.Error as e:
+        app.logger.error(f"Storage usage query error: {e}")
+        return None
+    total_size = total[0] or 1
+    dedup = None
+    if blob_store.enabled:
+        try:
+            dedup = blob_store.stats()
+            dedup['saved'] = human_readable_size(dedup['saved'])
+        except sqlite3.Error:
+            pass
+    return {
+        'size': human_readable_size(total[0]), 'files': total[1], 'dedup': dedup,
+        'folders': [{'path': r['path'], 'size': human_readable_size(r['size']), 'files': r['files'],
+                     'percent': round(r['size'] * 100 / total_size, 1)} for r in folders],
+        'types': [{'type': r['type'], 'label': FILE_TYPE_LABELS.get(r['type'], r['type']),
+                   'size': human_readable_size(r['size']), 'files': r['files'],
+                   'percent': round(r['size'] * 100 / total_size, 1)} for r in types],
+    }
+
+# ================= 目录列表 =================
+# 列表按页返回：一次 scandir (多卷时合并各卷) 流式过滤，用 heapq 只保留当前页所需的条目，
+# 游标记录上一页最后一条的排序键 (keyset 分页)，大目录也不必整体排序/stat。
+# 统计数据、README 和默认排序的第一页放入缓存，按 (各卷上的目录 mtime, README mtime) 校验，
+# LRU 淘汰并限制总内存；管理员的文件操作会主动失效相关目录。
+
+LISTING_PAGE_SIZE = 200
+LISTING_MAX_PAGE_SIZE = 1000
+LISTING_SORTS = ('name', 'size', 'mtime', 'type')
+LISTING_CACHE_MAX_ENTRIES = 512
+LISTING_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+def _listing_item(req_path, entry, is_dir):
+    stat = entry.stat()
+    return {
+        'name': entry.name, 'type': 'folder' if is_dir else get_file_type(entry.name), 'is_dir': is_dir,
+        'size': human_readable_size(stat.st_size) if not is_dir else '-',
+        'mtime': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M'),
+        'rel_path': os.path.join(req_path, entry.name).replace('\\', '/').strip('/'),
+        'bytes': stat.st_size if not is_dir else None,
+        'timestamp': int(stat.st_mtime),
+        'version': int(stat.st_mtime),
+        'thumb': not is_dir and thumbnail_supported(entry.name)
+    }
+
+def _listing_key(entry, is_dir, sort, descending):
+    """排序键：文件夹始终在前，同一组内按 sort 排序，最后以名称兜底保证唯一"""
+    if sort == 'size': primary = 0 if is_dir else entry.stat().st_size
+    elif sort == 'mtime': primary = entry.stat().st_mtime
+    elif sort == 'type': primary = 'folder' if is_dir else get_file_type(entry.name)
+    else: primary = ''
+    # 降序时取最大的若干项，组标记也要反过来才能让文件夹留在前面
+    group = (1 if is_dir else 0) if descending else (0 if is_dir else 1)
+    return (group, primary, entry.name.lower(), entry.name)
+
+def encode_cursor(sort, order, key):
+    raw = json.dumps({'s': sort, 'o': order, 'k': list(key)}, ensure_ascii=False, separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, sort, order):
+    """解析游标，格式不对或与当前排序不一致时抛 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw.decode('utf-8'))
+        key = data['k']
+    except Exception:
+        raise ValueError('invalid cursor')
+    if data.get('s') != sort or data.get('o') != order or not isinstance(key, list) or len(key) != 4:
+        raise ValueError('cursor does not match sort order')
+    return tuple(key)
+
+def list_directory(req_path, sort='name', order='asc', types=None, cursor=None, limit=LISTING_PAGE_SIZE):
+    """返回一页条目和下一页游标；只有排序需要时才对全部条目 stat"""
+    descending = order == 'desc'
+    after = decode_cursor(cursor, sort, order) if cursor else None
+
+    def candidates():
+        for entry in storage_pool.scandir(req_path):
+            if entry.name.startswith('.'): continue
+            try:
+                is_dir = entry.is_dir()
+                if types and ('folder' if is_dir else get_file_type(entry.name)) not in types: continue
+                key = _listing_key(entry, is_dir, sort, descending)
+            except OSError:
+                continue
+            if after is not None:
+                try:
+                    if (key >= after) if descending else (key <= after): continue
+                except TypeError:
+                    continue
+            yield key, entry, is_dir
+
+    pick = heapq.nlargest if descending else heapq.nsmallest
+    with metrics.timer('dir_list'):
+        page = pick(limit + 1, candidates(), key=lambda c: c[0])
+    next_cursor = None
+    if len(page) > limit:
+        page = page[:limit]
+        next_cursor = encode_cursor(sort, order, page[-1][0])
+    items = []
+    for key, entry, is_dir in page:
+        try:
+            items.append(_listing_item(req_path, entry, is_dir))
+        except OSError:
+            continue
+    return items, next_cursor
+
+def summarize_directory(req_path):
+    """统计各类型数量并渲染 README，不对条目 stat，返回 (stats, readme_html, readme_name)"""
+    readme_content = None
+    readme_name = None
+    stats = {'total': 0, 'image': 0, 'video': 0, 'doc': 0}
+    with metrics.timer('dir_summary'):
+        for entry in storage_pool.scandir(req_path):
+            if entry.name.startswith('.'): continue
+            if entry.name.lower() == 'readme.md':
+                readme_name = entry.name
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f, metrics.timer('markdown'):
+                        readme_content = markdown.markdown(f.read(), extensions=['fenced_code', 'tables'])
+                except: pass
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            ftype = 'folder' if is_dir else get_file_type(entry.name)
+            stats['total'] += 1
+            if ftype in stats: stats[ftype] += 1
+    return stats, readme_content, readme_name
+
+class ListingCache:
+    def __init__(self, max_entries=LISTING_CACHE_MAX_ENTRIES, max_bytes=LISTING_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _estimate_size(items, readme):
+        # 粗略估算：每个条目的 dict 开销 + 字符串长度
+        size = 512 + (len(readme) * 2 if readme else 0)
+        for item in items:
+            size += 400 + 2 * (len(item['name']) + len(item['rel_path']))
+        return size
+
+    @staticmethod
+    def _version(req_path, readme_name):
+        dir_mtime = storage_pool.dir_version(req_path)
+        readme_mtime = None
+        if readme_name:
+            try:
+                readme_mtime = os.stat(storage_pool.locate(os.path.join(req_path, readme_name))).st_mtime_ns
+            except OSError:
+                pass
+        return dir_mtime, readme_mtime
+
+    def get(self, req_path):
+        with self._lock:
+            entry = self._data.get(req_path)
+        if entry is None: return None
+        try:
+            version = self._version(req_path, entry['readme_name'])
+        except OSError:
+            self.invalidate(req_path)
+            return None
+        if version != entry['version']:
+            self.invalidate(req_path)
+            return None
+        with self._lock:
+            if req_path in self._data: self._data.move_to_end(req_path)
+        return entry
+
+    def put(self, req_path, items, next_cursor, stats, readme, readme_name, version):
+        size = self._estimate_size(items, readme)
+        if size > self.max_bytes // 4: return
+        entry = {'items': items, 'next_cursor': next_cursor, 'stats': stats, 'readme': readme,
+                 'readme_name': readme_name, 'version': version, 'size': size}
+        with self._lock:
+            old = self._data.pop(req_path, None)
+            if old: self.total_bytes -= old['size']
+            self._data[req_path] = entry
+            self.total_bytes += size
+            while self._data and (len(self._data) > self.max_entries or self.total_bytes > self.max_bytes):
+                _, evicted = self._data.popitem(last=False)
+                self.total_bytes -= evicted['size']
+
+    def invalidate(self, req_path, recursive=False):
+        req_path = (req_path or '').replace('\\', '/').strip('/')
+        with self._lock:
+            keys = [req_path]
+            if recursive:
+                prefix = req_path + '/' if req_path else ''
+                keys += [k for k in self._data if k.startswith(prefix)]
+            for key in keys:
+                entry = self._data.pop(key, None)
+                if entry: self.total_bytes -= entry['size']
+
+listing_cache = ListingCache()
+
+def get_listing(req_path):
+    """带缓存的目录首页，返回 (items, next_cursor, stats, readme_html)"""
+    entry = listing_cache.get(req_path)
+    if entry:
+        return entry['items'], entry['next_cursor'], entry['stats'], entry['readme']
+    try:
+        dir_mtime = storage_pool.dir_version(req_path)
+    except OSError:
+        dir_mtime = None
+    stats, readme, readme_name = summarize_directory(req_path)
+    items, next_cursor = list_directory(req_path)
+    try:
+        version = ListingCache._version(req_path, readme_name)
+    except OSError:
+        version = None
+    # 扫描期间目录有变动则不缓存，避免把旧数据当成新版本
+    if version and version[0] == dir_mtime:
+        listing_cache.put(req_path, items, next_cursor, stats, readme, readme_name, version)
+    return items, next_cursor, stats, readme
+
+def with_folder_sizes(items):
+    """给当前页的文件夹行填上递归大小 (一次批量查询，不进缓存，子目录深处的变动也能及时反映)"""
+    dirs = [item['rel_path'] for item in items if item['is_dir']]
+    if not dirs or not file_index.usage_ready: return items
+    try:
+        usage = file_index.folder_usage(dirs)
+    except sqlite3.Error:
+        return items
+    result = []
+    for item in items:
+        if item['is_dir'] and item['rel_path'] in usage:
+            size, files = usage[item['rel_path']]
+            item = dict(item, size=human_readable_size(size), bytes=size, files=files)
+        result.append(item)
+    return result
+
+def get_listing_stats(req_path):
+    entry = listing_cache.get(req_path)
+    if entry: return entry['stats']
+    return summarize_directory(req_path)[0]
+
+# ================= 外链缓存 =================
+# slug -> 外链信息 的进程内映射，首次使用时整表加载一次。
+# 新建/编辑/删除外链时更新 DATA_DIR/shares.version 的 mtime，各 worker 每次查找时
+# 只 stat 一次该文件，发现版本变化再重新加载；过期判断在内存中完成。
+# 外链下载次数先在内存中累加，由后台线程每隔几秒批量写回。
+
+SHARE_VERSION_FILE = os.path.join(DATA_DIR, 'shares.version')
+SHARE_FLUSH_INTERVAL = 5
+
+class CachedShare:
+    __slots__ = ('id', 'slug', 'file_path', 'expire_at')
+
+    def __init__(self, share):
+        self.id = share.id
+        self.slug = share.slug
+        self.file_path = share.file_path
+        self.expire_at = share.expire_at
+
+    @property
+    def is_expired(self):
+        return bool(self.expire_at and self.expire_at < get_beijing_time())
+
+class ShareRegistry(BackgroundWorker):
+    name = 'share-registry'
+    _NOT_LOADED = object()
+
+    def __init__(self, version_file=SHARE_VERSION_FILE, flush_interval=SHARE_FLUSH_INTERVAL):
+        super().__init__()
+        self.version_file = version_file
+        self.flush_interval = flush_interval
+        self._version = self._NOT_LOADED
+        self._shares = {}
+        self._lock = threading.Lock()
+        self._pending = Counter()
+        self._pending_lock = threading.Lock()
+
+    def _current_version(self):
+        try:
+            return os.stat(self.version_file).st_mtime_ns
+        except OSError:
+            return None
+
+    def bump(self):
+        """外链变更后调用，通知所有 worker 重新加载"""
+        now = time.time_ns()
+        try:
+            with open(self.version_file, 'a'):
+                pass
+            os.utime(self.version_file, ns=(now, now))
+        except OSError as e:
+            app.logger.error(f"Share version bump error: {e}")
+        with self._lock:
+            self._version = self._NOT_LOADED
+
+    def _reload(self, version):
+        shares = {s.slug: CachedShare(s) for s in FileShare.query.all()}
+        with self._lock:
+            self._shares = shares
+            self._version = version
+
+    def get(self, slug):
+        version = self._current_version()
+        if version != self._version or self._version is self._NOT_LOADED:
+            self._reload(version)
+        return self._shares.get(slug)
+
+    def record_download(self, share_id):
+        self._ensure_started()
+        with self._pending_lock:
+            self._pending[share_id] += 1
+
+    def flush(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, Counter()
+        if not pending: return
+        try:
+            run_blocking(self._store, pending)
+        except Exception as e:
+            app.logger.error(f"Share download count flush error: {e}")
+
+    def _store(self, pending):
+        with app.app_context():
+            table = FileShare.__table__
+            db.session.execute(
+                update(table).where(table.c.id == bindparam('share_id'))
+                .values(downloads=func.coalesce(table.c.downloads, 0) + bindparam('n')),
+                [{'share_id': k, 'n': v} for k, v in pending.items()]
+            )
+            db.session.commit()
+
+    def _on_start(self):
+        self._pending = Counter()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+share_registry = ShareRegistry()
+atexit.register(share_registry.flush)
+
+@app.context_processor
+def inject_global_vars():
+    return dict(is_admin=session.get('is_admin', False))
+
+@app.before_request
+def log_request_info():
+    if not request.path.startswith('/static'):
+        pass
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    metrics.gauge_add('nexus_http_requests_in_flight', 1)
+
+@app.after_request
+def record_response_metrics(response):
+    endpoint = request.endpoint or 'unmatched'
+    g.response_status = response.status_code
+    if request.method != 'HEAD' and response.content_length:
+        metrics.inc('nexus_http_response_bytes_total', response.content_length, endpoint=endpoint)
+    return response
+
+@app.teardown_request
+def finish_request_metrics(exc):
+    started = g.pop('request_started', None)
+    if started is None: return
+    endpoint = request.endpoint or 'unmatched'
+    status = 500 if exc is not None else g.pop('response_status', 500)
+    metrics.gauge_add('nexus_http_requests_in_flight', -1)
+    metrics.observe('nexus_http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    metrics.inc('nexus_http_requests_total', endpoint=endpoint, method=request.method, status=str(status))
+
+@app.route('/admin/metrics')
+def metrics_endpoint():
+    """Prometheus 抓取地址：管理员登录态，或 nexus.conf 中 metrics_token 对应的 Bearer Token"""
+    token = get_config().get('metrics_token')
+    auth = request.headers.get('Authorization', '')
+    if not session.get('is_admin') and not (token and secrets.compare_digest(auth, f"Bearer {token}")):
+        return jsonify({'error': '无权操作'}), 403
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+# ================= 静态资源与响应压缩 =================
+# 导入时 (gunicorn master 启动时的迁移子进程里就会先执行一次) 把 static/ 下的文件复制到 DATA_DIR/assets，
+# 文件名带上内容哈希 (main.3f2a1b9c0d.js)，文本文件同时生成 .br / .gz 预压缩版本，对应关系写在 manifest.json。
+# 模板用 asset_url('main.js') 取带哈希的地址：内容变了地址就变，浏览器可以永久缓存，不用再逐个验证。
+# manifest 记下了源文件的大小和修改时间，都没变时只读一次 manifest，不重新生成。
+# 动态生成的 HTML / JSON 超过 COMPRESS_MIN_SIZE 时按 Accept-Encoding 压缩；文件下载 (send_shared_file) 原样发送。
+
+ASSET_DIR = os.path.join(DATA_DIR, 'assets')
+ASSET_MANIFEST = os.path.join(ASSET_DIR, 'manifest.json')
+ASSET_MAX_AGE = 365 * 86400
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # 按优先顺序
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MIMETYPES = ('text/html', 'application/json', 'text/plain', 'text/css', 'application/javascript',
+                      'text/javascript', 'image/svg+xml')
+COMPRESS_LEVELS = {'br': 5, 'gzip': 6}  # 动态响应要兼顾 CPU，预压缩的静态文件用最高级别
+
+def compress_data(data, encoding, level=None):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if level is None else level)
+    return gzip.compress(data, 9 if level is None else level, mtime=0)
+
+def available_encodings():
+    return [e for e, _ in ASSET_ENCODINGS if e != 'br' or brotli is not None]
+
+def negotiate_encoding(encodings):
+    """按请求的 Accept-Encoding 从 encodings 里选一个，都不接受时返回 None"""
+    return request.accept_encodings.best_match(encodings) if encodings else None
+
+def _write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{secrets.token_hex(4)}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+def _asset_sources():
+    """static/ 下的文件 {相对路径: [大小, 修改时间]}，跳过隐藏文件"""
+    sources = {}
+    for root, dirs, names in os.walk(app.static_folder):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in names:
+            if name.startswith('.'): continue
+            path = os.path.join(root, name)
+            st = os.stat(path)
+            sources[os.path.relpath(path, app.static_folder).replace('\\', '/')] = [st.st_size, st.st_mtime_ns]
+    return sources
+
+def _read_asset_manifest():
+    try:
+        with open(ASSET_MANIFEST, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _manifest_current(manifest, sources):
+    return bool(manifest) and manifest.get('sources') == sources and manifest.get('brotli') == (brotli is not None)
+
+def build_assets():
+    """生成带哈希的文件和预压缩版本 (已存在的跳过)，写入并返回 manifest"""
+    previous = _read_asset_manifest() or {}
+    sources = _asset_sources()
+    files = {}
+    for rel in sorted(sources):
+        with open(os.path.join(app.static_folder, rel), 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(rel)
+        hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}"
+        target = os.path.join(ASSET_DIR, hashed)
+        if not os.path.exists(target): _write_atomic(target, data)
+        encodings = []
+        if (mimetypes.guess_type(rel)[0] or '') in COMPRESS_MIMETYPES and len(data) >= COMPRESS_MIN_SIZE:
+            for encoding, suffix in ASSET_ENCODINGS:
+                if encoding not in available_encodings(): continue
+                if not os.path.exists(target + suffix): _write_atomic(target + suffix, compress_data(data, encoding))
+                encodings.append(encoding)
+        files[rel] = {'file': hashed, 'encodings': encodings}
+    manifest = {'sources': sources, 'brotli': brotli is not None, 'files': files}
+    _write_atomic(ASSET_MANIFEST, json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+
+    # 只保留本次和上一版 manifest 的文件：滚动重启时还没退出的旧 worker 渲染的页面引用的是上一版
+    keep = {os.path.abspath(ASSET_MANIFEST)}
+    for entry in list(files.values()) + list(previous.get('files', {}).values()):
+        keep.add(os.path.abspath(os.path.join(ASSET_DIR, entry['file'])))
+        keep.update(os.path.abspath(os.path.join(ASSET_DIR, entry['file'] + suffix)) for _, suffix in ASSET_ENCODINGS)
+    for root, _, names in os.walk(ASSET_DIR):
+        for name in names:
+            path = os.path.abspath(os.path.join(root, name))
+            if path not in keep: os.remove(path)
+    app.logger.info(f"Built {len(files)} static assets into {ASSET_DIR}")
+    return manifest
+
+def init_assets():
+    """导入时调用：返回 {static 相对路径: {'file': 带哈希的文件名, 'encodings': [...]}}，失败时返回空 (退回 /static)"""
+    try:
+        sources = _asset_sources()
+        manifest = _read_asset_manifest()
+        if _manifest_current(manifest, sources): return manifest['files']
+        with file_lock('assets'):
+            manifest = _read_asset_manifest()
+            if _manifest_current(manifest, sources): return manifest['files']
+            return build_assets()['files']
+    except OSError as e:
+        app.logger.warning(f"Asset build failed, serving /static directly: {e}")
+        return {}
+
+asset_files = init_assets()
+
+@app.template_global()
+def asset_url(filename):
+    """模板里引用静态文件：有 manifest 记录时返回带哈希的地址"""
+    entry = asset_files.get(filename)
+    if entry is None: return url_for('static', filename=filename)
+    return url_for('asset', filename=entry['file'])
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    """带哈希的静态文件，按 Accept-Encoding 发送预压缩版本，永久缓存"""
+    full_path = safe_join(ASSET_DIR, filename)
+    if full_path is None or os.path.abspath(full_path) == os.path.abspath(ASSET_MANIFEST) \
+            or not os.path.isfile(full_path):
+        abort(404)
+    # 上一版的文件不在当前 manifest 里，直接看磁盘上有哪些压缩版本
+    encoding = negotiate_encoding([e for e, suffix in ASSET_ENCODINGS if os.path.isfile(full_path + suffix)])
+    suffix = dict(ASSET_ENCODINGS).get(encoding, '')
+    rv = send_from_directory(ASSET_DIR, filename + suffix, max_age=ASSET_MAX_AGE,
+                             mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if encoding: rv.headers['Content-Encoding'] = encoding
+    rv.vary.add('Accept-Encoding')
+    rv.cache_control.public = True
+    rv.cache_control.immutable = True
+    g.skip_compression = True
+    return rv
+
+@app.after_request
+def compress_response(response):
+    """压缩动态生成的 HTML / JSON (在 record_response_metrics 之前执行，响应字节数按压缩后统计)"""
+    if g.get('skip_compression') or response.status_code != 200 or response.direct_passthrough \
+            or response.is_streamed or 'Content-Encoding' in response.headers \
+            or response.mimetype not in COMPRESS_MIMETYPES:
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_SIZE: return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding(available_encodings())
+    if encoding is None: return response
+    response.set_data(run_blocking(compress_data, data, encoding, COMPRESS_LEVELS[encoding]))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag: response.set_etag(f"{etag}-{encoding}", weak)
+    return response
+
+# ================= 日志查询 =================
+# 按 (timestamp, id) 倒序做 keyset 分页：游标是上一页边界那条日志的 (timestamp, id)，
+# 翻到多深都只是一次索引范围查找，不用 OFFSET，也不用 COUNT。
+# 筛选条件 action / ip 各有 (字段, timestamp) 组合索引，文件名子串在 (timestamp, id, filename) 索引上过滤。
+
+LOG_PAGE_SIZES = (20, 50, 100)
+SHARE_PAGE_SIZE = 50
+LOG_API_MAX_LIMIT = 500
+LOG_EXPORT_BATCH = 2000
+LOG_EXPORT_FIELDS = ('id', 'timestamp', 'action', 'filename', 'ip_address', 'ip_location', 'device_type')
+LOG_FILTER_KEYS = ('action', 'ip', 'q', 'since', 'until')
+
+def encode_time_cursor(moment, row_id):
+    """(时间, id) keyset 游标，日志和外链列表共用"""
+    raw = json.dumps([moment.isoformat(), row_id], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def encode_log_cursor(log):
+    return encode_time_cursor(log.timestamp, log.id)
+
+def decode_log_cursor(cursor):
+    """解析日志游标，格式不对时抛 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        timestamp, log_id = json.loads(raw.decode('utf-8'))
+        return datetime.fromisoformat(timestamp), int(log_id)
+    except Exception:
+        raise ValueError('invalid cursor')
+
+def parse_log_time(value, end=False):
+    """
+    筛选时间：YYYY-MM-DD 或 YYYY-MM-DD HH:MM[:SS] (也接受 datetime-local 的 T 分隔)。
+    只给日期的结束时间包含当天，返回的是第二天零点 (查询用 <)。格式不对时抛 ValueError。
+    """
+    moment = datetime.fromisoformat(value.strip().replace(' ', 'T'))
+    if end and len(value.strip()) <= 10: moment += timedelta(days=1)
+    return moment
+
+def log_filters(args):
+    """从查询参数取出非空的筛选条件 (原始字符串，模板回填表单和拼链接用)"""
+    return {k: args.get(k, '').strip() for k in LOG_FILTER_KEYS if args.get(k, '').strip()}
+
+def filtered_logs(filters):
+    """按筛选条件构造查询，时间格式不对时抛 ValueError"""
+    query = DownloadLog.query
+    if 'action' in filters: query = query.filter(DownloadLog.action == filters['action'])
+    if 'ip' in filters: query = query.filter(DownloadLog.ip_address == filters['ip'])
+    if 'q' in filters: query = query.filter(DownloadLog.filename.contains(filters['q'], autoescape=True))
+    if 'since' in filters: query = query.filter(DownloadLog.timestamp >= parse_log_time(filters['since']))
+    if 'until' in filters: query = query.filter(DownloadLog.timestamp < parse_log_time(filters['until'], end=True))
+    return query
+
+def query_logs(filters, cursor=None, limit=50, newer=False):
+    """
+    取一页日志 (始终按时间倒序排列)。cursor 为空时取最新一页；
+    newer=False 取游标之后 (更旧) 的一页，newer=True 取游标之前 (更新) 的一页，用于“上一页”。
+    返回 {'items', 'next_cursor', 'prev_cursor'}，没有下一页/上一页时对应游标为 None。
+    """
+    query = filtered_logs(filters)
+    key = tuple_(DownloadLog.timestamp, DownloadLog.id)
+    position = decode_log_cursor(cursor) if cursor else None
+    if position and newer:
+        rows = query.filter(key > position).order_by(DownloadLog.timestamp.asc(), DownloadLog.id.asc()) \
+            .limit(limit + 1).all()
+        items = rows[:limit][::-1]
+        if not items:
+            # 已经在最前面了，退回第一页
+            return query_logs(filters, None, limit)
+        return {'items': items, 'next_cursor': encode_log_cursor(items[-1]),
+                'prev_cursor': encode_log_cursor(items[0]) if len(rows) > limit else None}
+
+    if position: query = query.filter(key < position)
+    rows = query.order_by(DownloadLog.timestamp.desc(), DownloadLog.id.desc()).limit(limit + 1).all()
+    items = rows[:limit]
+    return {'items': items, 'next_cursor': encode_log_cursor(items[-1]) if len(rows) > limit else None,
+            'prev_cursor': encode_log_cursor(items[0]) if position and items else None}
+
+def encode_share_cursor(share):
+    return encode_time_cursor(share.created_at, share.id)
+
+def query_shares(cursor=None, limit=SHARE_PAGE_SIZE, newer=False):
+    """后台外链列表的一页 (按创建时间倒序)，游标和返回值同 query_logs"""
+    key = tuple_(FileShare.created_at, FileShare.id)
+    position = decode_log_cursor(cursor) if cursor else None
+    if position and newer:
+        rows = FileShare.query.filter(key > position).order_by(FileShare.created_at.asc(), FileShare.id.asc()) \
+            .limit(limit + 1).all()
+        items = rows[:limit][::-1]
+        if not items: return query_shares(None, limit)
+        return {'items': items, 'next_cursor': encode_share_cursor(items[-1]),
+                'prev_cursor': encode_share_cursor(items[0]) if len(rows) > limit else None}
+
+    query = FileShare.query.filter(key < position) if position else FileShare.query
+    rows = query.order_by(FileShare.created_at.desc(), FileShare.id.desc()).limit(limit + 1).all()
+    items = rows[:limit]
+    return {'items': items, 'next_cursor': encode_share_cursor(items[-1]) if len(rows) > limit else None,
+            'prev_cursor': encode_share_cursor(items[0]) if position and items else None}
+
+def log_to_dict(log):
+    return {
+        'id': log.id, 'timestamp': log.timestamp.strftime('%Y-%m-%d %H:%M:%S'), 'action': log.action,
+        'filename': log.filename, 'ip_address': log.ip_address, 'ip_location': log.ip_location,
+        'device_type': log.device_type,
+    }
+
+def _export_batch(filters, position):
+    """导出的一批：独立的应用上下文和短事务，不会长时间占着读事务 (WAL 无法 checkpoint)"""
+    with app.app_context():
+        query = filtered_logs(filters).with_entities(*(getattr(DownloadLog, f) for f in LOG_EXPORT_FIELDS))
+        if position: query = query.filter(tuple_(DownloadLog.timestamp, DownloadLog.id) < position)
+        rows = query.order_by(DownloadLog.timestamp.desc(), DownloadLog.id.desc()).limit(LOG_EXPORT_BATCH).all()
+        db.session.remove()
+        return rows
+
+def iter_log_export(filters, fmt):
+    """
+    逐批导出日志：每批按 keyset 接着上一批的最后一条查，内存占用只有一批的大小。
+    gevent 模式下查询放到线程池执行，导出期间其他请求照常处理。
+    """
+    buf = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buf)
+        buf.write('\ufeff')  # Excel 打开 UTF-8 CSV 需要 BOM
+        writer.writerow(LOG_EXPORT_FIELDS)
+    position = None
+    while True:
+        rows = run_blocking(_export_batch, filters, position)
+        for row in rows:
+            values = [v.strftime('%Y-%m-%d %H:%M:%S') if isinstance(v, datetime) else v for v in row]
+            if fmt == 'csv':
+                writer.writerow(values)
+            else:
+                buf.write(json.dumps(dict(zip(LOG_EXPORT_FIELDS, values)), ensure_ascii=False) + '\n')
+        if buf.tell():
+            yield buf.getvalue().encode('utf-8')
+            buf.seek(0)
+            buf.truncate()
+        if len(rows) < LOG_EXPORT_BATCH: break
+        position = (rows[-1].timestamp, rows[-1].id)
+        cooperate()
+
+@app.route('/admin/logs')
+def api_logs():
+    """日志查询: ?action=&ip=&q=&since=&until=&cursor=&dir=prev&limit="""
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    filters = log_filters(request.args)
+    limit = max(1, min(request.args.get('limit', 50, type=int), LOG_API_MAX_LIMIT))
+    try:
+        page = query_logs(filters, request.args.get('cursor') or None, limit, request.args.get('dir') == 'prev')
+    except ValueError:
+        return jsonify({'error': '无效的游标或时间格式'}), 400
+    return jsonify({'items': [log_to_dict(log) for log in page['items']],
+                    'next_cursor': page['next_cursor'], 'prev_cursor': page['prev_cursor']})
+
+@app.route('/admin/logs/export')
+def export_logs():
+    """导出日志: ?format=csv|jsonl，筛选参数同 /admin/logs"""
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'jsonl'): return jsonify({'error': '不支持的导出格式'}), 400
+    filters = log_filters(request.args)
+    try:
+        filtered_logs(filters)
+    except ValueError:
+        return jsonify({'error': '无效的时间格式'}), 400
+
+    chunks = count_streamed_bytes(iter_log_export(filters, fmt), 'export_logs')
+    rv = app.response_class(chunks, mimetype='text/csv' if fmt == 'csv' else 'application/x-ndjson')
+    filename = f"nexus-logs-{get_beijing_time().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    rv.headers['Content-Disposition'] = _content_disposition(filename, True)
+    rv.headers['X-Accel-Buffering'] = 'no'
+    return rv
+
+# ================= 日志汇总与保留 =================
+# 后台线程每 ROLLUP_INTERVAL 秒把 download_log 中已结束的整点小时 (留出 ROLLUP_DELAY 让归属地回填完成)
+# 累加进 log_hourly (小时, 动作) 和 log_daily (日期, 动作, 文件名, 归属地)。
+# 汇总进度记在 SystemStat 的 rollup:until (北京时间的秒数)，每条日志只会被汇总一次。
+# 面板的趋势图和热门文件读汇总表，再加上进度之后还没汇总的一两个小时原始日志，查询量只取决于图表的时间范围。
+# nexus.conf 中 log_retention_days (默认 90，0 为不删除) 为原始日志的保留天数：
+# 超过的且已汇总的日志每批 ROLLUP_DELETE_BATCH 条、一批一个短事务地删除，计数器的变化和清空日志相同。
+# 清空日志只把删除截止时间记到 rollup:purge_before 并唤醒后台线程，同样分批删除；
+# 删除不会越过汇总进度，截止时间之前最后一个多小时的日志要等正常的延迟汇总完成后才删，
+# 这样还在各 worker 队列里的日志和还在查询中的归属地都能先汇总进统计表。
+
+ROLLUP_INTERVAL = 600
+ROLLUP_FIRST_RUN = 60
+ROLLUP_DELAY = 3600
+ROLLUP_CHUNK = timedelta(days=1)  # 每个事务汇总的时间跨度
+ROLLUP_DELETE_BATCH = 1000
+ROLLUP_DELETE_PAUSE = 0.05
+ROLLUP_WATERMARK_KEY = 'rollup:until'
+ROLLUP_PURGE_KEY = 'rollup:purge_before'
+LOG_RETENTION_DAYS = 90
+
+TRAFFIC_CHART_DAYS = 30
+TRAFFIC_CHART_HOURS = 48
+TOP_FILES_DAYS = 7
+TOP_FILES_LIMIT = 10
+TOP_FILE_ACTIONS = ('down', 'share_down', 'view')
+# 趋势图按颜色分段的动作分组，其余动作归入最后一组
+TRAFFIC_SERIES = (('down', '下载', ('down', 'share_down')), ('view', '预览', ('view',)), ('other', '其他', None))
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _log_timestamp(dt):
+    """与 DownloadLog.timestamp 在 SQLite 中的存储格式一致，可以直接按字符串比较"""
+    return dt.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+def get_rollup_watermark():
+    """已汇总到的时间 (不含)，还没汇总过时返回 None"""
+    stat = db.session.get(SystemStat, ROLLUP_WATERMARK_KEY)
+    return _EPOCH + timedelta(seconds=stat.value) if stat else None
+
+def get_purge_marker():
+    """清空日志要求删除到的时间 (不含)，没有待删除的请求时返回 None"""
+    stat = db.session.get(SystemStat, ROLLUP_PURGE_KEY)
+    return _EPOCH + timedelta(seconds=stat.value) if stat else None
+
+class LogRollup(BackgroundWorker):
+    name = 'log-rollup'
+
+    HOURLY_SQL = text("""
+        INSERT INTO log_hourly (hour, action, count)
+        SELECT substr(timestamp, 1, 13), COALESCE(action, 'unknown'), COUNT(*) FROM download_log
+        WHERE timestamp >= :start AND timestamp < :end GROUP BY 1, 2
+        ON CONFLICT (hour, action) DO UPDATE SET count = log_hourly.count + excluded.count""")
+    DAILY_SQL = text("""
+        INSERT INTO log_daily (day, action, filename, ip_location, count)
+        SELECT substr(timestamp, 1, 10), COALESCE(action, 'unknown'), COALESCE(filename, ''),
+               COALESCE(ip_location, '未知'), COUNT(*) FROM download_log
+        WHERE timestamp >= :start AND timestamp < :end GROUP BY 1, 2, 3, 4
+        ON CONFLICT (day, action, filename, ip_location) DO UPDATE SET count = log_daily.count + excluded.count""")
+
+    def __init__(self, interval=ROLLUP_INTERVAL, delay=ROLLUP_DELAY, batch=ROLLUP_DELETE_BATCH):
+        super().__init__()
+        self.interval = interval
+        self.delay = delay
+        self.batch = batch
+
+    @staticmethod
+    def retention_days():
+        return _config_number(get_config(), 'log_retention_days', LOG_RETENTION_DAYS, float)
+
+    def _rollup_range(self, start, end):
+        with app.app_context():
+            params = {'start': _log_timestamp(start), 'end': _log_timestamp(end)}
+            with metrics.timer('log_rollup'):
+                db.session.execute(self.HOURLY_SQL, params)
+                db.session.execute(self.DAILY_SQL, params)
+                db.session.merge(SystemStat(key=ROLLUP_WATERMARK_KEY, value=int((end - _EPOCH).total_seconds())))
+                db.session.commit()
+
+    def rollup(self, until):
+        """把汇总进度推进到 until，每个事务汇总一天的日志；调用方持有 rollup 文件锁"""
+        with app.app_context():
+            start = get_rollup_watermark()
+            if start is None:
+                # 第一次运行：从最早的日志开始补齐
+                start = db.session.query(func.min(DownloadLog.timestamp)).scalar() or until
+        while True:
+            end = max(start, min(until, start + ROLLUP_CHUNK))
+            run_blocking(self._rollup_range, start, end)
+            start = end
+            if start >= until: return
+
+    def _purge_batch(self, before):
+        """删除一批 before 之前的日志，实时计数器减掉、归档计数器加上删除的条数"""
+        with app.app_context():
+            rows = db.session.query(DownloadLog.id, DownloadLog.action).filter(
+                DownloadLog.timestamp < before).order_by(DownloadLog.timestamp).limit(self.batch).all()
+            if not rows: return 0
+            DownloadLog.query.filter(DownloadLog.id.in_([r.id for r in rows])).delete(synchronize_session=False)
+            removed = Counter(r.action for r in rows)
+            deltas = Counter({live_counter_key(a): -n for a, n in removed.items()})
+            deltas[LIVE_TOTAL_KEY] -= len(rows)
+            for stat_key, actions in ARCHIVED_STAT_ACTIONS.items():
+                deltas[stat_key] += sum(removed[a] for a in actions)
+            increment_counters(deltas)
+            db.session.commit()
+            return len(rows)
+
+    def purge(self, before):
+        """分批删除 before 之前的日志 (必须已汇总)，批次之间让出写锁给日志写入；返回删除条数"""
+        deleted = 0
+        while True:
+            count = run_blocking(self._purge_batch, before)
+            deleted += count
+            if count:
+                metrics.inc('nexus_logs_purged_total', count)
+            if count < self.batch: return deleted
+            time.sleep(ROLLUP_DELETE_PAUSE)
+
+    def request_purge(self, before):
+        """记录清空日志的删除截止时间 (已有更晚的截止时间时保留原值)，日志汇总过 before 之后才会删除"""
+        table = SystemStat.__table__
+        stmt = sqlite_insert(table).values(key=ROLLUP_PURGE_KEY, value=int((before - _EPOCH).total_seconds()))
+        stmt = stmt.on_conflict_do_update(index_elements=[table.c.key], set_={'value': func.max(table.c.value, stmt.excluded.value)})
+        db.session.execute(stmt)
+        db.session.commit()
+
+    def wake(self):
+        """让本进程的后台线程马上执行一轮，调用方不能持有 rollup 文件锁"""
+        self._ensure_started()
+        self._wakeup.set()
+
+    def _purge_cutoff(self, now):
+        """本轮要删除到的时间：保留天数和清空日志的截止时间取较晚的一个，且不超过汇总进度"""
+        with app.app_context():
+            watermark, marker = get_rollup_watermark(), get_purge_marker()
+        days = self.retention_days()
+        before = now - timedelta(days=days) if days > 0 else None
+        if marker and (before is None or marker > before):
+            before = marker
+        if before is None or watermark is None: return None, marker
+        return min(watermark, before), marker
+
+    def _clear_marker(self, marker):
+        with app.app_context():
+            # 删除期间又有新的清空请求时截止时间会变大，保留给下一轮
+            SystemStat.query.filter_by(key=ROLLUP_PURGE_KEY, value=int((marker - _EPOCH).total_seconds())).delete()
+            db.session.commit()
+
+    def run_once(self):
+        now = get_beijing_time()
+        until = (now - timedelta(seconds=self.delay)).replace(minute=0, second=0, microsecond=0)
+        self.rollup(until)
+        before, marker = self._purge_cutoff(now)
+        if before is None: return 0
+        deleted = self.purge(before)
+        if marker and before >= marker:
+            run_blocking(self._clear_marker, marker)
+        if deleted:
+            app.logger.info(f"Purged {deleted} log rows before {before:%Y-%m-%d %H:%M:%S}")
+        return deleted
+
+    def _on_start(self):
+        self._wakeup = threading.Event()
+
+    def _run(self):
+        wait = ROLLUP_FIRST_RUN
+        while True:
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+            wait = self.interval
+            try:
+                # 每个 worker 都有一个线程，同一时间只让拿到锁的那个执行
+                with file_lock('rollup', blocking=False) as locked:
+                    if locked: self.run_once()
+            except Exception as e:
+                app.logger.error(f"Log rollup error: {e}")
+
+    def start(self):
+        self._ensure_started()
+
+log_rollup = LogRollup()
+log_rollup.start()
+
+def _unrolled_logs(since):
+    """汇总进度之后、还没进汇总表的原始日志 (正常情况下只有最近一两个小时)"""
+    watermark = get_rollup_watermark()
+    start = max(watermark, since) if watermark else since
+    return DownloadLog.query.filter(DownloadLog.timestamp >= start)
+
+def _chart_bars(buckets, counts):
+    """[(标签, 提示文字, Counter(动作))] -> 按 TRAFFIC_SERIES 分段、以最高的一根为 100% 的柱状图数据"""
+    grouped = set(a for _, _, actions in TRAFFIC_SERIES if actions for a in actions)
+    peak = max([sum(c.values()) for c in counts.values()] + [1])
+    bars = []
+    for key, label, title in buckets:
+        c = counts.get(key, Counter())
+        total = sum(c.values())
+        parts = []
+        for series, name, actions in TRAFFIC_SERIES:
+            n = sum(c[a] for a in actions) if actions else sum(v for a, v in c.items() if a not in grouped)
+            if n: parts.append({'series': series, 'name': name, 'count': n, 'percent': round(n * 100 / peak, 2)})
+        detail = ' / '.join(f"{p['name']} {p['count']}" for p in parts)
+        bars.append({'label': label, 'title': f"{title}：{detail or '无'}", 'total': total, 'parts': parts})
+    return bars
+
+def get_traffic_charts(days=TRAFFIC_CHART_DAYS, hours=TRAFFIC_CHART_HOURS):
+    """最近 days 天按天、最近 hours 小时按小时的事件数，读 log_hourly 加上还没汇总的原始日志"""
+    now = get_beijing_time()
+    first_day = (now - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    hourly = {}
+    for hour, action, count in db.session.query(LogHourly.hour, LogHourly.action, LogHourly.count).filter(
+            LogHourly.hour >= first_day.strftime('%Y-%m-%d %H')):
+        hourly.setdefault(hour, Counter())[action] += count
+    bucket = func.substr(DownloadLog.timestamp, 1, 13)
+    for hour, action, count in _unrolled_logs(first_day).with_entities(bucket, DownloadLog.action, func.count()) \
+            .group_by(bucket, DownloadLog.action):
+        hourly.setdefault(hour, Counter())[action or 'unknown'] += count
+
+    daily = {}
+    for hour, c in hourly.items():
+        daily.setdefault(hour[:10], Counter()).update(c)
+    day_buckets = []
+    for i in range(days):
+        day = first_day + timedelta(days=i)
+        day_buckets.append((day.strftime('%Y-%m-%d'), day.strftime('%m-%d'), day.strftime('%Y-%m-%d')))
+    last_hour = now.replace(minute=0, second=0, microsecond=0)
+    hour_buckets = []
+    for i in range(hours - 1, -1, -1):
+        hour = last_hour - timedelta(hours=i)
+        hour_buckets.append((hour.strftime('%Y-%m-%d %H'), hour.strftime('%H时'), hour.strftime('%Y-%m-%d %H:00')))
+    recent = {k: hourly[k] for k, _, _ in hour_buckets if k in hourly}
+    return {'daily': _chart_bars(day_buckets, daily), 'hourly': _chart_bars(hour_buckets, recent),
+            'days': days, 'hours': hours}
+
+def get_top_files(days=TOP_FILES_DAYS, limit=TOP_FILES_LIMIT):
+    """最近 days 天下载 + 预览次数最多的文件，读 log_daily 加上还没汇总的原始日志"""
+    first_day = (get_beijing_time() - timedelta(days=days - 1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    recent = Counter(dict(_unrolled_logs(first_day).filter(DownloadLog.action.in_(TOP_FILE_ACTIONS))
+                          .with_entities(DownloadLog.filename, func.count()).group_by(DownloadLog.filename)))
+    total = func.sum(LogDaily.count)
+    # 多取 len(recent) 个，未汇总的部分加上去之后排名可能变化
+    counts = Counter(dict(db.session.query(LogDaily.filename, total).filter(
+        LogDaily.day >= first_day.strftime('%Y-%m-%d'), LogDaily.action.in_(TOP_FILE_ACTIONS))
+        .group_by(LogDaily.filename).order_by(total.desc()).limit(limit + len(recent))))
+    counts.update({name or '': n for name, n in recent.items()})
+    top = counts.most_common(limit)
+    peak = top[0][1] if top else 1
+    return {'days': days, 'files': [{'filename': name, 'count': n, 'percent': round(n * 100 / peak, 1)} for name, n in top]}
+
+# ================= 接口部分 =================
+
+# 清空日志：只记下删除截止时间后立即返回，由 LogRollup 后台线程在正常汇总 (按天 / 按文件的历史不丢) 越过
+# 截止时间后分批删除，删除期间日志照常写入；计数器的归档和自动清理相同 (见「日志汇总与保留」)
+@app.route('/admin/logs/clear', methods=['POST'])
+def clear_logs():
+    if not session.get('is_admin'): 
+        return jsonify({'error': '无权操作'}), 403
+    try:
+        log_rollup.request_purge(get_beijing_time())
+        log_rollup.wake()
+        return jsonify({'success': True, 'pending': True})
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/admin/file/mkdir', methods=['POST'])
+def create_folder():
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    data = request.json
+    path = secure_path(data.get('path', ''))
+    name = data.get('name', '').strip()
+    if path is None: return jsonify({'error': '非法路径'}), 400
+    if not name or '..' in name or '/' in name or '\\' in name: 
+        return jsonify({'error': '文件夹名称非法'}), 400
+    if not storage_pool.isdir(path): return jsonify({'error': '目录不存在'}), 404
+    try:
+        if storage_pool.exists(os.path.join(path, name)): raise FileExistsError(name)
+        os.makedirs(os.path.join(storage_pool.place(path), name), exist_ok=False)
+        file_index.add(os.path.join(path, name))
+        listing_cache.invalidate(path)
+        return jsonify({'success': True})
+    except FileExistsError:
+        return jsonify({'error': '该文件夹已存在'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def clean_upload_filename(name):
+    filename = os.path.basename(name or '')
+    filename = filename.replace('..', '').replace('/', '').replace('\\', '')
+    if not filename: filename = f"upload_{int(time.time())}_{secrets.token_hex(4)}"
+    return filename
+
+def unique_save_path(upload_dir, filename, digest=None):
+    """
+    重名时依次尝试 name_1.ext、name_2.ext ... (重名按逻辑路径判断，其他卷上的同名文件也算)
+    传入内容哈希时，若某个已存在的候选内容相同 (查去重索引，O(1)) 则直接返回该文件的实际路径，调用方据此跳过写入。
+    """
+    rel_dir = storage_pool.logical(upload_dir)
+    name = filename
+    base, ext = os.path.splitext(filename)
+    counter = 1
+    while True:
+        existing = storage_pool.locate(os.path.join(rel_dir, name))
+        if not os.path.exists(existing): return os.path.join(upload_dir, name)
+        if digest and blob_store.hash_of(existing) == digest: return existing
+        name = f"{base}_{counter}{ext}"
+        counter += 1
+
+@app.route('/admin/file/upload', methods=['POST'])
+def upload_file():
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    try:
+        path = secure_path(request.form.get('path', ''))
+        if path is None: return jsonify({'error': '非法路径'}), 400
+        if not storage_pool.isdir(path):
+            return jsonify({'error': '目录不存在'}), 404
+        upload_dir = storage_pool.place(path, request.content_length)
+        files = request.files.getlist('files')
+        dedup = blob_store.enabled
+        saved_count = 0
+        duplicates = 0
+        for file in files:
+            if file and file.filename:
+                filename = clean_upload_filename(file.filename)
+                if dedup:
+                    save_path, duplicate = save_upload_stream(file.stream, upload_dir, filename)
+                    saved_count += 1
+                    if duplicate:
+                        duplicates += 1
+                        continue
+                else:
+                    save_path = unique_save_path(upload_dir, filename)
+                    file.save(save_path)
+                    saved_count += 1
+                file_index.add(storage_pool.logical(save_path))
+        listing_cache.invalidate(path)
+        return jsonify({'success': True, 'count': saved_count, 'duplicates': duplicates})
+    except Exception as e:
+        app.logger.error(f"Upload Error: {str(e)}")
+        return jsonify({'error': f"上传出错: {str(e)}"}), 500
+
+# ================= 去重存储 =================
+# 可选功能 (nexus.conf 中 dedup=on)：上传内容按 SHA-256 存一份到 blob 目录，共享目录里的文件是它的硬链接
+# (跨文件系统或硬链接数超限时尝试 reflink，都不行就退回普通文件、不参与去重)。
+# DATA_DIR/dedup.db 记录 blob 引用计数和 路径 -> 哈希 的映射，重复上传无需再写一遍数据；
+# 删除/重命名接口同步维护引用，计数归零且没有其他硬链接时删除 blob。
+# 注意：blob 目录需要和 BASE_DIR 在同一个文件系统上才能用硬链接，存储池里其他文件系统上的卷写入普通文件。
+
+DEDUP_DB_FILE = os.path.join(DATA_DIR, 'dedup.db')
+FICLONE = 0x40049409  # Linux ioctl，btrfs/xfs 等支持写时复制的文件系统可用
+
+def _reflink(src, dst):
+    if fcntl is None: return False
+    try:
+        with open(src, 'rb') as fs, open(dst, 'xb') as fd:
+            fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+        return True
+    except OSError:
+        try: os.remove(dst)
+        except OSError: pass
+        return False
+
+class BlobStore:
+    def __init__(self, db_file=DEDUP_DB_FILE, blob_dir=None, pool=storage_pool):
+        self.db_file = db_file
+        self.blob_dir = blob_dir or get_config().get('blob_dir') or os.path.join(DATA_DIR, 'blobs')
+        self.pool = pool
+        self._local = threading.local()
+        self._schema_ready = False
+
+    @property
+    def enabled(self):
+        return get_config().get('dedup', 'off').strip().lower() in ('on', 'true', '1', 'yes')
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS blobs (
+                        hash TEXT PRIMARY KEY,
+                        size INTEGER NOT NULL,
+                        refs INTEGER NOT NULL DEFAULT 0,
+                        created_at REAL NOT NULL
+                    );
+                    CREATE TABLE IF NOT EXISTS links (
+                        path TEXT PRIMARY KEY,
+                        hash TEXT NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_links_hash ON links(hash);
+                ''')
+                self._schema_ready = True
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest[2:4], digest)
+
+    def _rel(self, path):
+        return self.pool.logical(path)
+
+    def lookup(self, digest):
+        """已存在的 blob 返回其大小，否则 None"""
+        row = self._conn().execute("SELECT size FROM blobs WHERE hash = ?", (digest,)).fetchone()
+        if row and os.path.exists(self.blob_path(digest)): return row['size']
+        return None
+
+    def hash_of(self, full_path):
+        """共享目录中某个文件的内容哈希 (只认经去重存储写入的文件)"""
+        row = self._conn().execute("SELECT hash FROM links WHERE path = ?", (self._rel(full_path),)).fetchone()
+        return row['hash'] if row else None
+
+    def _link(self, src, dst):
+        try:
+            os.link(src, dst)
+            return True
+        except FileExistsError:
+            raise
+        except OSError:
+            # EXDEV (跨文件系统) / EMLINK (硬链接数超限) / 文件系统不支持硬链接
+            return _reflink(src, dst)
+
+    def _record(self, conn, digest, size, rel_path):
+        conn.execute('''
+            INSERT INTO blobs(hash, size, refs, created_at) VALUES (?, ?, 1, ?)
+            ON CONFLICT(hash) DO UPDATE SET refs = refs + 1
+        ''', (digest, size, time.time()))
+        conn.execute("INSERT OR REPLACE INTO links(path, hash) VALUES (?, ?)", (rel_path, digest))
+
+    def ingest(self, src, dest, digest, size):
+        """
+        把已算好哈希的临时文件 src (与 dest 在同一目录) 放到 dest。
+        内容已存在时 dest 直接链接到已有 blob 并丢弃 src，返回 True；否则 src 成为新的 blob，返回 False。
+        """
+        blob = self.blob_path(digest)
+        with file_lock('blobs'):
+            conn = self._conn()
+            if os.path.exists(blob):
+                if not self._link(blob, dest):
+                    os.replace(src, dest)
+                    return False
+                os.remove(src)
+                reused = True
+            else:
+                os.makedirs(os.path.dirname(blob), exist_ok=True)
+                if not self._link(src, blob):
+                    app.logger.warning(f"Dedup: cannot link into {self.blob_dir}, storing {dest} as a plain file")
+                    os.replace(src, dest)
+                    return False
+                os.replace(src, dest)
+                reused = False
+            with conn:
+                self._record(conn, digest, size, self._rel(dest))
+        return reused
+
+    def link_existing(self, digest, dest):
+        """秒传：内容已在 blob 中时直接链接到 dest，成功返回 True"""
+        blob = self.blob_path(digest)
+        with file_lock('blobs'):
+            row = self._conn().execute("SELECT size FROM blobs WHERE hash = ?", (digest,)).fetchone()
+            if not row or not os.path.exists(blob): return False
+            try:
+                if not self._link(blob, dest): return False
+            except FileExistsError:
+                return False
+            conn = self._conn()
+            with conn:
+                self._record(conn, digest, row['size'], self._rel(dest))
+        return True
+
+    def move(self, old_rel, new_rel):
+        old_rel = old_rel.replace('\\', '/').strip('/')
+        new_rel = new_rel.replace('\\', '/').strip('/')
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("UPDATE links SET path = ? || substr(path, ?) WHERE path = ? OR (path >= ? AND path < ?)",
+                             (new_rel, len(old_rel) + 1, old_rel, old_rel + '/', _range_end(old_rel)))
+        except sqlite3.Error as e:
+            app.logger.error(f"Dedup move error: {e}")
+
+    def remove(self, rel_path, only_missing=False):
+        """
+        文件/文件夹删除后调用：减少引用，没有其他硬链接的孤儿 blob 一并删除。
+        only_missing=True 时只处理子树中已不存在的文件 (删除任务中途取消的情况)。
+        """
+        rel_path = rel_path.replace('\\', '/').strip('/')
+        try:
+            with file_lock('blobs'):
+                conn = self._conn()
+                with conn:
+                    rows = conn.execute("SELECT path, hash FROM links WHERE path = ? OR (path >= ? AND path < ?)",
+                                        (rel_path, rel_path + '/', _range_end(rel_path))).fetchall()
+                    if only_missing:
+                        rows = [row for row in rows if not self.pool.copies(row['path'])]
+                    if not rows: return
+                    conn.executemany("DELETE FROM links WHERE path = ?", [(row['path'],) for row in rows])
+                    counts = Counter(row['hash'] for row in rows)
+                    conn.executemany("UPDATE blobs SET refs = refs - ? WHERE hash = ?",
+                                     [(n, digest) for digest, n in counts.items()])
+                    for digest in counts:
+                        row = conn.execute("SELECT refs FROM blobs WHERE hash = ?", (digest,)).fetchone()
+                        if row and row['refs'] <= 0: self._drop_blob(conn, digest)
+        except Exception as e:
+            app.logger.error(f"Dedup remove error: {e}")
+
+    def _drop_blob(self, conn, digest):
+        blob = self.blob_path(digest)
+        try:
+            nlink = os.stat(blob).st_nlink
+        except FileNotFoundError:
+            nlink = 1
+        if nlink > 1:
+            # 计数与实际硬链接不一致 (例如在服务器上手动复制过)，以硬链接数为准保留 blob
+            conn.execute("UPDATE blobs SET refs = ? WHERE hash = ?", (nlink - 1, digest))
+            return
+        try:
+            os.remove(blob)
+        except FileNotFoundError:
+            pass
+        conn.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+
+    def stats(self):
+        row = self._conn().execute(
+            "SELECT COUNT(*) AS blobs, COALESCE(SUM(size), 0) AS stored, COALESCE(SUM(size * refs), 0) AS logical FROM blobs").fetchone()
+        return {'blobs': row['blobs'], 'stored': row['stored'], 'saved': max(0, row['logical'] - row['stored'])}
+
+blob_store = BlobStore()
+
+def save_upload_stream(stream, upload_dir, filename):
+    """
+    上传流边写临时文件边算 SHA-256，再交给去重存储。
+    返回 (save_path, duplicate)：duplicate 为 True 表示目录里已有同名同内容的文件，没有新建任何文件。
+    """
+    tmp_path = os.path.join(upload_dir, f".{secrets.token_hex(8)}.upload")
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as f:
+            for block in iter(lambda: stream.read(UPLOAD_IO_BLOCK), b''):
+                f.write(block)
+                digest.update(block)
+                size += len(block)
+        return place_deduplicated(tmp_path, upload_dir, filename, digest.hexdigest(), size)
+    finally:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+
+def place_deduplicated(tmp_path, upload_dir, filename, digest, size):
+    save_path = unique_save_path(upload_dir, filename, digest)
+    if os.path.exists(save_path):
+        os.remove(tmp_path)
+        return save_path, True
+    blob_store.ingest(tmp_path, save_path, digest, size)
+    return save_path, False
+
+# ================= 分片上传 =================
+# init -> PUT 分片 (可并行、可断点续传) -> complete。
+# 分片直接写进目标目录下预分配的隐藏文件 `.<upload_id>.part` 的对应偏移，完成时原地 rename，没有第二次拷贝。
+# 上传状态放在 DATA_DIR/uploads/<upload_id>/：meta.json + 每个已收到分片一个标记文件，多 worker 之间无需加锁。
+# 每个分片必须带 X-Chunk-Crc32 (HTTPS 下前端另带 X-Chunk-Sha256)，收到时校验，标记文件里记下分片的 CRC32 / SHA-256；
+# complete 时把整个文件按分片重新读一遍，和记录的校验值逐个比对，确认落盘的内容就是收到的内容。
+
+UPLOAD_STATE_DIR = os.path.join(DATA_DIR, 'uploads')
+UPLOAD_DEFAULT_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_STALE_SECONDS = 24 * 3600
+UPLOAD_GC_INTERVAL = 3600
+UPLOAD_IO_BLOCK = 1024 * 1024
+
+os.makedirs(UPLOAD_STATE_DIR, exist_ok=True)
+_upload_gc_at = 0
+
+def _upload_state_dir(upload_id):
+    if not upload_id or not all(c in '0123456789abcdef' for c in upload_id): return None
+    return os.path.join(UPLOAD_STATE_DIR, upload_id)
+
+def _load_upload(upload_id):
+    state_dir = _upload_state_dir(upload_id)
+    if not state_dir: return None
+    try:
+        with open(os.path.join(state_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _received_chunks(upload_id):
+    try:
+        return sorted(int(n[:-5]) for n in os.listdir(_upload_state_dir(upload_id)) if n.endswith('.done'))
+    except OSError:
+        return []
+
+def _chunk_digests(upload_id, index):
+    """分片标记文件里记录的校验值 {'crc32': ..., 'sha256': ...}；旧版本的标记文件只有 SHA-256 十六进制"""
+    with open(os.path.join(_upload_state_dir(upload_id), f"{index}.done"), 'r') as f:
+        content = f.read().strip()
+    try:
+        return json.loads(content)
+    except ValueError:
+        return {'sha256': content}
+
+def verify_upload(meta, want_sha256=False):
+    """
+    按分片重新读一遍已拼好的文件，和每个分片收到时记录的校验值比对。
+    返回 (第一个不一致的分片序号或 None, 整文件 SHA-256 或 None)；want_sha256 时顺带计算整文件哈希。
+    """
+    whole = hashlib.sha256() if want_sha256 else None
+    with open(meta['part_path'], 'rb') as f:
+        for index in range(meta['total_chunks']):
+            expected = _chunk_digests(meta['id'], index)
+            remaining = min(meta['chunk_size'], meta['size'] - index * meta['chunk_size'])
+            crc, chunk = 0, (hashlib.sha256() if 'crc32' not in expected else None)
+            while remaining > 0:
+                block = f.read(min(UPLOAD_IO_BLOCK, remaining))
+                if not block: return index, None
+                remaining -= len(block)
+                crc = zlib.crc32(block, crc)
+                if chunk: chunk.update(block)
+                if whole: whole.update(block)
+            if chunk is None and f"{crc:08x}" != expected['crc32']: return index, None
+            if chunk is not None and chunk.hexdigest() != expected.get('sha256'): return index, None
+    return None, whole.hexdigest() if whole else None
+
+def _upload_status(meta):
+    return {'upload_id': meta['id'], 'chunk_size': meta['chunk_size'],
+            'total_chunks': meta['total_chunks'], 'received': _received_chunks(meta['id']),
+            'dedup': blob_store.enabled}
+
+def _discard_upload(meta):
+    try:
+        os.remove(meta['part_path'])
+    except OSError:
+        pass
+    shutil.rmtree(_upload_state_dir(meta['id']), ignore_errors=True)
+
+def cleanup_stale_uploads(force=False):
+    """清理超过 UPLOAD_STALE_SECONDS 没有新分片的上传 (由 init 接口顺带触发，每小时最多一次)"""
+    global _upload_gc_at
+    now = time.time()
+    if not force and now - _upload_gc_at < UPLOAD_GC_INTERVAL: return
+    _upload_gc_at = now
+    try:
+        names = os.listdir(UPLOAD_STATE_DIR)
+    except OSError:
+        return
+    for name in names:
+        state_dir = os.path.join(UPLOAD_STATE_DIR, name)
+        try:
+            if now - os.path.getmtime(state_dir) < UPLOAD_STALE_SECONDS: continue
+        except OSError:
+            continue
+        meta = _load_upload(name)
+        if meta: _discard_upload(meta)
+        else: shutil.rmtree(state_dir, ignore_errors=True)
+        app.logger.info(f"Removed stale upload {name}")
+
+@app.route('/admin/file/upload/init', methods=['POST'])
+def upload_init():
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    cleanup_stale_uploads()
+    data = request.json or {}
+    path = secure_path(data.get('path', ''))
+    if path is None: return jsonify({'error': '非法路径'}), 400
+    if not storage_pool.isdir(path): return jsonify({'error': '目录不存在'}), 404
+    try:
+        size = int(data.get('size', -1))
+        chunk_size = int(data.get('chunk_size') or UPLOAD_DEFAULT_CHUNK_SIZE)
+    except (TypeError, ValueError):
+        return jsonify({'error': '参数错误'}), 400
+    if size < 0 or not (0 < chunk_size <= UPLOAD_MAX_CHUNK_SIZE): return jsonify({'error': '参数错误'}), 400
+    filename = clean_upload_filename(data.get('name', ''))
+
+    # 去重模式下带整文件哈希且内容已存在：直接链接，秒传完成
+    digest = (data.get('sha256') or '').lower()
+    if digest and blob_store.enabled and blob_store.lookup(digest) == size:
+        # 硬链接只能在 blob 所在的文件系统上建，秒传放在主卷
+        save_path = unique_save_path(storage_pool.primary.path(path), filename, digest)
+        if os.path.exists(save_path):
+            return jsonify({'success': True, 'instant': True, 'duplicate': True, 'name': os.path.basename(save_path)})
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        if blob_store.link_existing(digest, save_path):
+            file_index.add(storage_pool.logical(save_path))
+            listing_cache.invalidate(path)
+            return jsonify({'success': True, 'instant': True, 'name': os.path.basename(save_path)})
+
+    # 同一目录、同名、同大小、同指纹 (前端用 lastModified) 的文件得到同一个 upload_id，实现断点续传
+    fingerprint = f"{path}\n{filename}\n{size}\n{chunk_size}\n{data.get('fingerprint', secrets.token_hex(8))}"
+    upload_id = hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+    meta = _load_upload(upload_id)
+    if meta and os.path.exists(meta['part_path']):
+        return jsonify(_upload_status(meta))
+
+    # 分片文件预分配在选中的卷上，完成时原地 rename
+    try:
+        part_path = os.path.join(storage_pool.place(path, size), f".{upload_id}.part")
+    except OSError as e:
+        return jsonify({'error': f"无法写入: {e}"}), 507
+    try:
+        with open(part_path, 'wb') as f:
+            if size and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(f.fileno(), 0, size)
+            else:
+                f.truncate(size)
+    except OSError as e:
+        try: os.remove(part_path)
+        except OSError: pass
+        return jsonify({'error': f"磁盘空间不足或无法写入: {e}"}), 507
+    meta = {
+        'id': upload_id, 'path': path, 'name': filename, 'size': size, 'chunk_size': chunk_size,
+        'total_chunks': -(-size // chunk_size), 'part_path': part_path,
+        'sha256': data.get('sha256'), 'created_at': time.time()
+    }
+    state_dir = _upload_state_dir(upload_id)
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    return jsonify(_upload_status(meta))
+
+@app.route('/admin/file/upload/<upload_id>', methods=['GET'])
+def upload_status(upload_id):
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    meta = _load_upload(upload_id)
+    if not meta: return jsonify({'error': '上传任务不存在或已过期'}), 404
+    return jsonify(_upload_status(meta))
+
+@app.route('/admin/file/upload/<upload_id>', methods=['DELETE'])
+def upload_abort(upload_id):
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    meta = _load_upload(upload_id)
+    if meta: _discard_upload(meta)
+    return jsonify({'success': True})
+
+@app.route('/admin/file/upload/<upload_id>/<int:index>', methods=['PUT'])
+def upload_chunk(upload_id, index):
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    meta = _load_upload(upload_id)
+    if not meta: return jsonify({'error': '上传任务不存在或已过期'}), 404
+    if not 0 <= index < meta['total_chunks']: return jsonify({'error': '分片序号错误'}), 400
+    offset = index * meta['chunk_size']
+    expected = min(meta['chunk_size'], meta['size'] - offset)
+    if (request.content_length or 0) != expected:
+        return jsonify({'error': f"分片大小错误，应为 {expected} 字节"}), 400
+    expected_hash = request.headers.get('X-Chunk-Sha256', '').lower()
+    expected_crc = request.headers.get('X-Chunk-Crc32', '').lower()
+    if not expected_hash and not expected_crc:
+        return jsonify({'error': '缺少分片校验值 (X-Chunk-Crc32)'}), 400
+    digest = hashlib.sha256()
+    crc = 0
+    written = 0
     try:
-        os.makedirs(full_path, exist_ok=False)
-        return jsonify({'success': True})
-    except FileExistsError:
-        return jsonify({'error': '该文件夹已存在'}), 400
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        # 直接读原始请求体写到目标偏移，不经过 Werkzeug 的表单解析和临时文件
+        stream = request.stream
+        with open(meta['part_path'], 'r+b') as f:
+            f.seek(offset)
+            while written < expected:
+                block = stream.read(min(UPLOAD_IO_BLOCK, expected - written))
+                if not block: break
+                f.write(block)
+                digest.update(block)
+                crc = zlib.crc32(block, crc)
+                written += len(block)
+    except OSError as e:
+        app.logger.error(f"Upload Chunk Error: {e}")
+        return jsonify({'error': f"写入失败: {e}"}), 500
+    if written != expected: return jsonify({'error': '分片数据不完整'}), 400
+    chunk_hash, chunk_crc = digest.hexdigest(), f"{crc:08x}"
+    if (expected_hash and expected_hash != chunk_hash) or (expected_crc and expected_crc.zfill(8) != chunk_crc):
+        return jsonify({'error': '分片校验失败'}), 400
+    with open(os.path.join(_upload_state_dir(upload_id), f"{index}.done"), 'w') as f:
+        json.dump({'crc32': chunk_crc, 'sha256': chunk_hash}, f)
+    return jsonify({'success': True, 'index': index, 'sha256': chunk_hash, 'crc32': chunk_crc})
 
-@app.route('/admin/file/upload', methods=['POST'])
-def upload_file():
+@app.route('/admin/file/upload/<upload_id>/complete', methods=['POST'])
+def upload_complete(upload_id):
     if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    meta = _load_upload(upload_id)
+    if not meta: return jsonify({'error': '上传任务不存在或已过期'}), 404
+    received = _received_chunks(upload_id)
+    if len(received) != meta['total_chunks']:
+        return jsonify({'error': '分片未传完', **_upload_status(meta)}), 409
     try:
-        path = secure_path(request.form.get('path', ''))
-        if path is None: return jsonify({'error': '非法路径'}), 400
-        upload_dir = os.path.join(BASE_DIR, path)
-        if not os.path.exists(upload_dir):
-            return jsonify({'error': '目录不存在'}), 404
-        files = request.files.getlist('files')
-        saved_count = 0
-        for file in files:
-            if file and file.filename:
-                filename = os.path.basename(file.filename)
-                filename = filename.replace('..', '').replace('/', '').replace('\\', '')
-                if not filename: filename = f"upload_{int(time.time())}_{secrets.token_hex(4)}"
-                save_path = os.path.join(upload_dir, filename)
-                base, ext = os.path.splitext(filename)
-                counter = 1
-                while os.path.exists(save_path):
-                    save_path = os.path.join(upload_dir, f"{base}_{counter}{ext}")
-                    counter += 1
-                file.save(save_path)
-                saved_count += 1
-        return jsonify({'success': True, 'count': saved_count})
+        if os.path.getsize(meta['part_path']) != meta['size']:
+            return jsonify({'error': '文件大小不一致'}), 409
+        expected_hash = ((request.json or {}).get('sha256') if request.is_json else None) or meta.get('sha256')
+        dedup = blob_store.enabled
+        # 分片是乱序并行到达的，无法边收边算整文件哈希；校验分片时统一读一遍，需要时顺带算出整文件哈希
+        bad_chunk, digest = run_blocking(verify_upload, meta, bool(expected_hash or dedup))
+        if bad_chunk is not None:
+            # 只有这个分片需要重传
+            os.remove(os.path.join(_upload_state_dir(upload_id), f"{bad_chunk}.done"))
+            return jsonify({'error': f"分片 {bad_chunk} 校验失败，请重新上传", **_upload_status(meta)}), 409
+        if expected_hash and digest != expected_hash.lower():
+            _discard_upload(meta)
+            return jsonify({'error': '文件校验失败，请重新上传'}), 400
+        upload_dir = os.path.dirname(meta['part_path'])
+        if dedup:
+            save_path, duplicate = place_deduplicated(meta['part_path'], upload_dir, meta['name'], digest, meta['size'])
+        else:
+            save_path, duplicate = unique_save_path(upload_dir, meta['name']), False
+            os.rename(meta['part_path'], save_path)
+        shutil.rmtree(_upload_state_dir(upload_id), ignore_errors=True)
+        if not duplicate:
+            file_index.add(storage_pool.logical(save_path))
+            listing_cache.invalidate(meta['path'])
+        return jsonify({'success': True, 'name': os.path.basename(save_path), 'duplicate': duplicate})
     except Exception as e:
-        app.logger.error(f"Upload Error: {str(e)}")
+        app.logger.error(f"Upload Complete Error: {str(e)}")
         return jsonify({'error': f"上传出错: {str(e)}"}), 500
 
 @app.route('/admin/file/rename', methods=['POST'])
@@ -364,12 +3473,18 @@ def rename_item():
     new_name = data.get('new_name', '').strip()
     if path is None or not old_name or not new_name: return jsonify({'error': '参数错误'}), 400
     if '..' in new_name or '/' in new_name or '\\' in new_name: return jsonify({'error': '新名称非法'}), 400
-    old_path = os.path.join(BASE_DIR, path, old_name)
-    new_path = os.path.join(BASE_DIR, path, new_name)
-    if not os.path.exists(old_path): return jsonify({'error': '原文件不存在'}), 404
-    if os.path.exists(new_path): return jsonify({'error': '新名称已存在'}), 400
+    old_rel, new_rel = os.path.join(path, old_name), os.path.join(path, new_name)
+    copies = storage_pool.copies(old_rel)
+    if not copies: return jsonify({'error': '原文件不存在'}), 404
+    if storage_pool.exists(new_rel): return jsonify({'error': '新名称已存在'}), 400
     try:
-        os.rename(old_path, new_path)
+        # 文件夹可能分布在多个卷上，每个卷各自原地重命名
+        for volume, old_path in copies:
+            os.rename(old_path, volume.path(new_rel))
+        file_index.move(os.path.join(path, old_name), os.path.join(path, new_name))
+        blob_store.move(os.path.join(path, old_name), os.path.join(path, new_name))
+        listing_cache.invalidate(path)
+        listing_cache.invalidate(os.path.join(path, old_name), recursive=True)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -381,47 +3496,528 @@ def delete_items():
     path = secure_path(data.get('path', ''))
     filenames = data.get('filenames', [])
     if path is None or not filenames: return jsonify({'error': '参数错误'}), 400
+    filenames = [name for name in filenames if '..' not in name and '/' not in name]
+    # 含文件夹的删除可能涉及大量文件，交给后台任务，避免占住请求直到代理超时
+    if any(os.path.isdir(full_path) and not os.path.islink(full_path)
+           for name in filenames for _, full_path in storage_pool.copies(os.path.join(path, name))):
+        job = submit_job('delete', path, filenames)
+        return jsonify({'success': True, 'job_id': job.id})
     success_count = 0
     errors = []
     for name in filenames:
-        if '..' in name or '/' in name: continue
-        full_path = os.path.join(BASE_DIR, path, name)
         try:
-            if os.path.isfile(full_path) or os.path.islink(full_path):
-                os.remove(full_path)
-            elif os.path.isdir(full_path):
-                shutil.rmtree(full_path)
+            for _, full_path in storage_pool.copies(os.path.join(path, name)):
+                if os.path.isfile(full_path) or os.path.islink(full_path):
+                    os.remove(full_path)
+            file_index.remove(os.path.join(path, name))
+            blob_store.remove(os.path.join(path, name))
+            listing_cache.invalidate(os.path.join(path, name), recursive=True)
             success_count += 1
         except Exception as e:
             errors.append(f"{name}: {str(e)}")
+    listing_cache.invalidate(path)
     if errors:
         return jsonify({'success': False, 'msg': f"部分删除失败: {'; '.join(errors)}"})
     return jsonify({'success': True})
 
+# ================= 后台任务 =================
+# 递归删除 / 批量移动 / 批量复制这类耗时操作写入 file_job 表，由后台线程执行，接口立即返回 job_id。
+# 各 worker 都有执行线程，通过 file_lock('jobs') 保证同一时刻只有一个进程在跑任务 (磁盘 IO 串行更快)；
+# 拿到锁时仍处于 running 的任务说明上次执行的进程已退出，未超过重试次数的重新排队 (三种操作都可以重复执行)，
+# 否则标记为 interrupted 供后台查看。
+
+JOB_POLL_INTERVAL = 2
+JOB_PROGRESS_INTERVAL = 0.5
+JOB_MAX_ATTEMPTS = 3
+JOB_FINISHED = ('done', 'failed', 'cancelled', 'interrupted')
+
+class JobCancelled(Exception):
+    pass
+
+def job_to_dict(job):
+    return {
+        'id': job.id, 'kind': job.kind, 'status': job.status, 'path': job.path,
+        'names': json.loads(job.names or '[]'), 'dest': job.dest,
+        'total_items': job.total_items, 'done_items': job.done_items,
+        'total_bytes': job.total_bytes, 'done_bytes': job.done_bytes,
+        'message': job.message, 'attempts': job.attempts,
+        'created_at': job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else None,
+        'finished_at': job.finished_at.strftime('%Y-%m-%d %H:%M:%S') if job.finished_at else None,
+    }
+
+class JobProgress:
+    """累计进度，按 JOB_PROGRESS_INTERVAL 节流写库，同时检查是否被取消"""
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.total_items = self.total_bytes = 0
+        self.done_items = self.done_bytes = 0
+        self._flushed_at = 0
+
+    def set_total(self, items, nbytes=0):
+        self.total_items, self.total_bytes = items, nbytes
+        self.flush()
+
+    def advance(self, items=1, nbytes=0):
+        self.done_items += items
+        self.done_bytes += nbytes
+        if time.time() - self._flushed_at >= JOB_PROGRESS_INTERVAL: self.flush()
+
+    def flush(self, check_cancel=True):
+        self._flushed_at = time.time()
+        table = FileJob.__table__
+        db.session.execute(update(table).where(table.c.id == self.job_id).values(
+            total_items=self.total_items, total_bytes=self.total_bytes,
+            done_items=self.done_items, done_bytes=self.done_bytes))
+        db.session.commit()
+        if check_cancel:
+            cancelled = db.session.execute(
+                db.select(table.c.cancel_requested).where(table.c.id == self.job_id)).scalar()
+            if cancelled: raise JobCancelled()
+
+def _measure(full_path):
+    """返回 (条目数, 字节数)，文件夹本身也算一个条目"""
+    if not os.path.isdir(full_path) or os.path.islink(full_path):
+        try:
+            return 1, os.lstat(full_path).st_size
+        except OSError:
+            return 1, 0
+    items, nbytes = 1, 0
+    for root, dirs, files in os.walk(full_path):
+        items += len(dirs) + len(files)
+        for name in files:
+            try:
+                nbytes += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return items, nbytes
+
+def _delete_tree(full_path, progress):
+    if not os.path.isdir(full_path) or os.path.islink(full_path):
+        size = os.lstat(full_path).st_size
+        os.remove(full_path)
+        progress.advance(1, size)
+        return
+    for root, dirs, files in os.walk(full_path, topdown=False):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                size = os.lstat(path).st_size
+                os.remove(path)
+            except FileNotFoundError:
+                size = 0
+            progress.advance(1, size)
+        for name in dirs:
+            path = os.path.join(root, name)
+            if os.path.islink(path): os.remove(path)
+            else: os.rmdir(path)
+            progress.advance()
+    os.rmdir(full_path)
+    progress.advance()
+
+def _copy_file(src, dst, progress):
+    # 去重存储里已有的内容直接硬链接，不再写一遍
+    digest = blob_store.hash_of(src)
+    if digest and blob_store.link_existing(digest, dst):
+        progress.advance(1, os.path.getsize(dst))
+        return
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        for block in iter(lambda: fsrc.read(UPLOAD_IO_BLOCK), b''):
+            fdst.write(block)
+            progress.advance(0, len(block))
+    shutil.copystat(src, dst)
+    progress.advance(1)
+
+def _copy_or_skip(src, dst, progress):
+    if os.path.exists(dst):
+        # 重试时已复制完整的文件跳过，不完整的重新复制
+        size = os.path.getsize(dst)
+        if size == os.path.getsize(src):
+            progress.advance(1, size)
+            return
+        os.remove(dst)
+    _copy_file(src, dst, progress)
+
+def _copy_tree(src, dst, progress):
+    if not os.path.isdir(src):
+        _copy_or_skip(src, dst, progress)
+        return
+    os.makedirs(dst, exist_ok=True)
+    progress.advance()
+    for root, dirs, files in os.walk(src):
+        rel = os.path.relpath(root, src)
+        target_root = dst if rel == '.' else os.path.join(dst, rel)
+        for name in dirs:
+            os.makedirs(os.path.join(target_root, name), exist_ok=True)
+            progress.advance()
+        for name in files:
+            _copy_or_skip(os.path.join(root, name), os.path.join(target_root, name), progress)
+        shutil.copystat(root, target_root)
+
+def run_delete_job(job, progress):
+    names = json.loads(job.names)
+    # 文件夹在多个卷上都有时逐个删除各卷上的部分
+    targets = {name: [p for _, p in storage_pool.copies(os.path.join(job.path, name))] for name in names}
+    totals = [_measure(p) for paths in targets.values() for p in paths]
+    progress.set_total(sum(t[0] for t in totals), sum(t[1] for t in totals))
+    for name, paths in targets.items():
+        rel_path = os.path.join(job.path, name)
+        if not paths: continue
+        try:
+            for full_path in paths:
+                if os.path.lexists(full_path): _delete_tree(full_path, progress)
+        finally:
+            # 中途取消/出错时子树只删了一部分，索引按实际剩余内容重建
+            file_index.remove(rel_path)
+            if storage_pool.copies(rel_path):
+                file_index.add(rel_path)
+                blob_store.remove(rel_path, only_missing=True)
+            else:
+                blob_store.remove(rel_path)
+            listing_cache.invalidate(rel_path, recursive=True)
+            listing_cache.invalidate(job.path)
+
+class _SilentProgress:
+    def advance(self, items=1, nbytes=0):
+        pass
+
+def _transfer_targets(job):
+    """
+    源名称 -> 目标逻辑路径。目标已存在时与上传一样自动加 _1、_2 后缀；
+    结果在首次执行时写回任务，重启后重试仍写到同一位置，不会再生成新的副本。
+    """
+    if job.targets: mapping = json.loads(job.targets)
+    else:
+        mapping = {}
+        dest_dir = storage_pool.locate(job.dest)
+        for name in json.loads(job.names):
+            mapping[name] = os.path.basename(unique_save_path(dest_dir, name))
+        job.targets = json.dumps(mapping, ensure_ascii=False)
+        db.session.commit()
+    return {name: os.path.join(job.dest, target) for name, target in mapping.items()}
+
+def run_move_job(job, progress):
+    targets = _transfer_targets(job)
+    sources = {name: storage_pool.copies(os.path.join(job.path, name)) for name in targets}
+    totals = {name: [_measure(src) for _, src in copies] for name, copies in sources.items() if copies}
+    progress.set_total(sum(t[0] for ts in totals.values() for t in ts), sum(t[1] for ts in totals.values() for t in ts))
+    for name, new_rel in targets.items():
+        if name not in totals: continue
+        old_rel = os.path.join(job.path, name)
+        renamed = True
+        # 各卷上的部分留在原卷，在卷内移动到目标位置
+        for (volume, src), total in zip(sources[name], totals[name]):
+            if not os.path.lexists(src): continue
+            target = volume.path(new_rel)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                os.rename(src, target)
+            except OSError:
+                # 卷内跨文件系统：先复制 (计入进度) 再删除源
+                _copy_tree(src, target, progress)
+                _delete_tree(src, _SilentProgress())
+                renamed = False
+            else:
+                progress.advance(*total)
+        if renamed:
+            file_index.move(old_rel, new_rel)
+            blob_store.move(old_rel, new_rel)
+        else:
+            file_index.remove(old_rel)
+            blob_store.remove(old_rel)
+            file_index.add(new_rel)
+        listing_cache.invalidate(old_rel, recursive=True)
+        listing_cache.invalidate(job.path)
+        listing_cache.invalidate(job.dest)
+
+def run_copy_job(job, progress):
+    targets = _transfer_targets(job)
+    sources = {name: storage_pool.copies(os.path.join(job.path, name)) for name in targets}
+    totals = {name: [_measure(src) for _, src in copies] for name, copies in sources.items()}
+    progress.set_total(sum(t[0] for ts in totals.values() for t in ts), sum(t[1] for ts in totals.values() for t in ts))
+    for name, new_rel in targets.items():
+        if not sources[name]: continue
+        # 副本整体放到一个按剩余空间选出的卷上 (重试时沿用上次的卷)；源文件夹分布在多个卷时合并复制，同名以前面的卷为准
+        target = storage_pool.locate(new_rel)
+        if not os.path.lexists(target):
+            target = os.path.join(storage_pool.place(job.dest, sum(t[1] for t in totals[name])), os.path.basename(new_rel))
+        try:
+            for _, src in reversed(sources[name]):
+                if os.path.lexists(src): _copy_tree(src, target, progress)
+        finally:
+            if os.path.lexists(target): file_index.add(new_rel)
+            listing_cache.invalidate(job.dest)
+
+JOB_HANDLERS = {'delete': run_delete_job, 'move': run_move_job, 'copy': run_copy_job}
+
+class JobRunner(BackgroundWorker):
+    name = 'file-jobs'
+
+    def _on_start(self):
+        self._wakeup = threading.Event()
+
+    def start(self):
+        self._ensure_started()
+
+    def wake(self):
+        self._ensure_started()
+        self._wakeup.set()
+
+    def _recover(self):
+        for job in FileJob.query.filter_by(status='running').all():
+            if job.cancel_requested:
+                job.status, job.finished_at = 'cancelled', get_beijing_time()
+            elif job.attempts >= JOB_MAX_ATTEMPTS:
+                job.status, job.finished_at = 'interrupted', get_beijing_time()
+                job.message = '服务重启导致任务中断，且已多次重试失败'
+            else:
+                job.status = 'pending'
+                app.logger.info(f"Resuming file job {job.id} ({job.kind}) after restart")
+        db.session.commit()
+
+    def _claim(self):
+        job = FileJob.query.filter_by(status='pending').order_by(FileJob.id).first()
+        if not job: return None
+        job.status = 'running'
+        job.attempts = (job.attempts or 0) + 1
+        job.started_at = get_beijing_time()
+        job.done_items = job.done_bytes = 0
+        db.session.commit()
+        return job
+
+    def _execute_by_id(self, job_id):
+        """磁盘复制/删除是长时间的阻塞 IO，gevent 模式下在线程池里用独立的应用上下文执行"""
+        with app.app_context():
+            self._execute(db.session.get(FileJob, job_id))
+            db.session.remove()
+
+    def _execute(self, job):
+        progress = JobProgress(job.id)
+        status, message = 'done', None
+        try:
+            JOB_HANDLERS[job.kind](job, progress)
+        except JobCancelled:
+            status = 'cancelled'
+        except Exception as e:
+            app.logger.error(f"File job {job.id} ({job.kind}) failed: {e}")
+            status, message = 'failed', str(e)[:500]
+        db.session.rollback()
+        progress.flush(check_cancel=False)
+        job = db.session.get(FileJob, job.id)
+        job.status, job.message, job.finished_at = status, message, get_beijing_time()
+        db.session.commit()
+
+    def _run(self):
+        while True:
+            try:
+                with file_lock('jobs', blocking=False) as locked:
+                    if locked:
+                        with app.app_context():
+                            self._recover()
+                            while True:
+                                job = self._claim()
+                                if not job: break
+                                run_blocking(self._execute_by_id, job.id)
+                            db.session.remove()
+            except Exception as e:
+                app.logger.error(f"Job runner error: {e}")
+            self._wakeup.wait(JOB_POLL_INTERVAL)
+            self._wakeup.clear()
+
+job_runner = JobRunner()
+job_runner.start()
+
+def submit_job(kind, path, names, dest=None):
+    job = FileJob(kind=kind, path=path, names=json.dumps(names, ensure_ascii=False), dest=dest)
+    db.session.add(job)
+    db.session.commit()
+    job_runner.wake()
+    return job
+
+def _parse_transfer_request():
+    """move/copy 共用的参数校验，返回 (path, names, dest) 或 错误响应"""
+    data = request.json or {}
+    path = secure_path(data.get('path', ''))
+    dest = secure_path(data.get('dest', ''))
+    names = [n for n in data.get('filenames', []) if n and '..' not in n and '/' not in n and '\\' not in n]
+    if path is None or dest is None or not names: return None, (jsonify({'error': '参数错误'}), 400)
+    if not storage_pool.isdir(dest): return None, (jsonify({'error': '目标文件夹不存在'}), 404)
+    for name in names:
+        src_rel = os.path.join(path, name).replace('\\', '/').strip('/')
+        if dest == src_rel or dest.startswith(src_rel + '/'):
+            return None, (jsonify({'error': '不能移动/复制到自身或其子文件夹中'}), 400)
+    return (path, names, dest), None
+
+@app.route('/admin/file/move', methods=['POST'])
+def move_items():
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    params, error = _parse_transfer_request()
+    if error: return error
+    path, names, dest = params
+    if dest == path: return jsonify({'error': '目标与当前文件夹相同'}), 400
+    job = submit_job('move', path, names, dest)
+    return jsonify({'success': True, 'job_id': job.id})
+
+@app.route('/admin/file/copy', methods=['POST'])
+def copy_items():
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    params, error = _parse_transfer_request()
+    if error: return error
+    job = submit_job('copy', *params)
+    return jsonify({'success': True, 'job_id': job.id})
+
+@app.route('/admin/jobs')
+def list_jobs():
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    query = FileJob.query
+    if request.args.get('active'): query = query.filter(FileJob.status.in_(('pending', 'running')))
+    jobs = query.order_by(FileJob.id.desc()).limit(50).all()
+    return jsonify([job_to_dict(job) for job in jobs])
+
+@app.route('/admin/jobs/<int:job_id>')
+def job_status(job_id):
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    job = db.session.get(FileJob, job_id)
+    if not job: return jsonify({'error': '任务不存在'}), 404
+    return jsonify(job_to_dict(job))
+
+@app.route('/admin/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    if not session.get('is_admin'): return jsonify({'error': '无权操作'}), 403
+    job = db.session.get(FileJob, job_id)
+    if not job: return jsonify({'error': '任务不存在'}), 404
+    if job.status == 'pending':
+        job.status, job.finished_at = 'cancelled', get_beijing_time()
+    elif job.status == 'running':
+        job.cancel_requested = True
+    db.session.commit()
+    return jsonify({'success': True, 'status': job.status})
+
+# ================= 登录限流 =================
+# 按 IP + 入口 (user / admin) 记录最近的尝试时间，比对口令前先原子地占一次尝试，
+# 滑动窗口内次数达到上限后直接返回 429，不在请求里 sleep 占着 worker。
+# IP 取 get_client_addr()，客户端自己填写的转发头换不出新的限流 key。
+# 记录存在 RUNTIME_DB_FILE，所有 worker 共用。nexus.conf 可配置：
+#   login_max_failures  窗口内允许的失败次数，默认 5
+#   login_window        窗口长度 (秒)，默认 300
+# 登录成功后清空该 IP 在该入口的记录 (包括本次占用的那一次)。
+
+LOGIN_DEFAULT_MAX_FAILURES = 5
+LOGIN_DEFAULT_WINDOW = 300
+LOGIN_CLEANUP_INTERVAL = 600
+
+class LoginThrottle:
+    def __init__(self, db_file=RUNTIME_DB_FILE):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._schema_ready = False
+        self._cleaned_at = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF")
+            if not self._schema_ready:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS login_failures (
+                        scope TEXT NOT NULL,
+                        ip TEXT NOT NULL,
+                        failed_at REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_login_failures ON login_failures(scope, ip, failed_at);
+                ''')
+                self._schema_ready = True
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def limits(self):
+        config = get_config()
+        return (max(1, _config_number(config, 'login_max_failures', LOGIN_DEFAULT_MAX_FAILURES)),
+                max(1, _config_number(config, 'login_window', LOGIN_DEFAULT_WINDOW)))
+
+    def reserve(self, scope, ip):
+        """
+        比对口令之前先占一次尝试：窗口内的记录数和插入在同一个 IMMEDIATE 事务里完成，
+        并发请求不会全部通过检查。返回还需要等待的秒数，0 表示已占到名额可以比对口令。
+        """
+        max_failures, window = self.limits()
+        return run_blocking(self._reserve, scope, ip, time.time(), max_failures, window)
+
+    def _reserve(self, scope, ip, now, max_failures, window):
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT failed_at FROM login_failures WHERE scope = ? AND ip = ? AND failed_at > ? "
+                "ORDER BY failed_at DESC LIMIT ?", (scope, ip, now - window, max_failures)
+            ).fetchall()
+            # 窗口内最早的那次尝试过期后，次数就会回到上限以下
+            if len(rows) >= max_failures: return max(1, math.ceil(rows[-1]['failed_at'] + window - now))
+            conn.execute("INSERT INTO login_failures(scope, ip, failed_at) VALUES (?, ?, ?)", (scope, ip, now))
+            if now - self._cleaned_at >= LOGIN_CLEANUP_INTERVAL:
+                self._cleaned_at = now
+                conn.execute("DELETE FROM login_failures WHERE failed_at < ?", (now - window,))
+        return 0
+
+    def record_failure(self, scope):
+        # 尝试记录已经在 reserve 里写入，这里只计数
+        metrics.inc('nexus_login_failures_total', scope=scope)
+
+    def reset(self, scope, ip):
+        run_blocking(self._delete, scope, ip)
+
+    def _delete(self, scope, ip):
+        conn = self._conn()
+        with conn:
+            conn.execute("DELETE FROM login_failures WHERE scope = ? AND ip = ?", (scope, ip))
+
+login_throttle = LoginThrottle()
+
+def throttled_login_page(scope, retry_after, **page):
+    metrics.inc('nexus_login_throttled_total', scope=scope)
+    flash(f"尝试次数过多，请 {retry_after} 秒后再试", 'error')
+    rv = app.make_response((render_template('login.html', **page), 429))
+    rv.headers['Retry-After'] = str(retry_after)
+    return rv
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
+    page = dict(title="安全访问验证", subtitle="请输入访问口令以继续")
     if request.method == 'POST':
+        ip = get_client_addr()
+        retry_after = login_throttle.reserve('user', ip)
+        if retry_after: return throttled_login_page('user', retry_after, **page)
         input_pwd = request.form.get('password', '').strip()
         config = get_config()
         if input_pwd == config['user_password']:
+            login_throttle.reset('user', ip)
             session['is_verified'] = True
             log_activity('普通用户登录', 'user_login')
             return redirect(request.args.get('next') or '/')
         else:
-            time.sleep(1); flash('访问口令错误', 'error')
-    return render_template('login.html', title="安全访问验证", subtitle="请输入访问口令以继续")
+            login_throttle.record_failure('user')
+            flash('访问口令错误', 'error')
+    return render_template('login.html', **page)
 
 @app.route('/admin/login', methods=['GET', 'POST'])
 def admin_login():
     if session.get('is_admin'): return redirect(url_for('admin_dashboard'))
+    page = dict(title="管理后台验证", subtitle="请输入管理员口令")
     if request.method == 'POST':
+        ip = get_client_addr()
+        retry_after = login_throttle.reserve('admin', ip)
+        if retry_after: return throttled_login_page('admin', retry_after, **page)
         if request.form.get('password', '').strip() == get_config()['admin_password']:
+            login_throttle.reset('admin', ip)
             session['is_admin'] = True
             log_activity('管理员后台登录', 'admin_login')
             return redirect(url_for('admin_dashboard'))
         else:
+            login_throttle.record_failure('admin')
             flash('管理员口令错误', 'error')
-    return render_template('login.html', title="管理后台验证", subtitle="请输入管理员口令")
+    return render_template('login.html', **page)
 
 @app.route('/logout')
 def logout():
@@ -437,45 +4033,41 @@ def logout():
 def admin_dashboard():
     if not session.get('is_admin'): return redirect(url_for('admin_login'))
     
-    page = request.args.get('page', 1, type=int)
     limit = request.args.get('limit', 20, type=int)
-    if limit not in [20, 50, 100]: limit = 20
-    
-    pagination = DownloadLog.query.order_by(DownloadLog.timestamp.desc()).paginate(
-        page=page, per_page=limit, error_out=False
-    )
-    
-    shares = FileShare.query.order_by(FileShare.created_at.desc()).all()
+    if limit not in LOG_PAGE_SIZES: limit = 20
+
+    # 总条数取自计数器 (只在不筛选时显示)，日志按游标翻页
+    stats, total_logs = get_dashboard_stats()
+    log_filter = log_filters(request.args)
+    try:
+        logs = query_logs(log_filter, request.args.get('cursor') or None, limit, request.args.get('dir') == 'prev')
+    except ValueError:
+        flash('无效的筛选时间或页码，已回到第一页', 'error')
+        log_filter = {k: v for k, v in log_filter.items() if k not in ('since', 'until')}
+        logs = query_logs(log_filter, None, limit)
+    logs['total'] = None if log_filter else total_logs
+
+    try:
+        shares = query_shares(request.args.get('share_cursor') or None, newer=request.args.get('share_dir') == 'prev')
+    except ValueError:
+        shares = query_shares()
     now = get_beijing_time()
-    for s in shares: s.is_expired = s.expire_at and s.expire_at < now
-    
-    # 修改：统计逻辑 = 历史归档(SystemStat) + 当前表内统计(DownloadLog)
-    
-    # 1. 下载数
-    current_downloads = DownloadLog.query.filter_by(action='down').count()
-    archived_downloads = get_archived_stat('total_downloads')
-    
-    # 2. 预览数
-    current_views = DownloadLog.query.filter_by(action='view').count()
-    archived_views = get_archived_stat('total_views')
-    
-    # 3. 登录数
-    current_logins = DownloadLog.query.filter(DownloadLog.action.in_(['login', 'user_login'])).count()
-    archived_logins = get_archived_stat('total_logins')
-
-    stats = {
-        'total_downloads': current_downloads + archived_downloads,
-        'total_views': current_views + archived_views,
-        'total_logins': current_logins + archived_logins,
-        'disk': get_disk_usage()
-    }
-    
+    for s in shares['items']: s.is_expired = s.expire_at and s.expire_at < now
+
+    stats['disk'] = get_disk_usage()
+    storage = get_storage_usage()
+    jobs = FileJob.query.order_by(FileJob.id.desc()).limit(20).all()
+    traffic = get_traffic_charts()
+    top_files = get_top_files()
+
     if is_mobile_device():
         return render_template('mobile_admin.html', 
-                             stats=stats, pagination=pagination, 
-                             limit=limit, shares=shares, now=now)
+                             stats=stats, logs=logs, log_filter=log_filter,
+                             limit=limit, shares=shares, now=now, storage=storage, jobs=jobs,
+                             traffic=traffic, top_files=top_files)
     
-    return render_template('admin.html', stats=stats, pagination=pagination, limit=limit, shares=shares, now=now)
+    return render_template('admin.html', stats=stats, logs=logs, log_filter=log_filter, limit=limit, shares=shares,
+                           now=now, storage=storage, jobs=jobs, traffic=traffic, top_files=top_files)
 
 @app.route('/admin/share/create', methods=['POST'])
 def create_share():
@@ -486,7 +4078,7 @@ def create_share():
     file_path = data.get('file_path', '').strip()
     slug = data.get('slug', '').strip()
     duration = data.get('duration')
-    full_path = os.path.join(BASE_DIR, file_path)
+    full_path = storage_pool.locate(file_path)
     if not os.path.exists(full_path) or not os.path.isfile(full_path):
         msg = '文件不存在'
         if request.is_json: return jsonify({'error': msg}), 404
@@ -505,6 +4097,7 @@ def create_share():
         except: pass
     new_share = FileShare(file_path=file_path, slug=slug, expire_at=expire_at)
     db.session.add(new_share); db.session.commit()
+    share_registry.bump()
     share_url = url_for('index', req_path=slug, _external=True)
     if request.is_json: return jsonify({'success': True, 'url': share_url})
     flash(f'分享链接创建成功', 'success')
@@ -529,6 +4122,7 @@ def edit_share():
                 share.expire_at = get_beijing_time() + timedelta(days=int(duration))
             except: pass
     db.session.commit()
+    share_registry.bump()
     flash('分享链接已更新', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -537,6 +4131,7 @@ def delete_share(id):
     if not session.get('is_admin'): abort(403)
     share = FileShare.query.get_or_404(id)
     db.session.delete(share); db.session.commit()
+    share_registry.bump()
     flash('分享链接已删除', 'success')
     return redirect(url_for('admin_dashboard'))
 
@@ -544,49 +4139,28 @@ def delete_share(id):
 @app.route('/<path:req_path>')
 def index(req_path):
     if req_path and '..' not in req_path:
-        share = FileShare.query.filter_by(slug=req_path).first()
+        share = share_registry.get(req_path)
         if share:
-            if share.expire_at and share.expire_at < get_beijing_time(): return "该分享链接已过期", 410
-            full_path = os.path.join(BASE_DIR, share.file_path)
+            if share.is_expired: return "该分享链接已过期", 410
+            full_path = storage_pool.locate(share.file_path)
             if not os.path.exists(full_path): return "原文件已被移动或删除", 404
-            share.downloads += 1
+            ticket, rejected = traffic_control.admit(get_client_addr(), share.id, _file_size(full_path))
+            if rejected: return rejected
+            share_registry.record_download(share.id)
             log_activity(f"[Share] {share.file_path}", 'share_down')
-            return send_from_directory(os.path.dirname(full_path), os.path.basename(full_path), as_attachment=True)
+            return ticket.send(full_path, True)
 
     if not session.get('is_verified'):
         return redirect(url_for('login', next=request.path))
 
     req_path = secure_path(req_path)
     if req_path is None: abort(403)
-    full_path = os.path.join(BASE_DIR, req_path)
+    full_path = storage_pool.locate(req_path)
     if not os.path.exists(full_path): abort(404)
     if os.path.isfile(full_path): return serve_file(req_path, True)
 
-    items = []
-    readme_content = None
-    stats = {'total': 0, 'image': 0, 'video': 0, 'doc': 0}
-    try:
-        with os.scandir(full_path) as it:
-            for entry in it:
-                if entry.name.startswith('.'): continue
-                if entry.name.lower() == 'readme.md':
-                    try:
-                        with open(entry.path, 'r', encoding='utf-8') as f:
-                            readme_content = markdown.markdown(f.read(), extensions=['fenced_code', 'tables'])
-                    except: pass
-                is_dir = entry.is_dir()
-                ftype = 'folder' if is_dir else get_file_type(entry.name)
-                stat = entry.stat()
-                stats['total'] += 1
-                if ftype in stats: stats[ftype] += 1
-                items.append({
-                    'name': entry.name, 'type': ftype, 'is_dir': is_dir,
-                    'size': human_readable_size(stat.st_size) if not is_dir else '-',
-                    'mtime': datetime.fromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M'),
-                    'rel_path': os.path.join(req_path, entry.name).replace('\\', '/').strip('/')
-                })
-    except PermissionError: pass
-    items.sort(key=lambda x: (not x['is_dir'], x['name'].lower()))
+    items, next_cursor, stats, readme_content = get_listing(req_path)
+    items = with_folder_sizes(items)
 
     breadcrumbs = []
     parts = [p for p in req_path.split('/') if p]
@@ -596,32 +4170,101 @@ def index(req_path):
         breadcrumbs.append({'name': p, 'path': curr})
     
     if is_mobile_device():
-        return render_template('mobile_index.html', items=items, breadcrumbs=breadcrumbs, 
+        return render_template('mobile_index.html', items=items, breadcrumbs=breadcrumbs, next_cursor=next_cursor,
                              readme=readme_content, current_path=req_path, stats=stats, is_admin=session.get('is_admin', False))
 
-    return render_template('index.html', items=items, breadcrumbs=breadcrumbs, disk=get_disk_usage(),
+    return render_template('index.html', items=items, breadcrumbs=breadcrumbs, disk=get_disk_usage(), next_cursor=next_cursor,
                            readme=readme_content, stats=stats, current_path=req_path)
 
+def _resolve_listing_dir(req_path):
+    """返回 (规范化的路径, 目录是否存在)，路径非法时为 (None, False)"""
+    req_path = secure_path(req_path)
+    if req_path is None: return None, False
+    return req_path, storage_pool.isdir(req_path)
+
+@app.route('/api/list', defaults={'req_path': ''})
+@app.route('/api/list/<path:req_path>')
+def api_list(req_path):
+    """分页目录列表: ?cursor=&limit=&sort=name|size|mtime|type&order=asc|desc&type=image,video&render=desktop|mobile"""
+    if not session.get('is_verified'): return jsonify({'error': '未登录'}), 401
+    req_path, found = _resolve_listing_dir(req_path)
+    if req_path is None: return jsonify({'error': '非法路径'}), 403
+    if not found: return jsonify({'error': '目录不存在'}), 404
+
+    sort = request.args.get('sort', 'name')
+    if sort not in LISTING_SORTS: return jsonify({'error': '不支持的排序方式'}), 400
+    order = 'desc' if request.args.get('order') == 'desc' else 'asc'
+    types = [t for t in request.args.get('type', '').split(',') if t]
+    limit = max(1, min(request.args.get('limit', LISTING_PAGE_SIZE, type=int), LISTING_MAX_PAGE_SIZE))
+    cursor = request.args.get('cursor') or None
+
+    if sort == 'name' and order == 'asc' and not types and not cursor and limit == LISTING_PAGE_SIZE:
+        items, next_cursor = get_listing(req_path)[:2]
+    else:
+        try:
+            items, next_cursor = list_directory(req_path, sort, order, types, cursor, limit)
+        except ValueError:
+            return jsonify({'error': '无效的游标'}), 400
+
+    items = with_folder_sizes(items)
+    result = {'path': req_path, 'sort': sort, 'order': order, 'items': items, 'next_cursor': next_cursor}
+    render = request.args.get('render')
+    if render in ('desktop', 'mobile'):
+        # 前端无限滚动直接插入服务端渲染的行，保证与首屏模板一致
+        partial = '_mobile_file_rows.html' if render == 'mobile' else '_file_rows.html'
+        result['html'] = render_template(partial, items=items)
+    return jsonify(result)
+
+@app.route('/api/stats', defaults={'req_path': ''})
+@app.route('/api/stats/<path:req_path>')
+def api_list_stats(req_path):
+    if not session.get('is_verified'): return jsonify({'error': '未登录'}), 401
+    req_path, found = _resolve_listing_dir(req_path)
+    if req_path is None: return jsonify({'error': '非法路径'}), 403
+    if not found: return jsonify({'error': '目录不存在'}), 404
+    return jsonify({'path': req_path, 'stats': get_listing_stats(req_path)})
+
 @app.route('/api/search')
 def search():
     if not session.get('is_verified'): return jsonify([])
-    query = request.args.get('q', '').lower()
+    query = request.args.get('q', '').strip().lower()
     if not query: return jsonify([])
+    types = [t for t in request.args.get('type', '').split(',') if t]
+    limit = max(1, min(request.args.get('limit', SEARCH_DEFAULT_LIMIT, type=int), SEARCH_MAX_LIMIT))
+    if not file_index.ready:
+        # 索引首次构建完成前退回到目录遍历
+        with metrics.timer('search_walk'):
+            return jsonify(search_walk(query, types, limit))
     results = []
-    for root, dirs, files in os.walk(BASE_DIR):
-        dirs[:] = [d for d in dirs if not d.startswith('.')]
-        for name in files + dirs:
+    with metrics.timer('search_index'):
+        rows = file_index.search(query, types, limit)
+    for row in rows:
+        is_dir = bool(row['is_dir'])
+        results.append({
+            'name': row['name'], 'is_dir': is_dir, 'type': row['type'],
+            'rel_path': row['path'],
+            'size': human_readable_size(row['size']) if not is_dir else '-'
+        })
+    return jsonify(results)
+
+def search_walk(query, types, limit):
+    results = []
+    for rel_dir, dirs, files in storage_pool.walk(''):
+        cooperate()
+        for entry in files + dirs:
+            name = entry.name
             if query in name.lower():
-                full_path = os.path.join(root, name)
-                is_dir = os.path.isdir(full_path)
+                is_dir = entry.is_dir()
+                ftype = 'folder' if is_dir else get_file_type(name)
+                if types and ftype not in types: continue
                 results.append({
-                    'name': name, 'is_dir': is_dir, 'type': 'folder' if is_dir else get_file_type(name),
-                    'rel_path': os.path.relpath(full_path, BASE_DIR).replace('\\', '/'),
-                    'size': human_readable_size(os.path.getsize(full_path)) if not is_dir else '-'
+                    'name': name, 'is_dir': is_dir, 'type': ftype,
+                    'rel_path': f"{rel_dir}/{name}" if rel_dir else name,
+                    'size': human_readable_size(entry.stat().st_size) if not is_dir else '-'
                 })
-                if len(results) >= 30: break
-        if len(results) >= 30: break
-    return jsonify(results)
+                if len(results) >= limit: break
+        if len(results) >= limit: break
+    return results
 
 @app.route('/download/<path:req_path>')
 def download(req_path): 
@@ -633,13 +4276,847 @@ def view(req_path):
     if not session.get('is_verified'): return redirect(url_for('login'))
     return serve_file(req_path, False)
 
+# ================= 文件发送 =================
+# 鉴权、外链过期检查和日志都在应用里做完，真正的字节传输可以交给前置的 nginx / Apache：
+#   nexus.conf: serve_mode=x-accel   (nginx X-Accel-Redirect)
+#               serve_mode=x-sendfile (Apache mod_xsendfile / lighttpd X-Sendfile)
+#               serve_mode=direct     (默认，由 Python 直接发送)
+# x-accel 需要在 nginx 中配置对应的 internal location，例如：
+#   location /_protected/ { internal; alias /app/shares/; }
+# 前缀可用 accel_prefix 修改，默认 /_protected/。存储池里的其他卷各用一个 <前缀>-<卷名>/ 的 location：
+#   location /_protected-disk2/ { internal; alias /mnt/disk2/; }
+
+SEND_MAX_RANGES = 16
+SEND_BLOCK_SIZE = 256 * 1024
+
+def get_serve_mode():
+    config = get_config()
+    return config.get('serve_mode', 'direct').strip().lower(), config.get('accel_prefix', '/_protected/')
+
+def _content_disposition(filename, as_attachment):
+    kind = 'attachment' if as_attachment else 'inline'
+    ascii_name = filename.encode('ascii', 'ignore').decode('ascii').replace('"', '') or 'download'
+    return f"{kind}; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"
+
+def _file_chunks(full_path, ranges):
+    """按 (start, stop) 区间依次读取文件；ranges 为 None 时读取整个文件"""
+    with open(full_path, 'rb') as f:
+        for start, stop in ranges:
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                block = f.read(min(SEND_BLOCK_SIZE, remaining))
+                if not block: return
+                remaining -= len(block)
+                yield block
+                cooperate()
+
+def _parse_ranges(size):
+    """解析多段 Range，返回排序合并后的 [(start, stop)]；不可满足时返回 []"""
+    ranges = []
+    for start, stop in request.range.ranges[:SEND_MAX_RANGES]:
+        if stop is None:
+            stop = size
+            if start < 0: start = max(0, size + start)
+        stop = min(stop, size)
+        if 0 <= start < stop: ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def _if_range_ok(rv):
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == rv.get_etag()[0]
+    if if_range.date:
+        return rv.last_modified is not None and rv.last_modified <= if_range.date
+    return True
+
+def _send_multi_range(rv, full_path, size):
+    """
+    werkzeug 只支持单段 Range (多段会直接返回 416)，这里补上 multipart/byteranges。
+    rv 是未做条件处理的完整响应，沿用它的 ETag / Last-Modified / Content-Disposition。
+    """
+    rv.make_conditional(request.environ)
+    if rv.status_code != 200 or not _if_range_ok(rv):
+        return rv
+    ranges = _parse_ranges(size)
+    rv.close()
+    if not ranges:
+        rv = app.response_class(status=416)
+        rv.headers['Content-Range'] = f"bytes */{size}"
+        return rv
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        rv.response = _file_chunks(full_path, ranges)
+        rv.status_code = 206
+        rv.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{size}"
+        rv.content_length = stop - start
+        rv.direct_passthrough = False
+        return rv
+    boundary = secrets.token_hex(16)
+    content_type = rv.mimetype or 'application/octet-stream'
+    part_headers = [
+        (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+         f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode('ascii')
+        for start, stop in ranges
+    ]
+    closing = f"--{boundary}--\r\n".encode('ascii')
+
+    def generate():
+        for header, rng in zip(part_headers, ranges):
+            yield header
+            yield from _file_chunks(full_path, [rng])
+            yield b"\r\n"
+        yield closing
+
+    rv.response = generate()
+    rv.direct_passthrough = False
+    rv.status_code = 206
+    rv.content_length = sum(len(h) + (stop - start) + 2 for h, (start, stop) in zip(part_headers, ranges)) + len(closing)
+    rv.headers['Content-Type'] = f"multipart/byteranges; boundary={boundary}"
+    return rv
+
+def send_shared_file(full_path, as_attachment, download_name=None):
+    """
+    发送存储池里的文件 (full_path 为实际路径)。支持 ETag / Last-Modified / 304、单段和多段 Range，
+    按 serve_mode 可交给前置服务器传输。
+    """
+    volume = storage_pool.volume_of(full_path)
+    if volume is None or not os.path.isfile(full_path): abort(404)
+    download_name = download_name or os.path.basename(full_path)
+    mode, accel_prefix = get_serve_mode()
+    # 文件原样发送 (Range / 断点续传按原始字节计算)，不做动态压缩
+    g.skip_compression = True
+
+    if mode in ('x-accel', 'x-sendfile'):
+        rv = app.response_class()
+        if mode == 'x-accel':
+            prefix = accel_prefix.rstrip('/')
+            if volume is not storage_pool.primary: prefix += '-' + volume.name
+            rel_path = os.path.relpath(full_path, volume.root).replace('\\', '/')
+            rv.headers['X-Accel-Redirect'] = prefix + '/' + quote(rel_path)
+        else:
+            rv.headers['X-Sendfile'] = full_path
+        rv.headers['Content-Type'] = mimetypes.guess_type(download_name)[0] or 'application/octet-stream'
+        rv.headers['Content-Disposition'] = _content_disposition(download_name, as_attachment)
+        metrics.inc('nexus_offloaded_bytes_total', os.path.getsize(full_path), mode=mode)
+        return rv
+
+    directory, filename = os.path.dirname(full_path), os.path.basename(full_path)
+    rng = request.range
+    if rng and rng.units == 'bytes' and len(rng.ranges) > 1:
+        rv = send_from_directory(directory, filename, as_attachment=as_attachment,
+                                 download_name=download_name, conditional=False)
+        return _send_multi_range(rv, full_path, os.path.getsize(full_path))
+    return send_from_directory(directory, filename, as_attachment=as_attachment, download_name=download_name)
+
+# ================= 流量控制 =================
+# 文件下载 (/download、/view、外链、打包下载) 开始前先领一个传输名额，nexus.conf 可配置：
+#   limit_ip_transfers  每个 IP 同时进行的传输数，默认 0 不限 (小于 TRAFFIC_SLOT_MIN_BYTES 的文件不计)；
+#                       同一出口 IP 后面可能是整个办公室，开启时不要设得太小
+#   limit_ip_rate       每个 IP 的总带宽 (字节/秒，可写 512K / 20M)，默认不限
+#   limit_share_rate    每个外链的总带宽，默认不限
+#   limit_burst         令牌桶容量，按几秒的带宽计，默认 2
+# 名额和令牌桶存在 RUNTIME_DB_FILE，所有 worker 共用；worker 崩溃遗留的名额按进程是否存活清理。
+# 按 get_client_addr() 计数，不采信客户端自己填的 X-Forwarded-For / CF-Connecting-IP。
+# 超限时立即返回 429 (IP 超限) / 503 (外链超限) 并带 Retry-After，不占着 worker 排队。
+# 带宽按块扣令牌，不够时 sleep 限速；欠账超过 TRAFFIC_MAX_DEBT 秒说明已经很拥挤，新的传输直接拒绝。
+# serve_mode=x-accel 时字节由 nginx 发送，改为用 X-Accel-Limit-Rate 限制单个连接的速度，
+# 同一 IP 的连接数需要在 nginx 里用 limit_conn 控制。
+
+TRAFFIC_DEFAULT_IP_TRANSFERS = 0
+TRAFFIC_DEFAULT_BURST = 2
+TRAFFIC_MAX_DEBT = 1.0
+TRAFFIC_RETRY_AFTER = 5
+TRAFFIC_SLOT_MIN_BYTES = 1024 * 1024  # 小文件一瞬间就发完，不占并发名额
+TRAFFIC_MIN_STEP = 64 * 1024
+TRAFFIC_MAX_STEP = 1024 * 1024
+TRAFFIC_BUCKET_IDLE = 3600
+TRAFFIC_CLEANUP_INTERVAL = 600
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+def parse_byte_size(value, default=0):
+    """'512K' / '20M' / '1.5G' / 纯数字 -> 字节数，无法解析时返回 default"""
+    text_value = str(value or '').strip().upper().rstrip('B').rstrip('I')
+    if not text_value: return default
+    try:
+        if text_value[-1] in SIZE_UNITS:
+            return int(float(text_value[:-1]) * SIZE_UNITS[text_value[-1]])
+        return int(float(text_value))
+    except ValueError:
+        return default
+
+def _process_tag(pid):
+    """pid + 进程启动时间，容器重启后 pid 被复用也不会把旧名额当成仍在使用；没有 /proc 时返回 None"""
+    try:
+        with open(f"/proc/{pid}/stat", 'rb') as f:
+            return f"{pid}:{f.read().rsplit(b')', 1)[1].split()[19].decode()}"
+    except (OSError, IndexError):
+        return None
+
+def _file_size(full_path):
+    try:
+        return os.path.getsize(full_path)
+    except OSError:
+        return None
+
+def _call_after_close(iterable, callback):
+    close = getattr(iterable, 'close', None)
+
+    def closed():
+        try:
+            if close: close()
+        finally:
+            callback()
+    try:
+        iterable.close = closed
+    except AttributeError:
+        return ClosingIterator(iterable, callback)
+    return iterable
+
+class TransferTicket:
+    """一次传输占用的名额和要扣费的令牌桶，响应发送完 (或连接断开) 时释放"""
+
+    def __init__(self, control, slot, buckets, burst):
+        self.control = control
+        self.slot = slot
+        self.buckets = buckets
+        self.burst = burst
+        slowest = min((rate for _, rate in buckets), default=0)
+        self.step = max(TRAFFIC_MIN_STEP, min(TRAFFIC_MAX_STEP, slowest // 4))
+        self._released = False
+        metrics.gauge_add('nexus_transfers_in_flight', 1)
+
+    def release(self):
+        if self._released: return
+        self._released = True
+        metrics.gauge_add('nexus_transfers_in_flight', -1)
+        if self.slot is not None:
+            run_blocking(self.control.release, self.slot)
+
+    def shape(self, chunks):
+        """边发送边扣令牌，令牌不足时按欠账 sleep"""
+        pending = 0
+        try:
+            for chunk in chunks:
+                pending += len(chunk)
+                if pending >= self.step:
+                    self._throttle(pending)
+                    pending = 0
+                yield chunk
+        finally:
+            close = getattr(chunks, 'close', None)
+            if close: close()
+            self.release()
+
+    def _throttle(self, nbytes):
+        wait = run_blocking(self.control.take, self.buckets, nbytes, self.burst)
+        if wait > 0:
+            metrics.inc('nexus_traffic_throttled_seconds_total', wait)
+            time.sleep(wait)
+
+    def attach(self, rv):
+        """给响应挂上限速和释放回调"""
+        if self.buckets and 'X-Accel-Redirect' in rv.headers:
+            rv.headers['X-Accel-Limit-Rate'] = str(min(rate for _, rate in self.buckets))
+        if 'X-Accel-Redirect' in rv.headers or 'X-Sendfile' in rv.headers \
+                or request.method == 'HEAD' or rv.status_code not in (200, 206):
+            # 没有响应体要由本进程发送 (交给前置服务器 / HEAD / 304 / 416)
+            self.release()
+        elif self.buckets:
+            rv.response = self.shape(rv.response)
+            rv.direct_passthrough = False
+        elif rv.direct_passthrough:
+            # 直接透传的文件迭代器不经过 Response.close，释放挂到它自己的 close 上 (保留 sendfile)
+            rv.response = _call_after_close(rv.response, self.release)
+        else:
+            rv.call_on_close(self.release)
+        return rv
+
+    def send(self, full_path, as_attachment):
+        try:
+            rv = send_shared_file(full_path, as_attachment)
+        except Exception:
+            self.release()
+            raise
+        return self.attach(rv)
+
+class TrafficControl:
+    def __init__(self, db_file=RUNTIME_DB_FILE):
+        self.db_file = db_file
+        self._local = threading.local()
+        self._schema_ready = False
+        self._cleaned_at = 0
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_file, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            # 只是运行时状态，丢了也无妨，不需要每次提交都刷盘
+            conn.execute("PRAGMA synchronous=OFF")
+            if not self._schema_ready:
+                conn.executescript('''
+                    CREATE TABLE IF NOT EXISTS transfers (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        ip TEXT NOT NULL,
+                        share_id INTEGER,
+                        pid INTEGER NOT NULL,
+                        owner TEXT NOT NULL,
+                        started_at REAL NOT NULL
+                    );
+                    CREATE INDEX IF NOT EXISTS idx_transfers_ip ON transfers(ip);
+                    CREATE TABLE IF NOT EXISTS buckets (
+                        key TEXT PRIMARY KEY,
+                        tokens REAL NOT NULL,
+                        updated_at REAL NOT NULL
+                    );
+                ''')
+                self._schema_ready = True
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def limits(self):
+        config = get_config()
+        return {
+            'ip_transfers': _config_number(config, 'limit_ip_transfers', TRAFFIC_DEFAULT_IP_TRANSFERS),
+            'ip_rate': parse_byte_size(config.get('limit_ip_rate')),
+            'share_rate': parse_byte_size(config.get('limit_share_rate')),
+            'burst': max(0.1, _config_number(config, 'limit_burst', TRAFFIC_DEFAULT_BURST, float)),
+        }
+
+    def admit(self, ip, share_id=None, size=None):
+        """size 为待发送文件的大小 (未知时为 None)。返回 (ticket, None)；超限时返回 (None, 429/503 响应)"""
+        limits = self.limits()
+        buckets = []
+        if limits['ip_rate'] > 0: buckets.append((f"ip:{ip}", limits['ip_rate']))
+        if share_id is not None and limits['share_rate'] > 0: buckets.append((f"share:{share_id}", limits['share_rate']))
+        if buckets:
+            self._cleanup()
+            for key, rate in buckets:
+                debt = self._debt_seconds(key, rate, limits['burst'])
+                if debt > TRAFFIC_MAX_DEBT:
+                    return None, self._reject('share_rate' if key.startswith('share:') else 'ip_rate', debt)
+        slot = None
+        if limits['ip_transfers'] > 0 and (size is None or size >= TRAFFIC_SLOT_MIN_BYTES):
+            slot = run_blocking(self._acquire, ip, share_id, limits['ip_transfers'])
+            if slot is None:
+                return None, self._reject('ip_transfers', TRAFFIC_RETRY_AFTER)
+        return TransferTicket(self, slot, buckets, limits['burst']), None
+
+    def _reject(self, reason, retry_after):
+        metrics.inc('nexus_traffic_rejected_total', reason=reason)
+        if reason == 'share_rate':
+            rv = app.response_class("该分享链接当前下载人数过多，请稍后再试", status=503, mimetype='text/plain')
+        else:
+            rv = app.response_class("下载请求过于频繁，请稍后再试", status=429, mimetype='text/plain')
+        rv.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return rv
+
+    def _acquire(self, ip, share_id, max_transfers):
+        pid = os.getpid()
+        conn = self._conn()
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            active = conn.execute("SELECT COUNT(*) FROM transfers WHERE ip = ?", (ip,)).fetchone()[0]
+            if active >= max_transfers and self._purge_dead(conn):
+                active = conn.execute("SELECT COUNT(*) FROM transfers WHERE ip = ?", (ip,)).fetchone()[0]
+            if active >= max_transfers: return None
+            return conn.execute(
+                "INSERT INTO transfers(ip, share_id, pid, owner, started_at) VALUES (?, ?, ?, ?, ?)",
+                (ip, share_id, pid, _process_tag(pid) or str(pid), time.time())
+            ).lastrowid
+
+    def _purge_dead(self, conn):
+        """删除已退出 worker 遗留的名额，返回删除的行数"""
+        dead = [row['owner'] for row in conn.execute("SELECT DISTINCT pid, owner FROM transfers")
+                if ':' in row['owner'] and _process_tag(row['pid']) != row['owner']]
+        if not dead: return 0
+        return conn.execute(f"DELETE FROM transfers WHERE owner IN ({','.join('?' * len(dead))})", dead).rowcount
+
+    def release(self, slot):
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM transfers WHERE id = ?", (slot,))
+        except sqlite3.Error as e:
+            app.logger.error(f"Transfer slot release error: {e}")
+
+    def _debt_seconds(self, key, rate, burst):
+        row = self._conn().execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+        if not row: return 0
+        tokens = min(rate * burst, row['tokens'] + max(0, time.time() - row['updated_at']) * rate)
+        return -tokens / rate if tokens < 0 else 0
+
+    def take(self, buckets, nbytes, burst):
+        """从各个令牌桶扣掉 nbytes，返回需要等待的秒数 (取最慢的桶)"""
+        now = time.time()
+        wait = 0
+        conn = self._conn()
+        with conn:
+            for key, rate in buckets:
+                capacity = rate * burst
+                conn.execute('''
+                    INSERT INTO buckets(key, tokens, updated_at) VALUES (?, ?, ?)
+                    ON CONFLICT(key) DO UPDATE SET
+                        tokens = min(?, tokens + max(0, excluded.updated_at - updated_at) * ?) - ?,
+                        updated_at = max(updated_at, excluded.updated_at)
+                ''', (key, capacity - nbytes, now, capacity, rate, nbytes))
+                tokens = conn.execute("SELECT tokens FROM buckets WHERE key = ?", (key,)).fetchone()[0]
+                if tokens < 0: wait = max(wait, -tokens / rate)
+        return wait
+
+    def _cleanup(self):
+        """闲置超过 TRAFFIC_BUCKET_IDLE 的桶早已回满，删掉等价于重新开始"""
+        now = time.time()
+        if now - self._cleaned_at < TRAFFIC_CLEANUP_INTERVAL: return
+        self._cleaned_at = now
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - TRAFFIC_BUCKET_IDLE,))
+        except sqlite3.Error as e:
+            app.logger.error(f"Traffic bucket cleanup error: {e}")
+
+traffic_control = TrafficControl()
+
+# ================= 打包下载 =================
+# 文件夹 / 多选文件边读边压缩成 ZIP 流式输出：不落临时文件，内存占用只有一个读块。
+# 已经压缩过的类型 (压缩包、视频、图片) 直接存储，不再二次压缩。
+
+ZIP_STORED_TYPES = ('archive', 'video', 'image')
+ZIP_BLOCK_SIZE = 1024 * 1024
+
+class _ZipStream(io.RawIOBase):
+    """zipfile 的只写输出，不可 seek (zipfile 会改用 data descriptor)，写入的数据由生成器取走"""
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+def iter_archive_entries(base_rel, names):
+    """
+    展开要打包的条目，返回 (完整路径, 包内路径, 是否文件夹)。
+    base_rel 为所在目录，names 为其中选中的名称；文件夹递归展开，跳过隐藏文件。
+    """
+    for name in names:
+        rel_path = os.path.join(base_rel, name).replace('\\', '/').strip('/')
+        full_path = storage_pool.locate(rel_path)
+        if os.path.isfile(full_path):
+            yield full_path, name, False
+        elif os.path.isdir(full_path):
+            yield full_path, name + '/', True
+            # 按逻辑路径遍历，文件夹分布在多个卷上时合并打包
+            for rel_dir, dirs, files in storage_pool.walk(rel_path):
+                dirs.sort(key=lambda e: e.name)
+                rel_root = os.path.relpath(rel_dir, base_rel or '.').replace('\\', '/')
+                for d in dirs:
+                    yield d.path, f"{rel_root}/{d.name}/", True
+                for f in sorted(files, key=lambda e: e.name):
+                    yield f.path, f"{rel_root}/{f.name}", False
+
+def generate_zip(entries):
+    out = _ZipStream()
+    with zipfile.ZipFile(out, 'w', allowZip64=True) as zf:
+        for full_path, arcname, is_dir in entries:
+            try:
+                info = zipfile.ZipInfo.from_file(full_path, arcname)
+                if is_dir:
+                    zf.writestr(info, b'')
+                    continue
+                stored = get_file_type(arcname) in ZIP_STORED_TYPES
+                info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+                with open(full_path, 'rb') as src, zf.open(info, 'w') as dest:
+                    for block in iter(lambda: src.read(ZIP_BLOCK_SIZE), b''):
+                        dest.write(block)
+                        data = out.take()
+                        if data: yield data
+                        cooperate()
+            except OSError as e:
+                # 打包过程中文件被删除/无权限，跳过该文件继续
+                app.logger.warning(f"Zip skip {arcname}: {e}")
+            data = out.take()
+            if data: yield data
+    yield out.take()
+
+@app.route('/archive', methods=['POST'])
+@app.route('/archive/<path:req_path>', methods=['GET'])
+def download_archive(req_path=None):
+    """GET /archive/<文件夹> 打包整个文件夹；POST path + filenames (表单或 JSON) 打包选中的条目"""
+    if not session.get('is_verified'): return redirect(url_for('login'))
+    if req_path is not None:
+        req_path = secure_path(req_path)
+        if not req_path: abort(403)
+        base_rel, names = os.path.dirname(req_path), [os.path.basename(req_path)]
+        archive_name = os.path.basename(req_path)
+    else:
+        data = request.json if request.is_json else request.form
+        base_rel = secure_path(data.get('path', ''))
+        names = data.get('filenames') if request.is_json else request.form.getlist('filenames')
+        if base_rel is None or not names: abort(400)
+        names = [n for n in names if n and '..' not in n and '/' not in n and '\\' not in n]
+        if not names: abort(400)
+        archive_name = names[0] if len(names) == 1 else (os.path.basename(base_rel) or '全部文件')
+    if not storage_pool.isdir(base_rel): abort(404)
+    if not any(storage_pool.exists(os.path.join(base_rel, n)) for n in names): abort(404)
+    ticket, rejected = traffic_control.admit(get_client_addr())
+    if rejected: return rejected
+
+    log_activity(f"[ZIP] {'/'.join(filter(None, [base_rel, names[0]]))}"
+                 + (f" 等 {len(names)} 项" if len(names) > 1 else ''), 'down')
+    chunks = count_streamed_bytes(generate_zip(iter_archive_entries(base_rel, names)), 'download_archive')
+    rv = app.response_class(chunks, mimetype='application/zip')
+    rv.headers['Content-Disposition'] = _content_disposition(f"{archive_name}.zip", True)
+    rv.headers['X-Accel-Buffering'] = 'no'
+    return ticket.attach(rv)
+
+# ================= 缩略图 / 预览图 =================
+# 图片缩略图 (Pillow)、视频首帧 (ffmpeg)、PDF 首页 (pdftoppm) 在独立的进程池中生成，
+# 不占用请求 worker 的 CPU。结果按 路径 + mtime + 大小 + 规格 作为 key 存在 DATA_DIR/thumbs，
+# 总大小超过上限时按最近访问时间淘汰。URL 带 mtime 版本号，可以长期缓存。
+
+THUMB_DIR = os.path.join(DATA_DIR, 'thumbs')
+THUMB_SIZES = {'thumb': 256, 'preview': 1280}
+THUMB_WORKERS = 2
+THUMB_WAIT_SECONDS = 3
+THUMB_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+THUMB_EVICT_INTERVAL = 300
+THUMB_MAX_AGE = 365 * 24 * 3600
+FFMPEG_BIN = shutil.which('ffmpeg')
+PDFTOPPM_BIN = shutil.which('pdftoppm')
+
+os.makedirs(THUMB_DIR, exist_ok=True)
+
+def thumbnail_supported(name):
+    ext = os.path.splitext(name)[1].lower()
+    ftype = get_file_type(name)
+    if ftype == 'image': return Image is not None and ext != '.svg'
+    if ftype == 'video': return FFMPEG_BIN is not None and Image is not None
+    if ext == '.pdf': return PDFTOPPM_BIN is not None and Image is not None
+    return False
+
+def _render_thumbnail(src, dest, size):
+    """在进程池中执行：生成 JPEG 缩略图到 dest，返回是否成功"""
+    ext = os.path.splitext(src)[1].lower()
+    tmp_frame = None
+    tmp = f"{dest}.{os.getpid()}.tmp"
+    try:
+        if get_file_type(src) == 'video' or ext == '.pdf':
+            tmp_frame = f"{dest}.{os.getpid()}.frame"
+            if ext == '.pdf':
+                cmd = [PDFTOPPM_BIN, '-jpeg', '-singlefile', '-f', '1', '-l', '1', '-scale-to', str(size), src, tmp_frame]
+                tmp_frame += '.jpg'
+            else:
+                # thumbnail 滤镜从开头若干帧中挑一张有代表性的，避免黑屏首帧
+                cmd = [FFMPEG_BIN, '-v', 'error', '-y', '-i', src, '-frames:v', '1',
+                       '-vf', f"thumbnail,scale='min({size},iw)':-2", '-f', 'image2', tmp_frame]
+            subprocess.run(cmd, timeout=60, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            src = tmp_frame
+        with Image.open(src) as img:
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((size, size))
+            if img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+            img.save(tmp, 'JPEG', quality=82, optimize=True)
+        os.replace(tmp, dest)
+        return True
+    except Exception:
+        return False
+    finally:
+        if tmp_frame and os.path.exists(tmp_frame): os.remove(tmp_frame)
+        # 保存或 rename 失败时不留下半成品 (淘汰统计看不到它)
+        if os.path.exists(tmp): os.remove(tmp)
+
+class ThumbnailService:
+    def __init__(self, cache_dir=THUMB_DIR, max_bytes=THUMB_CACHE_MAX_BYTES, workers=THUMB_WORKERS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.workers = workers
+        self._pool = None
+        self._pool_pid = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._next_evict = 0
+
+    def _executor(self):
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+            self._pool_pid = os.getpid()
+            self._inflight = {}
+        return self._pool
+
+    def cache_path(self, rel_path, st, size_name):
+        key = hashlib.sha1(f"{rel_path}\0{st.st_mtime_ns}\0{st.st_size}\0{size_name}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.jpg")
+
+    def get(self, full_path, rel_path, size_name, wait=THUMB_WAIT_SECONDS):
+        """
+        返回缓存文件路径；生成失败返回 None；
+        等待超时抛出 concurrent.futures.TimeoutError (后台继续生成)。
+        """
+        st = os.stat(full_path)
+        dest = self.cache_path(rel_path, st, size_name)
+        if os.path.exists(dest):
+            return dest
+        with self._lock:
+            future = self._inflight.get(dest)
+            if future is None:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                future = self._executor().submit(_render_thumbnail, full_path, dest, THUMB_SIZES[size_name])
+                self._inflight[dest] = future
+                future.add_done_callback(lambda f, d=dest: self._done(d))
+        ok = future.result(timeout=wait)
+        return dest if ok else None
+
+    def _done(self, dest):
+        with self._lock:
+            self._inflight.pop(dest, None)
+        if time.time() >= self._next_evict:
+            self._next_evict = time.time() + THUMB_EVICT_INTERVAL
+            threading.Thread(target=self.evict, name='thumb-evict', daemon=True).start()
+
+    def evict(self):
+        """缓存超过上限时，按访问时间从旧到新删除，降到上限的 90%"""
+        with file_lock('thumbs', blocking=False) as locked:
+            if not locked: return
+            files, total = [], 0
+            for root, _, names in os.walk(self.cache_dir):
+                for name in names:
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((max(st.st_atime, st.st_mtime), st.st_size, path))
+                    total += st.st_size
+            if total <= self.max_bytes: return
+            files.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in files:
+                if total <= target: break
+                try:
+                    os.remove(path)
+                    total -= size
+                except OSError:
+                    pass
+
+thumbnail_service = ThumbnailService()
+
+@app.route('/thumb/<path:req_path>')
+def thumbnail(req_path):
+    if not session.get('is_verified'): abort(403)
+    req_path = secure_path(req_path)
+    if req_path is None: abort(403)
+    full_path = storage_pool.locate(req_path)
+    if not os.path.isfile(full_path) or not thumbnail_supported(full_path): abort(404)
+    size_name = request.args.get('size', 'thumb')
+    if size_name not in THUMB_SIZES: abort(400)
+    try:
+        cached = thumbnail_service.get(full_path, req_path, size_name)
+    except concurrent.futures.TimeoutError:
+        rv = app.response_class('生成中', status=503)
+        rv.headers['Retry-After'] = '2'
+        return rv
+    if not cached: abort(404)
+    rv = send_file(cached, mimetype='image/jpeg', max_age=THUMB_MAX_AGE, conditional=True)
+    rv.headers['Cache-Control'] = f"private, max-age={THUMB_MAX_AGE}, immutable"
+    return rv
+
+# ================= 文本预览 =================
+# 代码/文本类文件只读一个字节窗口 (开头 / 结尾 / 指定偏移)，窗口对齐到整行，前端滚动时再取下一段。
+# 编码根据开头一小段样本判断。小文件整篇渲染 (Markdown / 代码高亮)，结果按 路径 + mtime + 大小 缓存。
+
+PREVIEW_WINDOW = 64 * 1024
+PREVIEW_MAX_WINDOW = 1024 * 1024
+PREVIEW_SAMPLE = 16 * 1024
+PREVIEW_RENDER_MAX = 256 * 1024
+PREVIEW_CACHE_MAX_BYTES = 32 * 1024 * 1024
+PREVIEW_HIGHLIGHT_STYLE = 'monokai'
+PREVIEW_BOMS = ((b'\xef\xbb\xbf', 'utf-8'), (b'\xff\xfe', 'utf-16-le'), (b'\xfe\xff', 'utf-16-be'))
+
+def detect_encoding(sample):
+    """返回 (编码, BOM 长度)；看起来是二进制文件时返回 (None, 0)"""
+    for bom, encoding in PREVIEW_BOMS:
+        if sample.startswith(bom): return encoding, len(bom)
+    if b'\0' in sample: return None, 0
+    for encoding in ('utf-8', 'gb18030'):
+        try:
+            # 样本末尾可能截断了一个多字节字符，用增量解码器忽略结尾
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding, 0
+        except UnicodeDecodeError:
+            continue
+    return 'latin-1', 0
+
+def _find_newline(data, newline, reverse=False):
+    """查找换行符；UTF-16 的换行符必须落在两字节边界上"""
+    unit = len(newline)
+    pos = data.rfind(newline) if reverse else data.find(newline)
+    while pos != -1 and pos % unit:
+        pos = data.rfind(newline, 0, pos) if reverse else data.find(newline, pos + 1)
+    return pos
+
+def read_text_window(full_path, size, encoding, bom, start, stop):
+    """
+    读取 [start, stop) 并收缩到整行：开头跳过被截断的半行，结尾退回到最后一个换行符。
+    一行比窗口还长时保留原始范围 (半行)。返回 (实际起点, 实际终点, 文本)。
+    """
+    newline = '\n'.encode(encoding)
+    unit = len(newline)
+    start = max(bom, start - (start - bom) % unit)
+    stop = max(start, min(size, stop - (stop - bom) % unit))
+    with open(full_path, 'rb') as f:
+        at_line_start = start == bom
+        if not at_line_start:
+            f.seek(start - unit)
+            at_line_start = f.read(unit) == newline
+        f.seek(start)
+        data = f.read(stop - start)
+    head, tail = 0, len(data)
+    if not at_line_start:
+        pos = _find_newline(data, newline)
+        if pos != -1: head = pos + unit
+    if stop < size:
+        pos = _find_newline(data, newline, reverse=True)
+        if pos != -1 and pos + unit > head: tail = pos + unit
+    if tail <= head: head, tail = 0, len(data)
+    return start + head, start + tail, data[head:tail].decode(encoding, errors='replace')
+
+def render_text_preview(name, text):
+    """整篇渲染：Markdown 转 HTML，其他代码文件用 Pygments 高亮 (未安装时返回 None，前端按纯文本显示)"""
+    if name.lower().endswith('.md'):
+        return 'markdown', markdown.markdown(text, extensions=['fenced_code', 'tables'])
+    if pygments is None or name.lower().endswith('.txt'): return None, None
+    try:
+        lexer = get_lexer_for_filename(name, stripnl=False)
+    except PygmentsClassNotFound:
+        return None, None
+    return 'highlight', pygments.highlight(text, lexer, HtmlFormatter(style=PREVIEW_HIGHLIGHT_STYLE, noclasses=True))
+
+class PreviewCache:
+    """渲染结果的 LRU 缓存，key 含 mtime 和大小，文件变化后自然失效"""
+
+    def __init__(self, max_bytes=PREVIEW_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None: self._data.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        size = 256 + 2 * len(entry['html'] or '')
+        if size > self.max_bytes // 4: return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old: self.total_bytes -= old['_size']
+            self._data[key] = dict(entry, _size=size)
+            self.total_bytes += size
+            while self._data and self.total_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.total_bytes -= evicted['_size']
+
+preview_cache = PreviewCache()
+
+def _rendered_preview(req_path, full_path, st, encoding, bom):
+    key = (req_path, st.st_mtime_ns, st.st_size)
+    entry = preview_cache.get(key)
+    if entry is None:
+        _, _, text = read_text_window(full_path, st.st_size, encoding, bom, bom, st.st_size)
+        with metrics.timer('preview_render'):
+            kind, html = run_blocking(render_text_preview, os.path.basename(req_path), text)
+        entry = {'render': kind, 'html': html, 'text': None if html else text}
+        preview_cache.put(key, entry)
+    return entry
+
+@app.route('/api/preview/<path:req_path>')
+def api_preview(req_path):
+    """文本预览: ?offset= 向后读 | ?before= 向前读 | ?tail=1 读结尾，&length= 窗口大小；都不带时读开头并记一次预览"""
+    if not session.get('is_verified'): return jsonify({'error': '未登录'}), 401
+    req_path = secure_path(req_path)
+    if req_path is None: return jsonify({'error': '非法路径'}), 403
+    full_path = storage_pool.locate(req_path)
+    if not os.path.isfile(full_path): return jsonify({'error': '文件不存在'}), 404
+    if get_file_type(req_path) != 'code': return jsonify({'error': '此文件不支持文本预览'}), 415
+
+    st = os.stat(full_path)
+    with open(full_path, 'rb') as f:
+        encoding, bom = detect_encoding(f.read(PREVIEW_SAMPLE))
+    if encoding is None: return jsonify({'error': '二进制文件，无法预览'}), 415
+    length = max(1024, min(request.args.get('length', PREVIEW_WINDOW, type=int), PREVIEW_MAX_WINDOW))
+    offset = request.args.get('offset', type=int)
+    before = request.args.get('before', type=int)
+    result = {'path': req_path, 'size': st.st_size, 'encoding': encoding, 'mtime': st.st_mtime_ns}
+
+    if offset is None and before is None and not request.args.get('tail'):
+        try:
+            log_activity(req_path, 'view')
+        except: pass
+        if st.st_size <= PREVIEW_RENDER_MAX:
+            entry = _rendered_preview(req_path, full_path, st, encoding, bom)
+            result.update(render=entry['render'], html=entry['html'], text=entry['text'], start=bom,
+                          end=st.st_size, prev_offset=None, next_offset=None)
+            return jsonify(result)
+        offset = bom
+
+    if before is not None:
+        stop = max(bom, min(before, st.st_size))
+        start = max(bom, stop - length)
+    else:
+        start = max(bom, st.st_size - length) if offset is None else max(bom, min(offset, st.st_size))
+        stop = start + length
+    start, end, text = read_text_window(full_path, st.st_size, encoding, bom, start, stop)
+    result.update(render=None, html=None, text=text, start=start, end=end,
+                  prev_offset=start if start > bom else None, next_offset=end if end < st.st_size else None)
+    return jsonify(result)
+
 def serve_file(req_path, as_attachment):
-    if '..' in req_path: abort(403)
-    full_path = os.path.join(BASE_DIR, req_path)
+    req_path = secure_path(req_path)
+    if req_path is None: abort(403)
+    full_path = storage_pool.locate(req_path)
+    ticket, rejected = traffic_control.admit(get_client_addr(), size=_file_size(full_path))
+    if rejected: return rejected
     try:
         log_activity(req_path, 'down' if as_attachment else 'view')
     except: pass
-    return send_from_directory(os.path.dirname(full_path), os.path.basename(full_path), as_attachment=as_attachment)
+    return ticket.send(full_path, as_attachment)
+
+# ================= 启动耗时 =================
+# 从导入应用到可以处理请求的时间 (数据库迁移单独计)，写入日志和运行指标
+
+startup_seconds = time.perf_counter() - _import_started
+metrics.observe('nexus_operation_duration_seconds', startup_seconds, op='startup')
+if schema_migrations_applied:
+    metrics.observe('nexus_operation_duration_seconds', schema_seconds, op='schema_migrate')
+app.logger.info(f"Process {os.getpid()} ready in {startup_seconds:.2f}s "
+                f"(schema v{SCHEMA_VERSION}, {len(schema_migrations_applied)} migrations in {schema_seconds:.2f}s)")
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
@@ -0,0 +1,72 @@
+"""
+慢速下载回归检查：gunicorn + gevent worker 下挂上几百个慢速下载连接，同时压前台目录列表接口，
+列表请求必须全部成功且 p95 低于阈值，否则以非零状态退出 (可以直接放进 CI)。
+
+    python -m bench.check_slow                          # 默认 300 个慢连接，p95 上限 500ms
+    python -m bench.check_slow --slow-clients 500 --max-p95-ms 300
+
+数据放在独立的工作目录 (默认 /tmp/nexus-bench-check)，目录树比 small 档小，几秒钟就能准备好。
+"""
+import argparse
+import sys
+
+from . import run
+
+CHECK_SHAPE = ['--files', '200', '--wide', '2000', '--depth', '5', '--readme-kb', '16', '--log-rows', '1000']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.check_slow', description='慢速下载回归检查')
+    parser.add_argument('--workdir', default='/tmp/nexus-bench-check')
+    parser.add_argument('--slow-clients', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-d', '--duration', type=float, default=10.0)
+    parser.add_argument('--max-p95-ms', type=float, default=500.0, help='列表请求 p95 延迟上限')
+    parser.add_argument('--min-requests', type=int, default=100, help='检查期间至少完成的列表请求数')
+    return parser.parse_args(argv)
+
+
+def evaluate(result, args):
+    """返回不满足的条件列表，空列表表示通过"""
+    failures = []
+    slow = result['slow_clients']
+    connected = sum(v for k, v in slow['responses'].items() if k == '200')
+    if connected < args.slow_clients:
+        failures.append(f"只有 {connected}/{args.slow_clients} 个慢速下载连接拿到了 200，检查前提不成立")
+    if slow['client_errors']:
+        failures.append(f"慢速下载连接出错: {slow['client_errors']}")
+    if result['requests'] < args.min_requests:
+        failures.append(f"列表请求只完成了 {result['requests']} 个 (至少 {args.min_requests})")
+    errors = result['http_errors'] + sum(result['client_errors'].values())
+    if errors:
+        failures.append(f"列表请求失败 {errors} 个: 状态码 {result['status']}，客户端错误 {result['client_errors']}")
+    p95 = result['latency_ms']['p95']
+    if p95 is None or p95 > args.max_p95_ms:
+        failures.append(f"列表请求 p95 {p95} ms 超过上限 {args.max_p95_ms} ms")
+    return failures
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = run.main(CHECK_SHAPE + [
+        '--workdir', args.workdir, '--server', 'gunicorn', '--worker-class', 'gevent',
+        '--workers', str(args.workers), '--scenarios', 'slow_downloads', '--slow-clients', str(args.slow_clients),
+        '-c', str(args.concurrency), '-d', str(args.duration),
+    ])
+    result = report['scenarios']['slow_downloads']
+    failures = evaluate(result, args)
+    print()
+    print(f"{args.slow_clients} 个慢速下载 + {args.concurrency} 并发列表请求: "
+          f"{result['requests']} 个请求，p95 {result['latency_ms']['p95']} ms，"
+          f"慢连接 {result['slow_clients']['responses']}")
+    if failures:
+        for failure in failures:
+            print(f"FAIL: {failure}")
+        return 1
+    print('PASS')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
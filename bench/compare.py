@@ -0,0 +1,72 @@
+"""
+对比两次压测结果，找出变慢的场景：
+
+    python -m bench.compare before.json after.json [--threshold 10]
+
+p50/p95/p99 任一项变慢或吞吐下降超过阈值 (百分比) 记为回退，有回退时退出码为 1，可直接接在 CI 里。
+"""
+import argparse
+import json
+import sys
+
+LATENCY_KEYS = ('p50', 'p95', 'p99')
+
+
+def _change(old, new):
+    if not old or new is None: return None
+    return (new - old) / old * 100
+
+
+def compare(before, after, threshold):
+    """返回 (表格行, 回退列表)"""
+    rows, regressions = [], []
+    for name, new in after['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if old is None:
+            rows.append((name, '新增场景', '', '', ''))
+            continue
+        cells = []
+        for key in LATENCY_KEYS:
+            delta = _change(old['latency_ms'][key], new['latency_ms'][key])
+            cells.append(f"{new['latency_ms'][key]:.1f} ({delta:+.0f}%)" if delta is not None else '-')
+            if delta is not None and delta > threshold:
+                regressions.append(f"{name} {key} {old['latency_ms'][key]:.1f} -> {new['latency_ms'][key]:.1f} ms")
+        delta = _change(old['throughput_rps'], new['throughput_rps'])
+        cells.append(f"{new['throughput_rps']:.1f} ({delta:+.0f}%)" if delta is not None else '-')
+        if delta is not None and -delta > threshold:
+            regressions.append(f"{name} 吞吐 {old['throughput_rps']:.1f} -> {new['throughput_rps']:.1f} rps")
+        rows.append((name, *cells))
+    return rows, regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.compare', description='对比两次压测结果')
+    parser.add_argument('before')
+    parser.add_argument('after')
+    parser.add_argument('--threshold', type=float, default=10.0, help='判定回退的变化百分比')
+    args = parser.parse_args(argv)
+    with open(args.before, 'r', encoding='utf-8') as f:
+        before = json.load(f)
+    with open(args.after, 'r', encoding='utf-8') as f:
+        after = json.load(f)
+
+    for label, report in (('before', before), ('after', after)):
+        meta = report['meta']
+        print(f"{label}: {meta.get('git')} {meta.get('started_at')} profile={meta.get('profile')} c={meta.get('concurrency')}")
+    if before['meta'].get('shape') != after['meta'].get('shape'):
+        print('注意: 两次的数据规模不同，结果不能直接比较')
+    print()
+    rows, regressions = compare(before, after, args.threshold)
+    print(f"{'场景':<20}{'p50 ms':>18}{'p95 ms':>18}{'p99 ms':>18}{'rps':>18}")
+    for name, *cells in rows:
+        print(f"{name:<20}" + ''.join(f"{c:>18}" for c in cells))
+    if regressions:
+        print(f"\n超过 {args.threshold:g}% 的回退:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print('\n没有发现回退')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+压测数据生成：合成共享目录树、离线 IP 库、download_log 日志。
+都是确定性的 (固定随机种子)，同样的参数生成同样的数据，方便多次运行之间对比。
+"""
+import json
+import os
+import random
+import sqlite3
+import time
+from datetime import datetime, timedelta
+
+FIXTURE_MARKER = 'fixture.json'
+
+# 普通文件的扩展名分布，覆盖各种图标/类型筛选分支
+FILE_EXTS = ['.txt', '.md', '.pdf', '.docx', '.xlsx', '.jpg', '.png', '.mp4', '.mp3', '.zip', '.py', '.log']
+BULK_PER_DIR = 1000
+DOWNLOAD_FILES = {'small': 16 * 1024, 'medium': 1024 * 1024, 'large': 32 * 1024 * 1024}
+
+LOG_ACTIONS = [('down', 50), ('view', 30), ('share_down', 8), ('user_login', 6), ('login', 2), ('admin_login', 2),
+               ('logout', 2)]
+LOG_DEVICES = ['Windows / Chrome', 'Mac OS X / Safari', 'iOS / Mobile Safari', 'Android / Chrome Mobile', 'Linux / Firefox']
+IP_RANGES = 256
+
+
+def _readme(size_kb, title):
+    """生成大约 size_kb 的 Markdown，包含标题、列表、表格、代码块"""
+    parts = [f"# {title}\n\n"]
+    n, size = 0, 0
+    while size < size_kb * 1024:
+        block = (f"## 第 {n} 节\n\n这一段用来测试 README 渲染的开销，内容重复但结构完整。\n\n"
+                 f"- 列表项 **{n}-a**\n- 列表项 *{n}-b*\n- [链接](https://example.com/{n})\n\n"
+                 f"| 列 A | 列 B | 列 C |\n| --- | --- | --- |\n| {n} | {n * 2} | {n * 3} |\n\n"
+                 f"```python\ndef section_{n}():\n    return {n}\n```\n\n")
+        parts.append(block)
+        size += len(block.encode('utf-8'))
+        n += 1
+    return ''.join(parts)
+
+
+def _touch(path, size):
+    """稀疏文件：列表/搜索只关心大小，不必真的写入数据"""
+    with open(path, 'wb') as f:
+        if size: f.truncate(size)
+
+
+def build_tree(base_dir, files=2000, wide=2000, depth=20, readme_kb=64, seed=1):
+    """
+    生成共享目录：
+      deep/level_00/level_01/...   depth 层嵌套，每层几个文件
+      wide/                        单个目录放 wide 个文件 (加一个大 README)
+      bulk/part_000/...            files 个文件，每个子目录 BULK_PER_DIR 个，用于搜索/索引
+      downloads/                   真实数据的文件，用于下载测试
+    返回生成用的参数 (同时写入标记文件)，参数不变时跳过重建。
+    """
+    rng = random.Random(seed)
+    os.makedirs(base_dir, exist_ok=True)
+
+    with open(os.path.join(base_dir, 'README.md'), 'w', encoding='utf-8') as f:
+        f.write(_readme(readme_kb, 'Nexus Drive 压测目录'))
+
+    path = os.path.join(base_dir, 'deep')
+    for level in range(depth):
+        path = os.path.join(path, f"level_{level:02d}")
+        os.makedirs(path, exist_ok=True)
+        for i in range(5):
+            _touch(os.path.join(path, f"deep_{level:02d}_{i}{rng.choice(FILE_EXTS)}"), rng.randint(0, 1 << 20))
+    with open(os.path.join(path, 'README.md'), 'w', encoding='utf-8') as f:
+        f.write(_readme(max(1, readme_kb // 8), '最深一层'))
+
+    wide_dir = os.path.join(base_dir, 'wide')
+    os.makedirs(wide_dir, exist_ok=True)
+    for i in range(wide):
+        _touch(os.path.join(wide_dir, f"wide_{i:06d}{rng.choice(FILE_EXTS)}"), rng.randint(0, 1 << 30))
+    for i in range(min(50, wide // 20)):
+        os.makedirs(os.path.join(wide_dir, f"folder_{i:03d}"), exist_ok=True)
+    with open(os.path.join(wide_dir, 'README.md'), 'w', encoding='utf-8') as f:
+        f.write(_readme(readme_kb, '大目录'))
+
+    bulk_dir = os.path.join(base_dir, 'bulk')
+    for i in range(files):
+        part = os.path.join(bulk_dir, f"part_{i // BULK_PER_DIR:03d}")
+        if i % BULK_PER_DIR == 0:
+            os.makedirs(part, exist_ok=True)
+        _touch(os.path.join(part, f"file_{i:07d}{rng.choice(FILE_EXTS)}"), rng.randint(0, 1 << 26))
+
+    download_dir = os.path.join(base_dir, 'downloads')
+    os.makedirs(download_dir, exist_ok=True)
+    for name, size in DOWNLOAD_FILES.items():
+        with open(os.path.join(download_dir, f"{name}.bin"), 'wb') as f:
+            f.write(rng.randbytes(size) if hasattr(rng, 'randbytes') else os.urandom(size))
+
+    os.makedirs(os.path.join(base_dir, 'bench_uploads'), exist_ok=True)
+
+
+def ensure_tree(workdir, base_dir, shape, rebuild=False):
+    """标记文件里的参数和本次一致时复用已有目录，返回 (是否重建, 耗时秒)"""
+    marker = os.path.join(workdir, FIXTURE_MARKER)
+    try:
+        with open(marker, 'r', encoding='utf-8') as f:
+            existing = json.load(f)
+    except (OSError, ValueError):
+        existing = None
+    if existing == shape and not rebuild and os.path.isdir(base_dir):
+        return False, 0.0
+    if os.path.isdir(base_dir):
+        import shutil
+        shutil.rmtree(base_dir)
+    started = time.perf_counter()
+    build_tree(base_dir, **shape)
+    with open(marker, 'w', encoding='utf-8') as f:
+        json.dump(shape, f)
+    return True, time.perf_counter() - started
+
+
+def _ip_prefixes(seed=1):
+    rng = random.Random(seed)
+    return [f"{rng.randint(1, 223)}.{rng.randint(0, 255)}.{i}" for i in range(IP_RANGES)]
+
+
+def public_ips(seed=1, per_range=4):
+    """
+    压测请求用的 X-Forwarded-For：离线 IP 库每一段取 per_range 个地址。
+    前 IP_RANGES 个地址分别属于不同的段，排在后面的是同一批段里的其他主机。
+    """
+    prefixes = _ip_prefixes(seed)
+    return [f"{prefix}.{10 + host}" for host in range(per_range) for prefix in prefixes]
+
+
+def location_of(ip, seed=1):
+    return f"压测省 {_ip_prefixes(seed).index(ip.rsplit('.', 1)[0])} 号市"
+
+
+def write_ip_db(path, seed=1):
+    """生成离线 IP 段库 (格式见 app.OfflineIPSource)，压测不访问外网"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("# bench 生成的离线 IP 库\n")
+        for i, prefix in enumerate(_ip_prefixes(seed)):
+            f.write(f"{prefix}.0 {prefix}.255 压测省 {i} 号市\n")
+
+
+def seed_logs(db_file, rows, files, days=90, seed=1, batch=50000):
+    """
+    直接用 sqlite3 批量写入 download_log，补足到 rows 行 (已有足够行数时不写)。
+    计数器由调用方在应用上下文里 recompute_counters() 重新计算。
+    返回实际写入的行数。
+    """
+    conn = sqlite3.connect(db_file)
+    try:
+        existing = conn.execute("SELECT COUNT(*) FROM download_log").fetchone()[0]
+        missing = rows - existing
+        if missing <= 0: return 0
+        rng = random.Random(seed + existing)
+        actions = [a for a, _ in LOG_ACTIONS]
+        weights = [w for _, w in LOG_ACTIONS]
+        ips = public_ips(seed, per_range=1)
+        locations = {ip: location_of(ip, seed) for ip in ips}
+        end = datetime.utcnow() + timedelta(hours=8)
+        span = days * 86400
+        written = 0
+        while written < missing:
+            chunk = []
+            for _ in range(min(batch, missing - written)):
+                ip = rng.choice(ips)
+                chunk.append((rng.choice(files), ip, rng.choices(actions, weights)[0], locations[ip],
+                               rng.choice(LOG_DEVICES), end - timedelta(seconds=rng.randrange(span))))
+            conn.executemany(
+                "INSERT INTO download_log (filename, ip_address, action, ip_location, device_type, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)", [(*r[:5], r[5].strftime('%Y-%m-%d %H:%M:%S.%f')) for r in chunk])
+            conn.commit()
+            written += len(chunk)
+        return written
+    finally:
+        conn.close()
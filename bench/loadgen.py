@@ -0,0 +1,314 @@
+"""
+并发压测客户端：多个线程各自保持一条 HTTP/1.1 长连接，循环发请求并记录延迟。
+服务端是真实的 WSGI 应用 (werkzeug 多线程服务器)，请求走完整的路由/会话/模板/文件发送流程。
+"""
+import http.client
+import math
+import resource
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+from uuid import uuid4
+
+DESKTOP_UA = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36'
+
+
+class Request:
+    __slots__ = ('method', 'path', 'body', 'headers')
+
+    def __init__(self, method, path, body=None, headers=None):
+        self.method = method
+        self.path = path
+        self.body = body
+        self.headers = headers or {}
+
+
+def get(path, **params):
+    return Request('GET', f"{path}?{urlencode(params)}" if params else path)
+
+
+def multipart(path, fields, files):
+    """构造 multipart/form-data 请求；files 为 [(字段名, 文件名, bytes)]"""
+    boundary = uuid4().hex
+    chunks = []
+    for name, value in fields.items():
+        chunks.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, data in files:
+        chunks.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                      f'Content-Type: application/octet-stream\r\n\r\n'.encode())
+        chunks.append(data)
+        chunks.append(b'\r\n')
+    chunks.append(f'--{boundary}--\r\n'.encode())
+    return Request('POST', path, b''.join(chunks), {'Content-Type': f'multipart/form-data; boundary={boundary}'})
+
+
+class Connection:
+    """单线程使用的长连接，服务端断开时自动重连一次"""
+
+    def __init__(self, host, port, cookie=None, forwarded_for=None, timeout=60):
+        self.host, self.port = host, port
+        self.timeout = timeout
+        self.base_headers = {'User-Agent': DESKTOP_UA}
+        if cookie: self.base_headers['Cookie'] = cookie
+        if forwarded_for: self.base_headers['X-Forwarded-For'] = forwarded_for
+        self._conn = None
+
+    def request(self, req):
+        headers = dict(self.base_headers, **req.headers)
+        for attempt in (0, 1):
+            if self._conn is None:
+                self._conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                self._conn.request(req.method, req.path, body=req.body, headers=headers)
+                resp = self._conn.getresponse()
+                size = 0
+                while True:
+                    chunk = resp.read(256 * 1024)
+                    if not chunk: break
+                    size += len(chunk)
+                if resp.will_close: self.close()
+                return resp.status, size, resp
+            except (http.client.HTTPException, ConnectionError):
+                self.close()
+                if attempt: raise
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def login(host, port, password, admin=False):
+    """用真实的登录接口拿会话 Cookie (普通用户/管理员)"""
+    conn = Connection(host, port)
+    path = '/admin/login' if admin else '/login'
+    req = Request('POST', path, urlencode({'password': password}),
+                  {'Content-Type': 'application/x-www-form-urlencoded'})
+    status, _, resp = conn.request(req)
+    conn.close()
+    cookie = resp.getheader('Set-Cookie')
+    if status != 302 or not cookie:
+        raise RuntimeError(f"登录失败: {path} -> {status}")
+    return cookie.split(';', 1)[0]
+
+
+def _rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def _children(pid):
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", 'r') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def current_rss_kb(pid=None):
+    """pid 为 None 时取本进程；否则取 pid 及其所有子进程 (gunicorn master + workers) 之和"""
+    if pid is None:
+        return _rss_kb('self') or resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    total, stack = 0, [pid]
+    while stack:
+        p = stack.pop()
+        total += _rss_kb(p)
+        stack.extend(_children(p))
+    return total
+
+
+class RssSampler:
+    """
+    压测期间每 50ms 采样一次常驻内存，记录峰值。
+    进程内服务器时服务端和客户端在同一进程，数值包含两者；gunicorn 模式只统计服务端进程树。
+    """
+
+    def __init__(self, interval=0.05, pid=None):
+        self.interval = interval
+        self.pid = pid
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.peak_kb = current_rss_kb(self.pid)
+        self._thread = threading.Thread(target=self._run, name='bench-rss', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_kb = max(self.peak_kb, current_rss_kb(self.pid))
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, current_rss_kb(self.pid))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values: return None
+    # nearest-rank 法
+    idx = max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+
+def run_load(host, port, make_request, concurrency=8, duration=10.0, max_requests=None, cookie=None,
+             forwarded_for=None, warmup=0, timeout=60, server_pid=None):
+    """
+    concurrency 个线程并发执行 make_request(序号) 生成的请求，直到 duration 秒或 max_requests 次。
+    forwarded_for 为 IP 列表时按线程轮流使用。前 warmup 个请求不计入统计。
+    server_pid 为独立服务进程 (gunicorn master) 时统计它的进程树内存。
+    返回汇总结果 dict。
+    """
+    lock = threading.Lock()
+    counter = iter(range(1 << 62))
+    latencies, statuses, errors = [], Counter(), Counter()
+    total_bytes = [0]
+    deadline = [None]
+
+    def next_index():
+        with lock:
+            i = next(counter)
+        if max_requests is not None and i >= max_requests + warmup: return None
+        if deadline[0] is not None and time.perf_counter() >= deadline[0]: return None
+        return i
+
+    def worker(n):
+        ip = forwarded_for[n % len(forwarded_for)] if forwarded_for else None
+        conn = Connection(host, port, cookie, ip, timeout)
+        local_lat, local_status, local_bytes = [], Counter(), 0
+        try:
+            while True:
+                i = next_index()
+                if i is None: break
+                req = make_request(i)
+                started = time.perf_counter()
+                try:
+                    status, size, _ = conn.request(req)
+                except Exception as e:
+                    with lock: errors[type(e).__name__] += 1
+                    continue
+                elapsed = time.perf_counter() - started
+                if i < warmup: continue
+                local_lat.append(elapsed)
+                local_status[status] += 1
+                local_bytes += size
+        finally:
+            conn.close()
+            with lock:
+                latencies.extend(local_lat)
+                statuses.update(local_status)
+                total_bytes[0] += local_bytes
+
+    threads = [threading.Thread(target=worker, args=(n,), name=f"bench-client-{n}", daemon=True)
+               for n in range(concurrency)]
+    with RssSampler(pid=server_pid) as rss:
+        started = time.perf_counter()
+        if max_requests is None: deadline[0] = started + duration
+        for t in threads: t.start()
+        for t in threads: t.join()
+        wall = time.perf_counter() - started
+
+    latencies.sort()
+    count = len(latencies)
+    failed = sum(v for k, v in statuses.items() if k >= 400)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'requests': count,
+        'concurrency': concurrency,
+        'seconds': round(wall, 3),
+        'throughput_rps': round(count / wall, 2) if wall else 0,
+        'bytes': total_bytes[0],
+        'mb_per_s': round(total_bytes[0] / wall / 1048576, 2) if wall else 0,
+        'status': {str(k): v for k, v in sorted(statuses.items())},
+        'http_errors': failed,
+        'client_errors': dict(errors),
+        'latency_ms': {
+            'p50': ms(percentile(latencies, 50)), 'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)), 'mean': ms(sum(latencies) / count) if count else None,
+            'max': ms(latencies[-1]) if latencies else None,
+        },
+        'rss_peak_kb': rss.peak_kb,
+    }
+
+
+class SlowClients:
+    """
+    模拟慢速下载：count 个连接各自请求 path，每隔 interval 秒只读 read_size 字节，读完一遍后重新请求。
+    服务端在发送缓冲区写满后会阻塞在这个连接上，用来验证 worker 是否会被慢连接占满。
+    """
+
+    def __init__(self, host, port, path, count=200, cookie=None, forwarded_for=None, read_size=16 * 1024,
+                 interval=0.1, timeout=60):
+        self.host, self.port, self.path = host, port, path
+        self.count = count
+        self.cookie = cookie
+        self.forwarded_for = forwarded_for
+        self.read_size = read_size
+        self.interval = interval
+        self.timeout = timeout
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._threads = []
+        self.bytes = 0
+        self.status = Counter()
+        self.errors = Counter()
+
+    def _client(self, n):
+        headers = {'User-Agent': DESKTOP_UA}
+        if self.cookie: headers['Cookie'] = self.cookie
+        if self.forwarded_for: headers['X-Forwarded-For'] = self.forwarded_for[n % len(self.forwarded_for)]
+        while not self._stop.is_set():
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request('GET', self.path, headers=headers)
+                resp = conn.getresponse()
+                with self._lock: self.status[resp.status] += 1
+                while not self._stop.is_set():
+                    chunk = resp.read(self.read_size)
+                    if not chunk: break
+                    with self._lock: self.bytes += len(chunk)
+                    self._stop.wait(self.interval)
+                if resp.status != 200: self._stop.wait(1)
+            except Exception as e:
+                with self._lock: self.errors[type(e).__name__] += 1
+                self._stop.wait(1)
+            finally:
+                conn.close()
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        for n in range(self.count):
+            t = threading.Thread(target=self._client, args=(n,), name=f"bench-slow-{n}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        # 等连接基本都建立起来再开始测前台请求
+        deadline = time.perf_counter() + 10
+        while sum(self.status.values()) + sum(self.errors.values()) < self.count and time.perf_counter() < deadline:
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        for t in self._threads: t.join(timeout=5)
+
+    def summary(self):
+        wall = time.perf_counter() - self.started
+        return {
+            'connections': self.count,
+            'responses': {str(k): v for k, v in sorted(self.status.items())},
+            'client_errors': dict(self.errors),
+            'bytes': self.bytes,
+            'mb_per_s': round(self.bytes / wall / 1048576, 2) if wall else 0,
+        }
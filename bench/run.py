@@ -0,0 +1,311 @@
+"""
+Nexus Drive 压测入口 (完全离线，IP 归属地走 bench 生成的离线库)。
+
+    python -m bench.run --profile small                  # 生成数据并跑全部场景
+    python -m bench.run --profile medium --scenarios search,listing_wide_api -c 16 -d 20
+    python -m bench.run --conf dedup=on --out after.json   # 额外的 nexus.conf 配置
+    python -m bench.compare before.json after.json         # 对比两次结果
+    python -m bench.run --server gunicorn --worker-class gevent --scenarios slow_downloads --slow-clients 300
+    python -m bench.check_slow                             # 同上，并检查列表请求无错误、p95 达标，否则退出码非零
+
+工作目录 (--workdir，默认 /tmp/nexus-bench) 下 data/ 和 shares/ 分别作为 DATA_DIR 和 BASE_DIR，
+通过 NEXUS_DATA_DIR / NEXUS_BASE_DIR 传给 app，不会碰到真实数据。目录参数不变时复用上次生成的数据。
+结果写成 JSON：每个场景的 p50/p95/p99 延迟、吞吐、峰值 RSS，外加数据准备阶段的耗时。
+--server gunicorn 用 gunicorn.conf.py 启动独立的服务进程 (worker 类型/数量可指定)，RSS 统计服务端进程树；
+默认 inprocess 在本进程里起 werkzeug 多线程服务器。
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+from . import fixtures
+from .loadgen import SlowClients, current_rss_kb, login, run_load
+from .scenarios import SCENARIOS, SLOW_DOWNLOAD_PATH, UPLOAD_DIR
+
+USER_PASSWORD = 'bench-user'
+ADMIN_PASSWORD = 'bench-admin'
+SHARE_COUNT = 64
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# files: bulk 文件数, wide: 单目录文件数, depth: 嵌套层数, readme_kb: README 大小, log_rows: 日志行数
+PROFILES = {
+    'small': {'files': 2000, 'wide': 2000, 'depth': 20, 'readme_kb': 64, 'log_rows': 100000},
+    'medium': {'files': 100000, 'wide': 20000, 'depth': 50, 'readme_kb': 512, 'log_rows': 1000000},
+    'large': {'files': 300000, 'wide': 50000, 'depth': 100, 'readme_kb': 2048, 'log_rows': 5000000},
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m bench.run', description='Nexus Drive 压测')
+    parser.add_argument('--profile', choices=sorted(PROFILES), default='small')
+    parser.add_argument('--workdir', default=os.environ.get('NEXUS_BENCH_DIR', '/tmp/nexus-bench'))
+    parser.add_argument('--files', type=int, help='bulk/ 下的文件总数')
+    parser.add_argument('--wide', type=int, help='wide/ 单个目录里的文件数')
+    parser.add_argument('--depth', type=int, help='deep/ 的嵌套层数')
+    parser.add_argument('--readme-kb', type=int, help='README.md 大小 (KB)')
+    parser.add_argument('--log-rows', type=int, help='download_log 行数')
+    parser.add_argument('--rebuild', action='store_true', help='忽略已有数据，重新生成目录树')
+    parser.add_argument('--scenarios', default='all', help='逗号分隔的场景名，可选: ' + ','.join(SCENARIOS))
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('-d', '--duration', type=float, default=10.0, help='每个场景的持续秒数')
+    parser.add_argument('-n', '--requests', type=int, help='每个场景固定请求数 (优先于 --duration)')
+    parser.add_argument('--warmup', type=int, default=20, help='每个场景开头不计入统计的请求数')
+    parser.add_argument('--conf', action='append', default=[], metavar='KEY=VALUE', help='追加的 nexus.conf 配置')
+    parser.add_argument('--server', choices=['inprocess', 'gunicorn'], default='inprocess')
+    parser.add_argument('--worker-class', default='gevent', help='gunicorn worker 类型 (sync / gevent)')
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn worker 数')
+    parser.add_argument('--slow-clients', type=int, default=200, help='slow_downloads 场景的慢速连接数')
+    parser.add_argument('--timeout', type=float, default=30, help='单个请求的超时秒数')
+    parser.add_argument('--out', help='结果 JSON 路径，默认 <workdir>/results/<时间>.json')
+    return parser.parse_args(argv)
+
+
+def write_config(data_dir, extra):
+    ip_db = os.path.join(data_dir, 'bench-ipdb.txt')
+    fixtures.write_ip_db(ip_db)
+    lines = [f"user_password={USER_PASSWORD}", f"admin_password={ADMIN_PASSWORD}",
+             'ip_source=offline', f"ip_db={ip_db}",
+             # 日志是按 90 天生成的，自动清理会在压测期间删掉最早的一批，下次运行又要补写
+             'log_retention_days=0'] + list(extra)
+    with open(os.path.join(data_dir, 'nexus.conf'), 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=ROOT_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def sample_files(base_dir, limit=5000):
+    """从目录树里取一批相对路径作为日志里的文件名"""
+    paths = []
+    for root, _, names in os.walk(base_dir):
+        for name in names:
+            paths.append(os.path.relpath(os.path.join(root, name), base_dir).replace(os.sep, '/'))
+            if len(paths) >= limit: return paths
+    return paths
+
+
+def wait_until(predicate, timeout):
+    started = time.perf_counter()
+    while not predicate():
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError('等待后台任务超时')
+        time.sleep(0.2)
+    return time.perf_counter() - started
+
+
+def ensure_shares(nexus, files):
+    """建 SHARE_COUNT 个外链 (slug: bench-<n>)，已存在的跳过"""
+    with nexus.app.app_context():
+        existing = {s.slug for s in nexus.FileShare.query.filter(nexus.FileShare.slug.like('bench-%'))}
+        for n in range(SHARE_COUNT):
+            slug = f"bench-{n}"
+            if slug not in existing:
+                nexus.db.session.add(nexus.FileShare(file_path=files[n % len(files)], slug=slug))
+        nexus.db.session.commit()
+    return [f"bench-{n}" for n in range(SHARE_COUNT)]
+
+
+def sample_log_cursors(nexus, rows, count=16, seed=11):
+    """后台日志翻页用的游标：随机深度处的日志位置 (准备阶段用 OFFSET 取一次，压测请求只带游标)"""
+    rng = random.Random(seed)
+    log = nexus.DownloadLog
+    cursors = []
+    with nexus.app.app_context():
+        for depth in sorted(rng.randrange(max(1, rows)) for _ in range(count)):
+            row = log.query.order_by(log.timestamp.desc(), log.id.desc()).offset(depth).first()
+            if row is not None: cursors.append(nexus.encode_log_cursor(row))
+    return cursors
+
+
+class InProcessServer:
+    """本进程内的 werkzeug 多线程服务器"""
+    pid = None
+
+    def __init__(self, app):
+        from werkzeug.serving import make_server
+        self._server = make_server('127.0.0.1', 0, app, threaded=True)
+        self.port = self._server.server_port
+        threading.Thread(target=self._server.serve_forever, name='bench-server', daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+
+
+class GunicornServer:
+    """用 gunicorn.conf.py 启动独立的 gunicorn，目录通过环境变量传入"""
+
+    def __init__(self, worker_class, workers, log_file):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        env = dict(os.environ, NEXUS_BIND=f"127.0.0.1:{self.port}", NEXUS_WORKER_CLASS=worker_class,
+                   NEXUS_WORKERS=str(workers))
+        self._log = open(log_file, 'ab')
+        self._proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'app:app'],
+                                      cwd=ROOT_DIR, env=env, stdout=self._log, stderr=subprocess.STDOUT)
+        self.pid = self._proc.pid
+        started = time.perf_counter()
+        deadline = started + 60
+        while True:
+            if self._proc.poll() is not None:
+                raise RuntimeError(f"gunicorn 启动失败，日志见 {log_file}")
+            try:
+                socket.create_connection(('127.0.0.1', self.port), timeout=1).close()
+                break
+            except OSError:
+                if time.perf_counter() > deadline: raise RuntimeError('等待 gunicorn 启动超时')
+                time.sleep(0.2)
+        # 启动到开始监听 (含 master 执行数据库迁移)；worker 导入应用的耗时见 gunicorn 日志
+        self.start_seconds = time.perf_counter() - started
+
+    def stop(self):
+        self._proc.terminate()
+        try:
+            self._proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+        self._log.close()
+
+
+def print_table(results):
+    header = f"{'场景':<20}{'请求':>8}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'错误':>6}{'RSS MB':>9}"
+    print(header)
+    for name, r in results.items():
+        lat = r['latency_ms']
+        fmt = lambda v: f"{v:.1f}" if v is not None else '-'
+        print(f"{name:<20}{r['requests']:>8}{r['throughput_rps']:>10.1f}{fmt(lat['p50']):>10}{fmt(lat['p95']):>10}"
+              f"{fmt(lat['p99']):>10}{r['http_errors'] + sum(r['client_errors'].values()):>6}"
+              f"{r['rss_peak_kb'] / 1024:>9.1f}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    names = list(SCENARIOS) if args.scenarios == 'all' else [s.strip() for s in args.scenarios.split(',') if s.strip()]
+    unknown = [n for n in names if n not in SCENARIOS]
+    if unknown:
+        sys.exit(f"未知场景: {', '.join(unknown)}")
+
+    params = dict(PROFILES[args.profile])
+    for key in params:
+        value = getattr(args, key)
+        if value is not None: params[key] = value
+    log_rows = params.pop('log_rows')
+
+    workdir = os.path.abspath(args.workdir)
+    data_dir, base_dir = os.path.join(workdir, 'data'), os.path.join(workdir, 'shares')
+    os.makedirs(data_dir, exist_ok=True)
+    setup = {}
+
+    print(f"准备目录树: {params}")
+    rebuilt, seconds = fixtures.ensure_tree(workdir, base_dir, params, args.rebuild)
+    setup['tree_seconds'] = round(seconds, 3)
+    setup['tree_rebuilt'] = rebuilt
+    shutil.rmtree(os.path.join(base_dir, UPLOAD_DIR), ignore_errors=True)
+    os.makedirs(os.path.join(base_dir, UPLOAD_DIR))
+    write_config(data_dir, args.conf)
+
+    # app 在导入时读取目录配置，必须先设置环境变量
+    os.environ['NEXUS_DATA_DIR'] = data_dir
+    os.environ['NEXUS_BASE_DIR'] = base_dir
+    rss_before = current_rss_kb()
+    started = time.perf_counter()
+    import app as nexus
+    setup['import_seconds'] = round(time.perf_counter() - started, 3)
+    setup['import_rss_kb'] = current_rss_kb() - rss_before
+    logging.getLogger().setLevel(logging.WARNING)
+    nexus.app.logger.setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    print(f"准备日志: {log_rows} 行")
+    started = time.perf_counter()
+    files = sample_files(base_dir)
+    inserted = fixtures.seed_logs(os.path.join(data_dir, 'logs.db'), log_rows, files)
+    if inserted:
+        with nexus.app.app_context():
+            nexus.recompute_counters()
+    # 汇总表补齐到正常运行时的状态 (后台线程一分钟后才第一次运行)，面板图表不用扫原始日志
+    nexus.log_rollup.run_once()
+    setup['seed_rows'] = inserted
+    setup['seed_seconds'] = round(time.perf_counter() - started, 3)
+
+    print('等待文件索引...')
+    setup['index_seconds'] = round(wait_until(lambda: nexus.file_index.ready and nexus.file_index.usage_ready, 1800), 3)
+
+    ctx = {'shape': params, 'log_rows': log_rows, 'log_cursors': sample_log_cursors(nexus, log_rows),
+           'slugs': ensure_shares(nexus, [f for f in files if f.startswith('downloads/')] or files)}
+    if args.server == 'gunicorn':
+        server = GunicornServer(args.worker_class, args.workers, os.path.join(workdir, 'gunicorn.log'))
+        setup['server_start_seconds'] = round(server.start_seconds, 3)
+    else:
+        server = InProcessServer(nexus.app)
+    host, port = '127.0.0.1', server.port
+    user_cookie = login(host, port, USER_PASSWORD)
+    admin_cookie = login(host, port, ADMIN_PASSWORD, admin=True)
+    cookies = {'user': user_cookie, 'admin': admin_cookie, None: None}
+    ips = fixtures.public_ips()
+
+    results = {}
+    try:
+        for name in names:
+            session_kind, factory = SCENARIOS[name]
+            print(f"运行场景 {name} ...", flush=True)
+            load = lambda: run_load(host, port, factory(ctx), concurrency=args.concurrency, duration=args.duration,
+                                    max_requests=args.requests, cookie=cookies[session_kind], forwarded_for=ips,
+                                    warmup=args.warmup, timeout=args.timeout, server_pid=server.pid)
+            if name == 'slow_downloads':
+                # 慢连接每个用不同的 IP，避开前台请求用的前 concurrency 个，不受每 IP 并发名额限制
+                with SlowClients(host, port, SLOW_DOWNLOAD_PATH, args.slow_clients, user_cookie,
+                                 ips[args.concurrency:], timeout=args.timeout) as slow:
+                    results[name] = load()
+                results[name]['slow_clients'] = slow.summary()
+            else:
+                results[name] = load()
+    finally:
+        server.stop()
+        shutil.rmtree(os.path.join(base_dir, UPLOAD_DIR), ignore_errors=True)
+
+    report = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'git': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'profile': args.profile,
+            'shape': dict(params, log_rows=log_rows),
+            'concurrency': args.concurrency,
+            'duration': args.duration if args.requests is None else None,
+            'requests': args.requests,
+            'conf': args.conf,
+            'server': args.server if args.server == 'inprocess' else f"gunicorn/{args.worker_class}x{args.workers}",
+        },
+        'setup': setup,
+        'scenarios': results,
+    }
+    out = args.out or os.path.join(workdir, 'results', datetime.now().strftime('%Y%m%d-%H%M%S') + '.json')
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print()
+    print_table(results)
+    print(f"\n结果已保存: {out}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
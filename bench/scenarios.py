@@ -0,0 +1,132 @@
+"""
+压测场景：每个场景给出会话类型和请求生成函数 make(ctx) -> (序号 -> Request)。
+ctx 为 run.py 准备好的上下文 (目录参数、外链 slug、日志总数等)。
+"""
+import os
+import random
+
+from .fixtures import BULK_PER_DIR, DOWNLOAD_FILES
+from .loadgen import get, multipart
+
+UPLOAD_DIR = 'bench_uploads'
+UPLOAD_SIZE = 64 * 1024
+SLOW_DOWNLOAD_PATH = '/download/downloads/large.bin'
+
+
+def _deep_path(depth, level):
+    return 'deep/' + '/'.join(f"level_{i:02d}" for i in range(min(level, depth)))
+
+
+def listing_root(ctx):
+    return lambda i: get('/')
+
+
+def listing_wide_page(ctx):
+    """大目录首屏：服务端渲染的完整页面 (含 README)"""
+    return lambda i: get('/wide')
+
+
+def listing_wide_api(ctx):
+    """大目录 JSON 分页接口，轮换排序方式，偶尔翻到第二页之后"""
+    sorts = [('name', 'asc'), ('size', 'desc'), ('mtime', 'desc'), ('type', 'asc')]
+
+    def make(i):
+        sort, order = sorts[i % len(sorts)]
+        return get('/api/list/wide', sort=sort, order=order, limit=200)
+    return make
+
+
+def listing_deep(ctx):
+    depth = ctx['shape']['depth']
+    return lambda i: get('/' + _deep_path(depth, 1 + i % depth))
+
+
+def search(ctx):
+    """文件名子串搜索：命中很多 / 命中少量 / 不命中 三种混合"""
+    files = ctx['shape']['files']
+    rng = random.Random(7)
+    terms = ['file_', 'wide_0', 'deep_1', 'nothing-matches-this'] + \
+            [f"file_{rng.randrange(max(1, files)):07d}" for _ in range(32)] + \
+            [f"part_{rng.randrange(max(1, files // BULK_PER_DIR + 1)):03d}" for _ in range(8)]
+    types = ['image', 'video', 'doc', 'code']
+
+    def make(i):
+        term = terms[i % len(terms)]
+        if i % 5 == 0:
+            return get('/api/search', q=term, type=types[i // 5 % len(types)])
+        return get('/api/search', q=term)
+    return make
+
+
+def download_small(ctx):
+    return lambda i: get('/download/downloads/small.bin')
+
+
+def download_large(ctx):
+    names = list(DOWNLOAD_FILES)
+    return lambda i: get(f"/download/downloads/{names[i % len(names)]}.bin")
+
+
+def share_hit(ctx):
+    """外链访问：按 slug 查分享并发送文件，不需要登录"""
+    slugs = ctx['slugs']
+    return lambda i: get('/' + slugs[i % len(slugs)])
+
+
+def admin_dashboard(ctx):
+    """后台日志翻页：最新一页最常见，偶尔带游标跳到很靠后的位置"""
+    cursors = ctx['log_cursors']
+
+    def make(i):
+        if i % 8 == 7 and cursors:
+            return get('/admin', tab='logs', limit=50, cursor=cursors[i // 8 % len(cursors)])
+        return get('/admin', tab='logs', limit=50)
+    return make
+
+
+def admin_logs_filtered(ctx):
+    """日志查询接口：按动作 / 文件名子串 / 时间范围筛选，和深翻页游标组合"""
+    cursors = ctx['log_cursors']
+    filters = [{'action': 'view'}, {'q': 'part_0'}, {'q': 'nothing-matches-this'}, {'action': 'share_down', 'q': '.bin'},
+               {'since': '2000-01-01', 'action': 'down'}]
+
+    def make(i):
+        params = dict(filters[i % len(filters)], limit=100)
+        if i % 3 == 2 and cursors: params['cursor'] = cursors[i % len(cursors)]
+        return get('/admin/logs', **params)
+    return make
+
+
+def slow_downloads(ctx):
+    """
+    慢速下载占着大量连接时的目录浏览：run.py 在后台开 --slow-clients 个慢连接拉 SLOW_DOWNLOAD_PATH，
+    这里测前台列表接口的延迟。sync worker 会被慢连接占满，gevent worker 应该不受影响。
+    """
+    return listing_wide_api(ctx)
+
+
+def upload(ctx):
+    """multipart 上传 64KB 文件，文件名唯一；结束后由 run.py 清理上传目录"""
+    payload = os.urandom(UPLOAD_SIZE)
+
+    def make(i):
+        body = payload[:-8] + i.to_bytes(8, 'big')
+        return multipart('/admin/file/upload', {'path': UPLOAD_DIR}, [('files', f"upload_{i:08d}.bin", body)])
+    return make
+
+
+# 名称 -> (会话类型, 请求生成器)；会话类型 None 表示匿名访问
+SCENARIOS = {
+    'listing_root': ('user', listing_root),
+    'listing_wide_page': ('user', listing_wide_page),
+    'listing_wide_api': ('user', listing_wide_api),
+    'listing_deep': ('user', listing_deep),
+    'search': ('user', search),
+    'download_small': ('user', download_small),
+    'download_large': ('user', download_large),
+    'share_hit': (None, share_hit),
+    'admin_dashboard': ('admin', admin_dashboard),
+    'admin_logs_filtered': ('admin', admin_logs_filtered),
+    'slow_downloads': ('user', slow_downloads),
+    'upload': ('admin', upload),
+}
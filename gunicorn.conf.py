@@ -0,0 +1,46 @@
+"""
+gunicorn 配置 (Dockerfile 默认使用)：gunicorn -c gunicorn.conf.py app:app
+
+环境变量：
+  NEXUS_WORKER_CLASS        gevent (默认) 每个 worker 用协程处理请求，慢速下载、大文件上传只占一个协程，
+                            几百个并发连接也不会把 worker 占满；sync 为 gunicorn 默认的同步 worker，
+                            同时只能处理 NEXUS_WORKERS 个请求
+  NEXUS_WORKERS             worker 进程数，默认 4
+  NEXUS_WORKER_CONNECTIONS  gevent 模式下每个 worker 的最大并发连接数，默认 1000
+  NEXUS_BIND                监听地址，默认 0.0.0.0:5000
+
+应用里哪些阻塞操作需要配合协程，见 app.py 的「协程模式」一节。
+master 启动时先执行一次数据库迁移 (on_starting)，worker 导入应用时只检查版本号，见 app.py 的「数据库迁移」一节。
+"""
+import os
+import subprocess
+import sys
+import time
+
+bind = os.environ.get('NEXUS_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('NEXUS_WORKERS', 4))
+worker_class = os.environ.get('NEXUS_WORKER_CLASS', 'gevent')
+worker_connections = int(os.environ.get('NEXUS_WORKER_CONNECTIONS', 1000))
+# 前置 nginx 复用到上游的长连接；sync worker 不支持 keep-alive，会忽略该项
+keepalive = 5
+
+
+def on_starting(server):
+    # master 自己不导入应用 (否则 worker 会继承已导入的模块，gevent 的 monkey patch 来不及生效)，
+    # 迁移放在一次性的子进程里执行；失败时不阻止启动，由第一个 worker 拿文件锁重试
+    started = time.perf_counter()
+    try:
+        result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'migrate-db'],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=dict(os.environ, NEXUS_MIGRATE_ONLY='1'), capture_output=True, text=True)
+    except OSError as e:
+        server.log.error(f"Schema migration could not start, workers will retry: {e}")
+        return
+    # migrate-db 的结果行可能没打到 stdout (日志走 stderr 或命令输出有变化)，不能因此中断 master 启动
+    summary = (result.stdout.strip().splitlines() or ['migrate-db done'])[-1]
+    stderr = result.stderr.strip()[-2000:]
+    elapsed = time.perf_counter() - started
+    if result.returncode:
+        server.log.error(f"Schema migration failed (exit {result.returncode}), workers will retry:\n{stderr}")
+    else:
+        server.log.info(f"{summary} (exit 0, {elapsed:.2f}s)" + (f"\n{stderr}" if stderr else ''))
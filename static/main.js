@@ -1,4 +1,4 @@
-console.log("Main.js Loaded v3.5");
+console.log("Main.js Loaded v4.2");
 
 // 基础视图和选择功能
 function switchView(viewName) {
@@ -16,18 +16,12 @@ function switchView(viewName) {
 function filterType(type, element) {
     document.querySelectorAll('.nav-item').forEach(el => el.classList.remove('active'));
     element.classList.add('active');
-    const items = document.querySelectorAll('.file-item');
-    items.forEach(item => {
-        const itemType = item.getAttribute('data-type');
-        if (type === 'all' || itemType === 'folder' || itemType === type) {
-            item.style.display = (document.getElementById('fileContainer').classList.contains('grid-view')) ? 'flex' : 'grid';
-        } else { item.style.display = 'none'; }
-    });
-    document.getElementById('selectAll').checked = false;
-    clearSelection();
+    // 分页加载后页面上只有部分条目，筛选交给服务端重新拉取
+    listing.type = (type === 'all') ? '' : 'folder,' + type;
+    reloadListing();
 }
-document.getElementById('searchInput').addEventListener('input', function(e) {
-    const val = e.target.value.toLowerCase();
+function applySearchFilter() {
+    const val = document.getElementById('searchInput').value.toLowerCase();
     const items = document.querySelectorAll('.file-item');
     items.forEach(item => {
         const name = item.getAttribute('data-name').toLowerCase();
@@ -35,7 +29,74 @@ document.getElementById('searchInput').addEventListener('input', function(e) {
             item.style.display = (document.getElementById('fileContainer').classList.contains('grid-view')) ? 'flex' : 'grid';
         } else { item.style.display = 'none'; }
     });
-});
+}
+document.getElementById('searchInput').addEventListener('input', applySearchFilter);
+
+// ================= 分页加载 (无限滚动) =================
+const listing = { sort: 'name', order: 'asc', type: '', cursor: '', loading: false, generation: 0 };
+
+function listingUrl() {
+    const path = getPath();
+    const base = '/api/list' + (path ? '/' + path.split('/').map(encodeURIComponent).join('/') : '');
+    const params = new URLSearchParams({ sort: listing.sort, order: listing.order, render: 'desktop' });
+    if (listing.type) params.set('type', listing.type);
+    if (listing.cursor) params.set('cursor', listing.cursor);
+    return base + '?' + params.toString();
+}
+function loadMoreItems() {
+    if (listing.loading || !listing.cursor) return;
+    fetchListingPage(false);
+}
+function reloadListing() {
+    listing.cursor = '';
+    listing.generation++;
+    listing.loading = false;
+    clearSelection();
+    fetchListingPage(true);
+}
+function fetchListingPage(reset) {
+    const generation = listing.generation;
+    listing.loading = true;
+    fetch(listingUrl()).then(r => r.json()).then(data => {
+        if (generation !== listing.generation) return; // 已被新的排序/筛选请求取代
+        const container = document.getElementById('fileContainer');
+        if (data.error) { alert(data.error); return; }
+        if (reset) container.querySelectorAll('.file-item').forEach(el => el.remove());
+        container.insertAdjacentHTML('beforeend', data.html);
+        document.getElementById('emptyState').style.display = container.querySelector('.file-item') ? 'none' : 'block';
+        listing.cursor = data.next_cursor || '';
+        applySearchFilter();
+    }).catch(() => {}).finally(() => {
+        if (generation !== listing.generation) return;
+        listing.loading = false;
+        // 一屏没填满时继续加载
+        const sentinel = document.getElementById('listSentinel');
+        if (listing.cursor && sentinel.getBoundingClientRect().top < window.innerHeight + 400) loadMoreItems();
+    });
+}
+function sortListing(sort) {
+    if (listing.sort === sort) listing.order = (listing.order === 'asc') ? 'desc' : 'asc';
+    else { listing.sort = sort; listing.order = 'asc'; }
+    document.querySelectorAll('.list-header .sortable').forEach(el => {
+        el.querySelector('.sort-mark').innerText = (el.dataset.sort === listing.sort) ? (listing.order === 'asc' ? '▲' : '▼') : '';
+    });
+    reloadListing();
+}
+(function initInfiniteScroll() {
+    const sentinel = document.getElementById('listSentinel');
+    if (!sentinel) return;
+    listing.cursor = sentinel.dataset.nextCursor || '';
+    const scroller = document.querySelector('.file-area');
+    if ('IntersectionObserver' in window) {
+        new IntersectionObserver(entries => {
+            if (entries.some(e => e.isIntersecting)) loadMoreItems();
+        }, { root: null, rootMargin: '400px' }).observe(sentinel);
+    } else if (scroller) {
+        scroller.addEventListener('scroll', () => {
+            if (scroller.scrollTop + scroller.clientHeight > scroller.scrollHeight - 400) loadMoreItems();
+        });
+    }
+})();
 
 function updateSelectionBar() {
     const checkboxes = document.querySelectorAll('.item-checkbox:checked');
@@ -67,15 +128,27 @@ function clearSelection() {
     const sa = document.getElementById('selectAll'); if(sa) sa.checked = false;
 }
 
-// 下载功能
+// 下载功能：单个文件直接下载，多个文件或包含文件夹时打包成 ZIP
 function downloadSelectedFiles() {
-    const checkboxes = document.querySelectorAll('.item-checkbox:checked');
+    const checkboxes = Array.from(document.querySelectorAll('.item-checkbox:checked'));
     if (checkboxes.length === 0) return;
-    checkboxes.forEach((cb, index) => {
-        // 只下载非文件夹
-        const url = cb.getAttribute('data-url');
-        if(url) setTimeout(() => { triggerDownload(url); }, index * 800);
+    if (checkboxes.length === 1 && checkboxes[0].getAttribute('data-dir') !== 'true') {
+        triggerDownload(checkboxes[0].getAttribute('data-url'));
+        return;
+    }
+    const form = document.createElement('form');
+    form.method = 'POST';
+    form.action = '/archive';
+    form.style.display = 'none';
+    const fields = [['path', getPath()]].concat(checkboxes.map(cb => ['filenames', cb.value]));
+    fields.forEach(([name, value]) => {
+        const input = document.createElement('input');
+        input.type = 'hidden'; input.name = name; input.value = value;
+        form.appendChild(input);
     });
+    document.body.appendChild(form);
+    form.submit();
+    document.body.removeChild(form);
 }
 function triggerDownload(url) {
     const link = document.createElement('a');
@@ -87,21 +160,114 @@ function triggerDownload(url) {
     document.body.removeChild(link);
 }
 
-// 预览功能
-function openPreview(name, type, viewUrl, downloadUrl) {
+// 预览功能 (图片优先加载服务器生成的预览图，失败时回退到原图)
+function openPreview(name, type, viewUrl, downloadUrl, previewUrl) {
     const modal = document.getElementById('previewModal');
     const container = document.getElementById('previewContent');
     document.getElementById('previewTitle').innerText = name;
     document.getElementById('previewDl').href = downloadUrl;
     modal.classList.add('active');
+    textPreview.generation++;
+    container.onscroll = null;
+    container.style.alignItems = '';
     container.innerHTML = '<div style="color:white">加载中...</div>';
-    if (type === 'image') container.innerHTML = `<img src="${viewUrl}" class="preview-media" style="object-fit:contain;">`;
-    else if (type === 'video') container.innerHTML = `<video controls autoplay class="preview-media"><source src="${viewUrl}"></video>`;
-    else if (type === 'code' || type === 'text') fetch(viewUrl).then(r => r.text()).then(txt => { container.innerHTML = `<pre style="color:#ccc; padding:20px; width:100%; white-space:pre-wrap;">${txt.replace(/</g,"&lt;")}</pre>`; });
+    if (type === 'image') {
+        const img = document.createElement('img');
+        img.className = 'preview-media';
+        img.style.objectFit = 'contain';
+        img.onerror = function() { if (img.src.indexOf(viewUrl) === -1) img.src = viewUrl; };
+        img.src = previewUrl || viewUrl;
+        container.innerHTML = '';
+        container.appendChild(img);
+    }
+    else if (type === 'video') container.innerHTML = `<video controls autoplay class="preview-media"${previewUrl ? ` poster="${previewUrl}"` : ''}><source src="${viewUrl}"></video>`;
+    else if (type === 'code' || type === 'text') openTextPreview(container, viewUrl.replace('/view/', '/api/preview/'));
     else if (type === 'doc') container.innerHTML = `<iframe src="${viewUrl}" style="width:100%; height:100%; border:none;"></iframe>`;
     else container.innerHTML = `<div style="color:#fff; text-align:center;"><p>此文件不支持在线预览</p></div>`;
 }
 
+// ================= 文本预览 (分段加载) =================
+// 服务端每次只返回一段整行文本，滚到底部/顶部时再取下一段/上一段；小文件直接返回渲染好的 HTML
+const textPreview = { url: '', prev: null, next: null, loading: false, generation: 0 };
+
+function fetchTextWindow(params) {
+    const query = new URLSearchParams(params).toString();
+    return fetch(textPreview.url + (query ? '?' + query : '')).then(r => r.json());
+}
+function openTextPreview(container, url) {
+    const generation = ++textPreview.generation;
+    Object.assign(textPreview, { url: url, prev: null, next: null, loading: true });
+    fetchTextWindow({}).then(data => {
+        if (generation !== textPreview.generation) return;
+        textPreview.loading = false;
+        if (data.error) { container.innerHTML = `<div style="color:#fff; text-align:center;"><p>${data.error}</p></div>`; return; }
+        container.style.alignItems = 'flex-start';
+        if (data.render === 'markdown') {
+            container.innerHTML = `<div class="markdown-body" style="background:#fff; padding:20px 30px; width:100%; min-height:100%;">${data.html}</div>`;
+            return;
+        }
+        if (data.render === 'highlight') {
+            container.innerHTML = `<div style="width:100%; font-size:13px;">${data.html}</div>`;
+            return;
+        }
+        const bar = data.next_offset === null ? '' :
+            `<div style="position:sticky; top:0; padding:6px 20px; background:#1f2937; color:#9ca3af; font-size:12px; display:flex; gap:15px;">
+                <span>${formatPreviewSize(data.size)} · ${data.encoding} · 滚动时分段加载</span>
+                <a href="#" style="color:#93c5fd;" onclick="jumpTextPreview(true); return false;">跳到开头</a>
+                <a href="#" style="color:#93c5fd;" onclick="jumpTextPreview(false); return false;">跳到末尾</a>
+            </div>`;
+        container.innerHTML = bar + '<pre id="previewText" style="color:#ccc; padding:20px; margin:0; width:100%; white-space:pre-wrap;"></pre>';
+        showTextWindow(data);
+        container.onscroll = () => onTextPreviewScroll(container);
+    }).catch(() => {
+        if (generation === textPreview.generation) container.innerHTML = '<div style="color:#fff; text-align:center;"><p>加载失败</p></div>';
+    });
+}
+function formatPreviewSize(size) {
+    const units = ['B', 'KB', 'MB', 'GB', 'TB'];
+    let i = 0;
+    while (size >= 1024 && i < units.length - 1) { size /= 1024; i++; }
+    return `${size.toFixed(i ? 1 : 0)} ${units[i]}`;
+}
+function showTextWindow(data) {
+    document.getElementById('previewText').textContent = data.text;
+    textPreview.prev = data.prev_offset;
+    textPreview.next = data.next_offset;
+}
+function jumpTextPreview(head) {
+    const generation = textPreview.generation;
+    const container = document.getElementById('previewContent');
+    textPreview.loading = true;
+    fetchTextWindow(head ? { offset: 0 } : { tail: 1 }).then(data => {
+        if (generation !== textPreview.generation || data.error) return;
+        showTextWindow(data);
+        container.scrollTop = head ? 0 : container.scrollHeight;
+    }).finally(() => { if (generation === textPreview.generation) textPreview.loading = false; });
+}
+function onTextPreviewScroll(container) {
+    if (textPreview.loading) return;
+    const pre = document.getElementById('previewText');
+    const generation = textPreview.generation;
+    let params = null, append = true;
+    if (textPreview.next !== null && container.scrollTop + container.clientHeight > container.scrollHeight - 600) params = { offset: textPreview.next };
+    else if (textPreview.prev !== null && container.scrollTop < 300) { params = { before: textPreview.prev }; append = false; }
+    if (!params) return;
+    textPreview.loading = true;
+    fetchTextWindow(params).then(data => {
+        if (generation !== textPreview.generation || data.error) return;
+        if (append) {
+            pre.appendChild(document.createTextNode(data.text));
+            textPreview.next = data.next_offset;
+        } else {
+            // 在前面插入后保持当前看到的位置不动
+            const height = container.scrollHeight;
+            pre.insertBefore(document.createTextNode(data.text), pre.firstChild);
+            container.scrollTop += container.scrollHeight - height;
+            textPreview.prev = data.prev_offset;
+        }
+    }).finally(() => { if (generation === textPreview.generation) textPreview.loading = false; });
+}
+
 // ================= 管理功能 =================
 
 function getPath() { return document.getElementById('currentPath').value; }
@@ -129,44 +295,153 @@ function submitMkdir() {
     });
 }
 
-// --- 上传文件 ---
+// --- 上传文件 (分片 + 并行 + 断点续传) ---
+const UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024;
+const UPLOAD_PARALLEL = 3;
+const UPLOAD_RETRIES = 3;
+const DEDUP_HASH_LIMIT = 256 * 1024 * 1024;
+
 function triggerUpload() { document.getElementById('uploadInput').click(); }
 const uploadInputEl = document.getElementById('uploadInput');
 if(uploadInputEl) {
     uploadInputEl.addEventListener('change', function(e) {
         if (this.files.length === 0) return;
-        const formData = new FormData();
-        formData.append('path', getPath());
-        for (let i = 0; i < this.files.length; i++) formData.append('files', this.files[i]);
-        
+        const files = Array.from(this.files);
+        this.value = '';
+
         const modal = document.getElementById('uploadProgressModal');
         const bar = document.getElementById('progressBar');
         const txtPercent = document.getElementById('uploadPercent');
         const txtSpeed = document.getElementById('uploadSpeed');
         modal.style.display = 'flex';
-        
-        const xhr = new XMLHttpRequest();
+
+        const totalBytes = files.reduce((sum, f) => sum + f.size, 0) || 1;
         const startTime = new Date().getTime();
-        xhr.upload.onprogress = function(event) {
-            if (event.lengthComputable) {
-                const percent = (event.loaded / event.total) * 100;
-                bar.style.width = percent + "%";
-                txtPercent.innerText = Math.round(percent) + "%";
-                const now = new Date().getTime();
-                const duration = (now - startTime) / 1000;
-                if (duration > 0) txtSpeed.innerText = formatSpeed(event.loaded / duration);
+        let doneBytes = 0;      // 已确认写入的字节 (含续传时服务器已有的分片)
+        let sentBytes = 0;      // 本次实际发送的字节，用于计算速度
+        const inflight = {};    // 正在上传的分片已发送字节
+        function refresh() {
+            const loaded = doneBytes + Object.values(inflight).reduce((a, b) => a + b, 0);
+            const percent = Math.min(100, (loaded / totalBytes) * 100);
+            bar.style.width = percent + "%";
+            txtPercent.innerText = Math.round(percent) + "%";
+            const duration = (new Date().getTime() - startTime) / 1000;
+            if (duration > 0) txtSpeed.innerText = formatSpeed((sentBytes + Object.values(inflight).reduce((a, b) => a + b, 0)) / duration);
+        }
+
+        (async () => {
+            for (const file of files) await uploadOneFile(file, {
+                onChunkProgress(key, loaded) { inflight[key] = loaded; refresh(); },
+                onChunkDone(key, size, sent) { delete inflight[key]; doneBytes += size; if (sent) sentBytes += size; refresh(); }
+            });
+        })().then(() => window.location.reload()).catch(err => {
+            alert("上传失败: " + err.message);
+            modal.style.display = 'none';
+        });
+    });
+}
+
+async function uploadJSON(url, method, body) {
+    const resp = await fetch(url, {
+        method: method,
+        headers: {'Content-Type': 'application/json'},
+        body: body === undefined ? undefined : JSON.stringify(body)
+    });
+    let data = {};
+    try { data = await resp.json(); } catch (e) { throw new Error("服务器错误"); }
+    if (!resp.ok || data.error) throw new Error(data.error || "服务器错误");
+    return data;
+}
+
+async function uploadOneFile(file, hooks) {
+    // 同一文件重新选择时 fingerprint 相同，服务器会返回已收到的分片，实现断点续传
+    const init = await uploadJSON('/admin/file/upload/init', 'POST', {
+        path: getPath(), name: file.name, size: file.size, chunk_size: UPLOAD_CHUNK_SIZE,
+        fingerprint: `${file.lastModified}`
+    });
+    // 去重模式：还没传过分片时先算整文件哈希，服务器已有相同内容就秒传 (crypto.subtle 只能整块计算，大文件跳过)
+    let sha256 = null;
+    if (init.dedup && !init.received.length && file.size <= DEDUP_HASH_LIMIT && window.crypto && crypto.subtle && window.isSecureContext) {
+        const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        sha256 = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+        const again = await uploadJSON('/admin/file/upload/init', 'POST', {
+            path: getPath(), name: file.name, size: file.size, chunk_size: UPLOAD_CHUNK_SIZE,
+            fingerprint: `${file.lastModified}`, sha256: sha256
+        });
+        if (again.instant) {
+            hooks.onChunkDone(`${init.upload_id}:instant`, file.size, false);
+            return again;
+        }
+    }
+    const chunkSize = init.chunk_size;
+    const received = new Set(init.received);
+    const pending = [];
+    for (let i = 0; i < init.total_chunks; i++) {
+        const size = Math.min(chunkSize, file.size - i * chunkSize);
+        if (received.has(i)) hooks.onChunkDone(`${init.upload_id}:${i}`, size, false);
+        else pending.push(i);
+    }
+    async function worker() {
+        while (pending.length) {
+            const index = pending.shift();
+            const blob = file.slice(index * chunkSize, Math.min(file.size, (index + 1) * chunkSize));
+            const key = `${init.upload_id}:${index}`;
+            for (let attempt = 1; ; attempt++) {
+                try {
+                    await uploadChunk(init.upload_id, index, blob, loaded => hooks.onChunkProgress(key, loaded));
+                    break;
+                } catch (err) {
+                    hooks.onChunkProgress(key, 0);
+                    if (attempt >= UPLOAD_RETRIES) throw err;
+                    await new Promise(r => setTimeout(r, 1000 * attempt));
+                }
             }
-        };
+            hooks.onChunkDone(key, blob.size, true);
+        }
+    }
+    await Promise.all(Array.from({length: UPLOAD_PARALLEL}, worker));
+    return uploadJSON(`/admin/file/upload/${init.upload_id}/complete`, 'POST', sha256 ? { sha256: sha256 } : {});
+}
+
+// CRC32 (与 Python zlib.crc32 相同)：crypto.subtle 只在 HTTPS 下可用，普通 HTTP 也要能校验每个分片
+const CRC32_TABLE = (() => {
+    const table = new Uint32Array(256);
+    for (let n = 0; n < 256; n++) {
+        let c = n;
+        for (let k = 0; k < 8; k++) c = c & 1 ? 0xEDB88320 ^ (c >>> 1) : c >>> 1;
+        table[n] = c >>> 0;
+    }
+    return table;
+})();
+
+function crc32(bytes) {
+    let crc = 0xFFFFFFFF;
+    for (let i = 0; i < bytes.length; i++) crc = CRC32_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    return ((crc ^ 0xFFFFFFFF) >>> 0).toString(16).padStart(8, '0');
+}
+
+async function uploadChunk(uploadId, index, blob, onProgress) {
+    const headers = {'Content-Type': 'application/octet-stream'};
+    const data = await blob.arrayBuffer();
+    headers['X-Chunk-Crc32'] = crc32(new Uint8Array(data));
+    // HTTPS 下再带上 SHA-256
+    if (window.crypto && crypto.subtle && window.isSecureContext) {
+        const digest = await crypto.subtle.digest('SHA-256', data);
+        headers['X-Chunk-Sha256'] = Array.from(new Uint8Array(digest)).map(b => b.toString(16).padStart(2, '0')).join('');
+    }
+    return new Promise((resolve, reject) => {
+        const xhr = new XMLHttpRequest();
+        xhr.upload.onprogress = function(event) { if (event.lengthComputable) onProgress(event.loaded); };
         xhr.onload = function() {
-            if (xhr.status === 200) {
-                const resp = JSON.parse(xhr.responseText);
-                if (resp.success) window.location.reload();
-                else { alert("上传失败: " + resp.error); modal.style.display = 'none'; }
-            } else { alert("服务器错误"); modal.style.display = 'none'; }
+            let resp = {};
+            try { resp = JSON.parse(xhr.responseText); } catch (e) {}
+            if (xhr.status === 200 && resp.success) resolve(resp);
+            else reject(new Error(resp.error || "服务器错误"));
         };
-        xhr.onerror = function() { alert("网络错误"); modal.style.display = 'none'; };
-        xhr.open("POST", "/admin/file/upload");
-        xhr.send(formData);
+        xhr.onerror = function() { reject(new Error("网络错误")); };
+        xhr.open("PUT", `/admin/file/upload/${uploadId}/${index}`);
+        Object.entries(headers).forEach(([k, v]) => xhr.setRequestHeader(k, v));
+        xhr.send(blob);
     });
 }
 function formatSpeed(bytesPerSec) {
@@ -232,11 +507,56 @@ function doDelete(filenames) {
         headers: {'Content-Type': 'application/json'},
         body: JSON.stringify({ path: getPath(), filenames: filenames })
     }).then(r => r.json()).then(data => {
-        if(data.success) window.location.reload();
+        if (data.success && data.job_id) watchJob(data.job_id, '正在删除');
+        else if(data.success) window.location.reload();
         else alert("删除失败: " + (data.msg || data.error));
     });
 }
 
+// --- 移动 / 复制 (后台任务) ---
+function transferSelectedFiles(kind) {
+    const filenames = Array.from(document.querySelectorAll('.item-checkbox:checked')).map(cb => cb.value);
+    if (filenames.length === 0) return;
+    const label = kind === 'move' ? '移动' : '复制';
+    const dest = prompt(`${label}到文件夹 (相对根目录的路径，留空为根目录):`, getPath());
+    if (dest === null) return;
+    uploadJSON(`/admin/file/${kind}`, 'POST', { path: getPath(), filenames: filenames, dest: dest.trim().replace(/^\/+|\/+$/g, '') })
+        .then(data => watchJob(data.job_id, '正在' + label))
+        .catch(err => alert(label + "失败: " + err.message));
+}
+
+// --- 后台任务进度 ---
+let watchingJobId = null;
+function watchJob(jobId, title) {
+    watchingJobId = jobId;
+    document.getElementById('jobTitle').innerText = title || '正在处理';
+    document.getElementById('jobModal').style.display = 'flex';
+    const poll = () => fetch(`/admin/jobs/${jobId}`).then(r => r.json()).then(job => {
+        if (job.error) throw new Error(job.error);
+        const total = job.total_bytes || job.total_items;
+        const done = job.total_bytes ? job.done_bytes : job.done_items;
+        const percent = total ? Math.min(100, done / total * 100) : 0;
+        document.getElementById('jobProgressBar').style.width = percent + '%';
+        document.getElementById('jobPercent').innerText = Math.round(percent) + '%';
+        document.getElementById('jobDetail').innerText = `${job.done_items} / ${job.total_items} 项`;
+        if (job.status === 'pending' || job.status === 'running') { setTimeout(poll, 1000); return; }
+        if (job.status === 'failed' || job.status === 'interrupted') alert("任务失败: " + (job.message || job.status));
+        window.location.reload();
+    }).catch(err => { alert(err.message); window.location.reload(); });
+    poll();
+}
+function cancelWatchedJob() {
+    if (!watchingJobId) return;
+    fetch(`/admin/jobs/${watchingJobId}/cancel`, { method: 'POST' });
+    document.getElementById('jobTitle').innerText = '正在取消...';
+}
+// 刷新页面后继续显示进行中的任务
+if (document.getElementById('jobModal')) {
+    fetch('/admin/jobs?active=1').then(r => r.json()).then(jobs => {
+        if (Array.isArray(jobs) && jobs.length) watchJob(jobs[jobs.length - 1].id, '正在处理后台任务');
+    }).catch(() => {});
+}
+
 // --- 分享 (保持原有) ---
 function openShareModal(relPath, fileName) {
     document.getElementById('shareModal').classList.add('active');
@@ -40,8 +40,8 @@ function closeActionSheet() {
 
 function execDownload() {
     if(!currentItem) return;
-    if(currentItem.isDir) { alert('手机端暂不支持文件夹打包下载'); return; }
-    window.location.href = '/download/' + currentItem.relPath;
+    if(currentItem.isDir) window.location.href = '/archive/' + currentItem.relPath;
+    else window.location.href = '/download/' + currentItem.relPath;
     closeActionSheet();
 }
 
@@ -83,13 +83,28 @@ function execDelete() {
                 filenames: [currentItem.name] 
             })
         }).then(r => r.json()).then(data => {
-            if(data.success) window.location.reload();
+            if(data.success && data.job_id) waitJob(data.job_id);
+            else if(data.success) window.location.reload();
             else alert(data.error || data.msg);
         });
     }
     closeActionSheet();
 }
 
+// 文件夹删除在后台任务中执行，轮询到结束再刷新
+function waitJob(jobId) {
+    const brand = document.querySelector('.brand');
+    fetch(`/admin/jobs/${jobId}`).then(r => r.json()).then(job => {
+        if (job.status === 'pending' || job.status === 'running') {
+            brand.innerHTML = `<i class="fa-solid fa-spinner fa-spin"></i> 处理中 ${job.done_items}/${job.total_items}`;
+            setTimeout(() => waitJob(jobId), 1000);
+            return;
+        }
+        if (job.status !== 'done') alert("任务失败: " + (job.message || job.error || job.status));
+        window.location.reload();
+    }).catch(() => window.location.reload());
+}
+
 // --- 管理员菜单逻辑 ---
 
 function toggleAdminMenu() {
@@ -150,3 +165,39 @@ if(upInput) {
         });
     });
 }
+
+// --- 分页加载 (无限滚动) ---
+
+let nextCursor = '';
+let loadingMore = false;
+
+function loadMoreItems() {
+    if (loadingMore || !nextCursor) return;
+    loadingMore = true;
+    const path = getPath();
+    const base = '/api/list' + (path ? '/' + path.split('/').map(encodeURIComponent).join('/') : '');
+    const params = new URLSearchParams({ cursor: nextCursor, render: 'mobile' });
+    fetch(base + '?' + params.toString()).then(r => r.json()).then(data => {
+        if (data.error) { nextCursor = ''; return; }
+        document.getElementById('listSentinel').insertAdjacentHTML('beforebegin', data.html);
+        nextCursor = data.next_cursor || '';
+    }).catch(() => {}).finally(() => {
+        loadingMore = false;
+        const sentinel = document.getElementById('listSentinel');
+        if (nextCursor && sentinel.getBoundingClientRect().top < window.innerHeight + 600) loadMoreItems();
+    });
+}
+
+const listSentinel = document.getElementById('listSentinel');
+if (listSentinel) {
+    nextCursor = listSentinel.dataset.nextCursor || '';
+    if ('IntersectionObserver' in window) {
+        new IntersectionObserver(entries => {
+            if (entries.some(e => e.isIntersecting)) loadMoreItems();
+        }, { rootMargin: '600px' }).observe(listSentinel);
+    } else {
+        window.addEventListener('scroll', () => {
+            if (window.innerHeight + window.scrollY > document.body.scrollHeight - 600) loadMoreItems();
+        });
+    }
+}